@@ -0,0 +1,156 @@
+import io
+import os
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from contextlib import redirect_stdout, redirect_stderr
+
+import pandas as pd
+from PIL import Image
+
+from experiments import get_parser, run_chains, run_turns
+from scripts.lvlm_chat import LVLMChat, prewarm_image_cache
+from scripts.mock_backend import MockBackend, parse_mock_spec
+from scripts.rate_limit import RetryPolicy
+from scripts.results import get_stream_fp, load_result_rows
+from scripts.scheduler import ChainScheduler
+from scripts.setups import SETUP_NAMES, get_setup
+from scripts.transcripts import TranscriptStore
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark the experiment engine offline against the mock backend.")
+    parser.add_argument("--setup_names", type=str, default=",".join(SETUP_NAMES), help="Comma-separated setups to benchmark. Default is all.")
+    parser.add_argument("--concurrency", type=str, default="1,4,16,64", help="Comma-separated max_concurrency levels. Default is 1,4,16,64.")
+    parser.add_argument("--modes", type=str, default="threads,async", help="Comma-separated engines: threads, async or both. Default is both.")
+    parser.add_argument("--mock_backend", type=str, default="latency=0.05,jitter=0.2", help="MockBackend settings, see experiments.py --mock_backend.")
+    parser.add_argument("--rounds", type=str, default="1,2,3,4", help="Rounds of every chain. Default is 1,2,3,4.")
+    parser.add_argument("--num_pairs", type=int, default=10, help="Number of synthetic pairs. Default is 10.")
+    parser.add_argument("--num_runs", type=int, default=2, help="num_experiments_per_experiment of every setup. Default is 2.")
+    parser.add_argument("--num_models", type=int, default=2, help="Number of mock models. Default is 2.")
+    parser.add_argument("--num_objects", type=int, default=13, help="Number of objects per image. Default is 13.")
+    parser.add_argument("--img_size", type=int, default=400, help="Side of the synthetic grid images in pixels. Default is 400.")
+    parser.add_argument("--num_chats", type=int, default=20, help="Number of chats kept alive to measure the memory per chat. Default is 20.")
+    parser.add_argument("--output_fp", type=str, default=None, help="Also save the results to this JSONL file.")
+    return parser.parse_args()
+
+
+def make_synthetic_data(dire, num_objects=13, num_rounds=4, num_pairs=10, num_images=8, num_runs=10, img_size=400, seed=0):
+    '''Random transcripts, grid images, mapper and playbook shaped like the real data, for offline runs.'''
+    rng = random.Random(seed)
+    ids = list(range(1, num_objects + 1))
+
+    image_fps, mapper = [], dict()
+    for i in range(num_images):
+        image_fp = os.path.join(dire, f"random_order_{i}.png")
+        Image.frombytes("RGB", (img_size, img_size), rng.randbytes(img_size * img_size * 3)).save(image_fp)
+        image_fps.append(image_fp)
+        mapper[image_fp] = rng.sample(ids, num_objects)
+
+    playbook = {str(run): {str(r): rng.choice(image_fps) for r in range(1, num_rounds + 1)} for run in range(num_runs)}
+
+    pairs = [f"Pair{p}" for p in range(1, num_pairs + 1)]
+    chunks, answers = dict(), dict()
+    for r in range(1, num_rounds + 1):
+        answers[r] = rng.sample(ids, num_objects)
+        for pair in pairs:
+            chunks[(r, pair)] = [f"D: in round {r}, the next one is object {obj}, it has a {rng.choice(['round', 'square', 'woven', 'tall'])} "
+                                 f"shape and a {rng.choice(['dark', 'light', 'striped', 'plain'])} rim.\nM: Okay, got it." for obj in answers[r]]
+
+    return TranscriptStore(pairs, chunks, answers), image_fps, mapper, playbook
+
+
+def get_setup_args(setup_name, args):
+    return get_parser().parse_args(["--setup_name", setup_name, "--rounds", args.rounds,
+                                    "--num_pairs", str(args.num_pairs),
+                                    "--num_experiments_per_experiment", str(args.num_runs)])
+
+
+def get_chat_kwargs(setup, setup_args):
+    return dict(system_prompt=setup.system_prompt, retry_policy=RetryPolicy(max_tries=setup_args.max_tries))
+
+
+def benchmark_throughput(setup, setup_args, models, mock_kwargs, concurrency, use_async, res_fp):
+    '''Run every chain of the setup against the mock backend and time it end to end.'''
+    mocks = {model: MockBackend(setup.num_objects_per_image, model=model, **mock_kwargs) for model in models}
+    completion_fns = {model: mock.acompletion if use_async else mock.completion for model, mock in mocks.items()}
+    rounds = [int(r) for r in setup_args.rounds.split(",")]
+    chains = setup.get_chains(rounds, setup.transcripts.pairs, models)
+
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        run_chains(ChainScheduler(max_concurrency=concurrency), chains, setup.cols, res_fp,
+                   get_chat_kwargs(setup, setup_args), use_async, completion_fns=completion_fns)
+    elapsed = perf_counter() - start
+
+    num_trials = len(load_result_rows(get_stream_fp(res_fp)))
+    num_requests = sum(mock.num_attempts for mock in mocks.values())
+    return {"chains": len(chains), "trials": num_trials, "requests": num_requests, "seconds": elapsed,
+            "trials/s": num_trials / elapsed, "requests/s": num_requests / elapsed}
+
+
+def benchmark_memory(setup, setup_args, model, num_chats):
+    '''Mean memory held by a chat after all its turns, measured with tracemalloc.'''
+    mock = MockBackend(setup.num_objects_per_image, model=model)
+    rounds = [int(r) for r in setup_args.rounds.split(",")]
+    chains = setup.get_chains(rounds, setup.transcripts.pairs, [model])[:num_chats]
+
+    chats = []
+    with redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _, _, turns_fn in chains:
+            chat = LVLMChat(model=model, completion_fn=mock.completion, **get_chat_kwargs(setup, setup_args))
+            run_turns(chat, turns_fn())
+            chats.append(chat)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    return {"chats": len(chats), "kb/chat": (after - before) / len(chats) / 1024,
+            "messages/chat": sum(len(chat.messages) for chat in chats) / len(chats)}
+
+
+def main():
+    args = get_args()
+    mock_kwargs = parse_mock_spec(args.mock_backend)
+    models = [f"mock/model-{i}" for i in range(args.num_models)]
+    num_rounds = max(int(r) for r in args.rounds.split(","))
+
+    with tempfile.TemporaryDirectory() as dire:
+        transcripts, image_fps, mapper, playbook = make_synthetic_data(dire, args.num_objects, num_rounds, args.num_pairs,
+                                                                       num_runs=args.num_runs, img_size=args.img_size)
+        # encode the images once, so that the runs measure the engine rather than PNG decoding
+        prewarm_image_cache(image_fps)
+
+        throughput, memory = [], []
+        for setup_name in args.setup_names.split(","):
+            setup_args = get_setup_args(setup_name, args)
+            setup = get_setup(setup_name, transcripts, mapper, playbook, image_fps, args.num_objects, setup_args)
+            setup.check_rounds([int(r) for r in args.rounds.split(",")])
+
+            memory.append(dict(setup=setup_name, **benchmark_memory(setup, setup_args, models[0], args.num_chats)))
+            for mode in args.modes.split(","):
+                for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                    res_fp = os.path.join(dire, f"{setup_name}-{mode}-{concurrency}.csv")
+                    totals = benchmark_throughput(setup, setup_args, models, mock_kwargs, concurrency, mode == "async", res_fp)
+                    throughput.append(dict(setup=setup_name, mode=mode, concurrency=concurrency, **totals))
+                    print(f"{setup_name}, {mode}, concurrency {concurrency}: {totals['trials/s']:.1f} trials/s")
+
+    print()
+    print(pd.DataFrame(throughput).to_string(index=False, float_format="{:.2f}".format))
+    print()
+    print(pd.DataFrame(memory).to_string(index=False, float_format="{:.1f}".format))
+
+    if args.output_fp is not None:
+        with open(args.output_fp, "w") as f:
+            for row in throughput:
+                f.write(json.dumps(dict(row, benchmark="throughput")) + "\n")
+            for row in memory:
+                f.write(json.dumps(dict(row, benchmark="memory")) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import json
+import base64
+import random
+import argparse
+import tempfile
+from io import BytesIO
+
+import pandas as pd
+from PIL import Image
+
+from experiments import get_parser, load_image_fps_and_mapper, run_chains
+from scripts.image_profiles import parse_image_profile, estimate_image_tokens
+from scripts.lvlm_chat import get_image_data_url
+from scripts.mock_backend import MockBackend, parse_mock_spec
+from scripts.rate_limit import RetryPolicy
+from scripts.response_cache import ResponseCache
+from scripts.scheduler import ChainScheduler
+from scripts.setups import get_setup
+from scripts.telemetry import Telemetry
+from scripts.transcripts import TranscriptStore
+from scripts.usage import UsageLedger
+from scripts.utils import load_dict_from_json
+
+
+DEFAULT_PROFILES = ";".join(["original", "format=png,tile=512", "format=jpeg,quality=90",
+                             "format=jpeg,quality=75,tile=512", "format=webp,quality=80,tile=512"])
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Compare image profiles by payload size, image tokens, latency and accuracy on a fixed sample.")
+    parser.add_argument("--data_fp", type=str, default="data/baskets-matching-data.xlsx", help="Path to the data file")
+    parser.add_argument("--image_dire", type=str, default="data/baskets-grid/", help="Directory containing images")
+    parser.add_argument("--setup_name", type=str, default="one transcript at a time", choices=["one transcript at a time", "object summaries"], help="Setup of the sample.")
+    parser.add_argument("--profiles", type=str, default=DEFAULT_PROFILES, help="Semicolon-separated image profiles, see experiments.py --image_profile. 'original' sends the image files as they are.")
+    parser.add_argument("--models", type=str, default="openai/gpt-4o-mini-2024-07-18", help="Comma-separated models.")
+    parser.add_argument("--rounds", type=str, default="1,2,3,4", help="Rounds of the sample. Default is 1,2,3,4.")
+    parser.add_argument("--num_pairs", type=int, default=4, help="Number of pairs in the sample. Default is 4.")
+    parser.add_argument("--num_runs", type=int, default=2, help="Number of runs in the sample. Default is 2.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sample, the same for every profile. Default is 0.")
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Max chains in flight per provider. Default is 4.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Response cache, so that re-running the benchmark does not pay twice.")
+    parser.add_argument("--mock_backend", type=str, default=None, help="Run against the mock backend (see experiments.py --mock_backend), which only measures payloads and the engine.")
+    parser.add_argument("--output_fp", type=str, default=None, help="Also save the results to this JSONL file.")
+    return parser.parse_args()
+
+
+def parse_profiles(spec):
+    return {name.strip(): None if name.strip() == "original" else parse_image_profile(name)
+            for name in spec.split(";")}
+
+
+def measure_payloads(image_fps, profile):
+    '''Mean payload size, image size and estimated image tokens of the images encoded with the profile.'''
+    num_bytes, widths, heights, tokens = [], [], [], []
+    for image_fp in image_fps:
+        data = base64.b64decode(get_image_data_url(image_fp, profile=profile).split(",", 1)[1])
+        with Image.open(BytesIO(data)) as img:
+            size = img.size
+        num_bytes.append(len(data))
+        widths.append(size[0])
+        heights.append(size[1])
+        tokens.append(estimate_image_tokens(size))
+
+    n = len(image_fps)
+    return {"size": f"{round(sum(widths) / n)}x{round(sum(heights) / n)}", "kb/image": sum(num_bytes) / n / 1024,
+            "image tokens (est.)": sum(tokens) / n}
+
+
+def run_sample(setup, models, profile, args, res_fp):
+    '''Run the fixed sample with the profile and return accuracy, prompt tokens and latency by model.'''
+    usage_ledger, telemetry = UsageLedger(), Telemetry()
+    cache = ResponseCache(args.cache_dir) if args.cache_dir is not None else None
+    chat_kwargs = dict(system_prompt=setup.system_prompt, cache=cache, retry_policy=RetryPolicy(),
+                       usage_ledger=usage_ledger, telemetry=telemetry, image_profiles={"*": profile})
+
+    completion_fns = None
+    if args.mock_backend is not None:
+        completion_fns = {model: MockBackend(setup.num_objects_per_image, model=model, **parse_mock_spec(args.mock_backend)).completion
+                          for model in models}
+
+    # every profile gets the same sample of images, pairs and rounds
+    random.seed(args.seed)
+    chains = setup.get_chains([int(r) for r in args.rounds.split(",")], setup.transcripts.pairs[:args.num_pairs], models)
+    run_chains(ChainScheduler(max_concurrency=args.max_concurrency), chains, setup.cols, res_fp, chat_kwargs,
+               completion_fns=completion_fns)
+
+    df = pd.read_csv(res_fp)
+    usage, timings = usage_ledger.summary(), telemetry.summary()
+    out = dict()
+    for model in models:
+        accus = pd.to_numeric(df.loc[df["Model"] == model, "Accu"], errors="coerce")
+        totals, network = usage.get(model, dict()), timings.get((model, "network"), dict())
+        out[model] = {"accuracy": accus.mean(),
+                      "prompt tokens/request": totals.get("prompt_tokens", 0) / max(1, totals.get("requests", 0)),
+                      "network p50": network.get("p50"), "network p95": network.get("p95")}
+    return out
+
+
+def main():
+    args = get_args()
+    models = args.models.split(",")
+
+    transcripts = TranscriptStore.load(args.data_fp)
+    all_image_fps, mapper = load_image_fps_and_mapper(args.image_dire)
+    playbook = load_dict_from_json(os.path.join(args.image_dire, "playbook.json"))
+    setup_args = get_parser().parse_args(["--setup_name", args.setup_name, "--rounds", args.rounds,
+                                          "--num_experiments_per_experiment", str(args.num_runs)])
+    setup = get_setup(args.setup_name, transcripts, mapper["data"], playbook, all_image_fps,
+                      mapper["metadata"]["number_of_objects_per_image"], setup_args)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as dire:
+        for name, profile in parse_profiles(args.profiles).items():
+            payloads = measure_payloads(all_image_fps, profile)
+            results = run_sample(setup, models, profile, args, os.path.join(dire, f"{len(rows)}.csv"))
+            for model, totals in results.items():
+                rows.append(dict(profile=name, model=model, **payloads, **totals))
+                print(f"{name}, {model}: {payloads['kb/image']:.0f} KB/image, accuracy {totals['accuracy']:.3f}")
+
+    print()
+    print(pd.DataFrame(rows).to_string(index=False, float_format="{:.3f}".format))
+
+    if args.output_fp is not None:
+        with open(args.output_fp, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
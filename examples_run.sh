@@ -1,3 +1,5 @@
+# The same runs as a grid that runs in parallel: python sweep.py sweeps/examples.json
+
 
 ### One Transcript at a Time (Main Experiments)
 
@@ -1,28 +1,32 @@
-import re
 import os
+import asyncio
 import argparse
-import pandas as pd
-from random import sample
 from tqdm import tqdm
 from datetime import datetime
-from scripts.lvlm_chat import LVLMChat
-from scripts.utils import get_conversations, load_dict_from_json
-from scripts.prompt_templates import get_prompt_templates_from_setup_name
-
-
-random_sequence_mapper = {
-    10: "3, 7, 1, 5, 2, 8, 10, 4, 6, 9",
-    13: "3, 7, 1, 12, 5, 2, 13, 8, 10, 4, 6, 9, 11",
-}
-
-
-SETUP_NAMES = [
-    "one transcript at a time", "object summaries",
-    "all transcripts", "object descriptions","plus feedback"
-]
-
-
-def get_args():
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from scripts.lvlm_chat import LVLMChat, AsyncLVLMChat, FAILED_RESPONSE, prewarm_image_cache
+from scripts.batch import run_batch
+from scripts.response_cache import ResponseCache, get_cache_key
+from scripts.rate_limit import RetryPolicy, FailureLog, get_rate_limiter
+from scripts.usage import UsageLedger
+from scripts.telemetry import Telemetry
+from scripts.mock_backend import MockBackend, parse_mock_spec
+from scripts.local_backend import LocalBackend, is_local_model
+from scripts.image_profiles import load_image_profiles, get_image_profile
+from scripts.planner import SweepPlan, record_turns, replay_turns
+from scripts.grids import VirtualGridSource, create_playbook
+from scripts.results import ResultWriter, get_stream_fp, get_state_fp, load_done_keys, save_results, \
+    save_run_state, load_run_state
+from scripts.scheduler import ChainScheduler, parse_provider_concurrency
+from scripts.utils import load_dict_from_json
+from scripts.transcripts import TranscriptStore
+from scripts.scoring import extract_prediction, compute_accu, answer_transform, \
+    extract_json_response, compute_accu_for_json_response
+from scripts.setups import SETUP_NAMES, random_sequence_mapper, get_setup
+
+
+def get_parser():
     parser = argparse.ArgumentParser(description="Run the observer task experiment.")
     # need something to check that the data_fp and image_dire correspond to each other
     parser.add_argument("--data_fp", type=str, default="data/baskets-matching-data.xlsx", help="Path to the data file")
@@ -33,45 +37,64 @@ def get_args():
     parser.add_argument("--num_experiments_per_experiment", type=int, default=1, help="Number of experiments per experiment")
     parser.add_argument("--models", type=str, default="openai/gpt-4o-mini-2024-07-18", help="Model name(s) to use")
     parser.add_argument("--max_img_dim", type=int, default=None, help="Max image dimension for the model")
+    parser.add_argument("--image_profile", type=str, default=None, help="How images are encoded for all models, like format=jpeg,quality=85,max_dim=1024,tile=512 (format is png, jpeg or webp). Replaces --max_img_dim.")
+    parser.add_argument("--image_profiles_fp", type=str, default=None, help="JSON file of {model: image profile} overriding --image_profile for specific models.")
     parser.add_argument("--temperature", type=float, default=0.0, help="Temperature for the model")
     parser.add_argument("--output_fn", type=str, default=None, help="Output filename. If not provided, will be the timestamp.")
     parser.add_argument("--not_use_playbook", action="store_true", help="Whether to use the playbook. If not provided, will use the playbook.")
     parser.add_argument("--repeat_same_img", action="store_true", help="Whether to repeat the same image for each model run. Only implemented for setup_id=1 and setup_id=2.")
+    parser.add_argument("--seed_images_dir", type=str, default=None, help="Render the grids in memory from the object pictures in this directory (e.g. data/scan-baskets-segmented) and the mapper.json of image_dire, instead of reading PNGs.")
+    parser.add_argument("--num_virtual_grids", type=int, default=None, help="With --seed_images_dir, render this many new random grids instead of the ones in mapper.json, with a new playbook.")
+    parser.add_argument("--grid_seed", type=int, default=0, help="Seed of the random grids and playbook of --num_virtual_grids. Default is 0.")
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Max number of (run, model, pair) chains in flight per provider. Default is 4. Use 1 to run serially.")
+    parser.add_argument("--use_async", action="store_true", help="Run all chains on one event loop with AsyncLVLMChat instead of a thread per chain.")
+    parser.add_argument("--fan_out", action="store_true", help="Send each request to all --models at the same time, building it once. max_concurrency then caps the (run, pair) groups in flight.")
+    parser.add_argument("--provider_concurrency", type=str, default=None, help="Per-provider overrides of max_concurrency, e.g. openai=8,groq=2")
+    parser.add_argument("--max_tries", type=int, default=5, help="Max attempts per request. Retries back off exponentially and honor Retry-After.")
+    parser.add_argument("--requests_per_minute", type=float, default=None, help="Requests per minute allowed per model. Default is no limit.")
+    parser.add_argument("--tokens_per_minute", type=float, default=None, help="Estimated tokens per minute allowed per model. Default is no limit.")
+    parser.add_argument("--prompt_caching", action="store_true", help="Mark the system prompt and the latest turns as cacheable (anthropic-style cache_control).")
+    parser.add_argument("--max_images_in_history", type=int, default=None, help="Only send the last N images of a conversation and replace older ones with a text placeholder. Default is to send all.")
+    parser.add_argument("--max_turns_in_history", type=int, default=None, help="Only keep the first turn and the last N turns of a conversation in its history. Default is to keep all.")
+    parser.add_argument("--summarize_dropped_turns", action="store_true", help="With --max_turns_in_history, keep what was said in the dropped turns in one message, without their images and responses.")
+    parser.add_argument("--stream", action="store_true", help="Stream the responses and log the time to first token and to the final answer.")
+    parser.add_argument("--early_stop", action="store_true", help="Stream the responses and stop generating once a valid final answer has been given. Not used for the 'all transcripts' and 'plus feedback' setups.")
+    parser.add_argument("--batch", action="store_true", help="Send the requests as offline batch jobs, one batch per conversation turn.")
+    parser.add_argument("--batch_backend", type=str, default="litellm", choices=["litellm", "local"], help="Backend for --batch. 'local' runs the batch files locally for testing.")
+    parser.add_argument("--batch_poll_interval", type=float, default=60, help="Seconds between batch status checks. Default is 60.")
+    parser.add_argument("--mock_backend", type=str, nargs="?", const="", default=None, help="Answer with a local mock backend instead of the APIs, optionally configured like latency=0.5,jitter=0.2,error_rate=0.01,rate_limit_rate=0.05,seed=0")
+    parser.add_argument("--mock_templates_fp", type=str, default=None, help="JSON list of response templates for --mock_backend, with {answer} where the predicted sequence goes.")
+    parser.add_argument("--local_batch_size", type=int, default=8, help="Max requests per batched forward pass of local/<model id> models. Default is 8.")
+    parser.add_argument("--local_batch_wait", type=float, default=0.05, help="Seconds a local model waits for a batch to fill up. Default is 0.05.")
+    parser.add_argument("--local_max_new_tokens", type=int, default=512, help="Max tokens generated per response by local models. Default is 512.")
+    parser.add_argument("--local_num_threads", type=int, default=None, help="CPU threads used by local models. Default is the torch default.")
+    parser.add_argument("--plan", action="store_true", help="Compile every request of the run first, print the estimated requests, tokens, cost and time, and only send chains that are not identical to an earlier one (at temperature 0).")
+    parser.add_argument("--dry_run", action="store_true", help="With --plan, stop after printing the plan.")
+    parser.add_argument("--plan_seconds_per_request", type=float, default=5.0, help="Seconds per request assumed by --plan. Default is 5.")
+    parser.add_argument("--plan_response_tokens", type=int, default=300, help="Tokens per response assumed by --plan. Default is 300.")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run with the same output_fn, skipping the chains already saved.")
+    parser.add_argument("--prewarm_images", action="store_true", help="Encode all images in image_dire up front instead of on first use.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the on-disk response cache. If not provided, responses are not cached.")
+    parser.add_argument("--cache_max_mb", type=float, default=None, help="Evict least recently used cache entries beyond this size in MB. Default is no limit.")
+    parser.add_argument("--cache_replay", action="store_true", help="Only serve responses from the cache and fail on a miss, without calling any API.")
     
-    return parser.parse_args()
+    return parser
+
+
+def get_args():
+    return get_parser().parse_args()
 
 
 def get_time_stamp():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-def extract_prediction(response, num_objects_per_image):
-    matches = re.findall(r'\d+(?:\s*,\s*\d+)+', response)
-    
-    if matches:
-        for match in matches[::-1]:
-            match = [int(x.strip()) for x in match.split(",")]
-            if set(match) == set(range(1, num_objects_per_image)):
-                return match
-        
-        return [int(x.strip()) for x in matches[-1].split(",")]
-        
-    return "CANNOT_PARSE"
+def get_res_fp(image_dire, setup_name, output_fn=None):
+    dire = image_dire.rstrip("/").split("/")[-1]
+    if output_fn is None:
+        output_fn = get_time_stamp()
+    return f"results/{dire}/setup{setup_name}/{output_fn}.csv"
 
-    
-def compute_accu(answer, pred):
-    if pred == "CANNOT_PARSE":
-        return 0
-    else:
-        return sum([a==p for a, p in zip(answer, pred)]) / len(answer)
-    
-
-def answer_transform(img_fp, answer, mapper):
-    if img_fp in mapper:
-        return [mapper[img_fp].index(x) + 1 for x in answer]
-    else:
-        raise ValueError(f"Image path {img_fp} not found in mapper.") 
-    
 
 def load_image_fps_and_mapper(image_dire):
     image_fps = [os.path.join(image_dire, f) for 
@@ -80,35 +103,231 @@ def load_image_fps_and_mapper(image_dire):
     return image_fps, mapper
 
 
-def extract_json_response(response, num_matches=None):    
-    matches = re.findall(r'\d+(?:\s*,\s*\d+)+', response)[-num_matches:]
-
-    if len(matches) == num_matches:
-        out = dict()
-        for i, match in enumerate(matches):
-            out[f"Round {i+1}"] = [int(x.strip()) for x in match.split(",")]
-        
-        return out
-
-    return "CANNOT_PARSE"
-
+def load_virtual_grids(args):
+    '''Image paths, mapper and playbook of grids rendered in memory from the object pictures, see VirtualGridSource.
 
-def compute_accu_for_json_response(answers, preds):
-    out = [0] * len(answers)
+    These are the grids in the mapper.json of image_dire, or with `num_virtual_grids`, as many new
+    random grids and a playbook drawn over them.
+    '''
+    source = VirtualGridSource.from_mapper(args.seed_images_dir, args.image_dire.rstrip("/"))
+    metadata = dict(load_dict_from_json(os.path.join(args.image_dire, "mapper.json"))["metadata"])
 
-    if preds == "CANNOT_PARSE":
-        return out
+    if args.num_virtual_grids is None:
+        playbook = load_dict_from_json(os.path.join(args.image_dire, "playbook.json"))
+        image_fps = list(source.mapper)
     else:
-        for i in range(len(preds)):
+        image_fps = source.add_random_orders(args.num_virtual_grids, seed=args.grid_seed)
+        playbook = create_playbook(image_fps, args.num_experiments_per_experiment, seed=args.grid_seed)
+
+    metadata["number_of_images"] = len(image_fps)
+    return image_fps, {"data": {fp: source.mapper[fp] for fp in image_fps}, "metadata": metadata}, playbook
+
+
+def run_turns(chat, turns):
+    '''Feed the prompts yielded by a chain generator to the chat and return the rows the chain returns.'''
+    try:
+        prompt = next(turns)
+        while True:
+            prompt = turns.send(chat.get_chat_completion(prompt))
+    except StopIteration as e:
+        return e.value
+
+
+async def run_turns_async(chat, turns):
+    try:
+        prompt = next(turns)
+        while True:
+            prompt = turns.send(await chat.get_chat_completion(prompt))
+    except StopIteration as e:
+        return e.value
+
+
+def run_turns_in_batches(jobs, chat_kwargs, writer, batch_backend, fp_prefix, poll_interval=60, completion_fns=None):
+    '''Advance all (model, turns_fn) chains one turn per batch job until every chain is done.
+
+    Single-turn setups finish after one batch, multi-turn setups need one batch per turn.
+    Cached responses are served directly and only the misses are submitted. Models with
+    `completion_fns` have their batches run locally (see scripts.batch.get_batch_backend).
+    '''
+    cache = chat_kwargs.get("cache")
+    completion_fns = completion_fns or dict()
+    active = []
+    for ix, (model, turns_fn) in enumerate(jobs):
+        turns = turns_fn()
+        # the chats only lay out the requests; with a completion_fn, mock/ and local/ models skip litellm's vision check
+        chat = LVLMChat(model=model, completion_fn=completion_fns.get(model), **chat_kwargs)
+        active.append((str(ix), model, chat, turns, next(turns)))
+
+    wave = 0
+    while active:
+        wave += 1
+        requests, responses = [], dict()
+
+        for custom_id, model, chat, _, prompt in active:
+            chat.append_message("user", prompt)
+            messages = list(chat.get_request_messages())
+            if cache is not None:
+                responses[custom_id] = cache.get(get_cache_key(model, chat.temperature, messages))
+            if responses.get(custom_id) is None:
+                requests.append((custom_id, model, messages, chat.temperature))
+
+        print(f"Batch wave {wave}: {len(requests)} requests for {len(active)} chains.")
+        if requests:
+            batch_responses = run_batch(requests, batch_backend, f"{fp_prefix}.wave{wave}", poll_interval, completion_fns)
+            for custom_id, model, messages, temperature in requests:
+                response = batch_responses.get(custom_id)
+                if response is not None and cache is not None:
+                    response = cache.put(get_cache_key(model, temperature, messages), model, temperature, response)
+                responses[custom_id] = response
+
+        still_active = []
+        for custom_id, model, chat, turns, _ in active:
+            response = responses.get(custom_id)
+            if response is None:
+                response = FAILED_RESPONSE
+            else:
+                chat.append_message("assistant", response)
+
             try:
-                pred = preds[f"Round {i+1}"]
-                answer = answers[i]
-                out[i] = sum([a==p for a, p in zip(answer, pred)]) / len(answer)
-            except Exception as e:
-                print(f"Error processing Round {i+1}: {e}")
-                out[i] = "CANNOT_PARSE"
-        
-        return out
+                still_active.append((custom_id, model, chat, turns, turns.send(response)))
+            except StopIteration as e:
+                writer.write(e.value)
+
+        active = still_active
+
+
+def group_chains(chains):
+    '''Group the (model, keys, turns_fn) chains that send the same requests to different models into
+    (models, keys, turns_fns) chains, in the order of their first chain. Keys are (run, model, ...).'''
+    groups = dict()
+    for model, keys, turns_fn in chains:
+        group_key = tuple(key[:1] + key[2:] for key in keys)
+        models, group_keys, turns_fns = groups.setdefault(group_key, ([], [], []))
+        models.append(model)
+        group_keys.extend(keys)
+        turns_fns.append(turns_fn)
+    return [(tuple(models), keys, turns_fns) for models, keys, turns_fns in groups.values()]
+
+
+def run_chains(scheduler, chains, cols, res_fp, chat_kwargs, use_async=False, resume=False,
+               batch_backend=None, batch_poll_interval=60, rate_limits=(None, None), completion_fns=None,
+               fan_out=False, plan=None):
+    '''Run the (model, keys, turns_fn) chains through the scheduler.
+
+    Each chain gets its own chat, so the rounds within a chain share one conversation history.
+    The rows of every finished chain are appended to a JSONL file right away, and the CSV at
+    `res_fp` (and a typed Arrow file next to it) is written from it once all chains are done. With `resume`, chains whose
+    (run, model, pair, round) keys are all in the JSONL file already are skipped. With
+    `batch_backend`, the requests are sent as batch jobs instead (see run_turns_in_batches).
+    `rate_limits` are the (requests/min, tokens/min) allowed per model, and `completion_fns` can
+    replace the completion function of a model, e.g. with a MockBackend.
+
+    With `fan_out`, the chains that only differ by model run together: every model gets its own
+    chat, but the chats share the messages built from the prompts, and all models are queried at
+    the same time, so a group of chains takes as long as its slowest model.
+
+    With a `plan` (see scripts.planner.SweepPlan) of the same chains, chains that duplicate an
+    earlier one are not sent; they are scored on the responses of the chain they duplicate.
+    '''
+    stream_fp = get_stream_fp(res_fp)
+    completion_fns = completion_fns or dict()
+    telemetry = chat_kwargs.get("telemetry")
+
+    def update_progress(pbar):
+        if telemetry is not None:
+            pbar.set_postfix_str(telemetry.get_postfix(), refresh=False)
+        pbar.update(1)
+
+    done = set()
+    if resume:
+        done = load_done_keys(stream_fp, [keys for _, keys, _ in chains])
+    todo = [(ix, chain) for ix, chain in enumerate(chains) if not set(chain[1]) <= done]
+    if resume:
+        print(f"Resuming from {stream_fp}: {len(chains) - len(todo)} of {len(chains)} chains already done.")
+
+    duplicates, records = [], dict()
+    if plan is not None:
+        duplicates = [(ix, chain) for ix, chain in todo if plan.duplicate_of[ix] is not None]
+        todo = [(ix, chain) for ix, chain in todo if plan.duplicate_of[ix] is None]
+        # record the turns of the chains that have duplicates, to score the duplicates on
+        for i, (ix, (model, keys, turns_fn)) in enumerate(todo):
+            if plan.has_duplicates(ix):
+                todo[i] = (ix, (model, keys, partial(record_turns, turns_fn, records.setdefault(ix, []))))
+        print(f"Sending {len(todo)} unique chains, {len(duplicates)} duplicates are scored on their responses.")
+    todo = [chain for _, chain in todo]
+
+    with ResultWriter(stream_fp, cols, append=resume) as writer:
+        def execute(todo):
+            if batch_backend is not None:
+                run_turns_in_batches([(model, turns_fn) for model, _, turns_fn in todo], chat_kwargs, writer, batch_backend,
+                                     os.path.splitext(res_fp)[0], batch_poll_interval, completion_fns)
+            elif use_async:
+                async def run_chain(model, turns_fn, message_cache=None):
+                    chat = AsyncLVLMChat(model=model, rate_limiter=get_rate_limiter(model, *rate_limits),
+                                         completion_fn=completion_fns.get(model), message_cache=message_cache,
+                                         **chat_kwargs)
+                    return await run_turns_async(chat, turns_fn())
+
+                async def run_group(models, turns_fns):
+                    message_cache = dict()
+                    results = await asyncio.gather(*[run_chain(model, turns_fn, message_cache)
+                                                     for model, turns_fn in zip(models, turns_fns)])
+                    return [row for rows in results for row in rows]
+
+                if fan_out:
+                    jobs = [(models, partial(run_group, models, turns_fns)) for models, _, turns_fns in group_chains(todo)]
+                else:
+                    jobs = [(model, partial(run_chain, model, turns_fn)) for model, _, turns_fn in todo]
+
+                async def run_all():
+                    with tqdm(total=len(jobs)) as pbar:
+                        async for _, rows in scheduler.run_async(jobs):
+                            writer.write(rows)
+                            update_progress(pbar)
+
+                asyncio.run(run_all())
+            else:
+                def run_chain(model, turns_fn, message_cache=None):
+                    chat = LVLMChat(model=model, rate_limiter=get_rate_limiter(model, *rate_limits),
+                                    completion_fn=completion_fns.get(model), message_cache=message_cache,
+                                    **chat_kwargs)
+                    return run_turns(chat, turns_fn())
+
+                def run_group(models, turns_fns):
+                    message_cache = dict()
+                    with ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="fan-out") as executor:
+                        futures = [executor.submit(run_chain, model, turns_fn, message_cache)
+                                   for model, turns_fn in zip(models, turns_fns)]
+                        return [row for future in futures for row in future.result()]
+
+                if fan_out:
+                    jobs = [(models, partial(run_group, models, turns_fns)) for models, _, turns_fns in group_chains(todo)]
+                else:
+                    jobs = [(model, partial(run_chain, model, turns_fn)) for model, _, turns_fn in todo]
+
+                with tqdm(total=len(jobs)) as pbar:
+                    for _, rows in scheduler.run(jobs):
+                        writer.write(rows)
+                        update_progress(pbar)
+
+        execute(todo)
+
+        if plan is not None:
+            # score the duplicates on the responses of their first chain, and send any that ask for other prompts
+            rerun = []
+            for ix, (model, keys, turns_fn) in duplicates:
+                rows = replay_turns(turns_fn, records.get(plan.duplicate_of[ix]))
+                if rows is None:
+                    rerun.append((model, keys, turns_fn))
+                else:
+                    writer.write(rows)
+            print(f"Scored {len(duplicates) - len(rerun)} duplicate chains on the responses of the chains they duplicate.")
+            if rerun:
+                execute(rerun)
+
+    # chains finish out of order, so put the rows back in chain order for the CSV
+    order = {key: ix for ix, (_, keys, _) in enumerate(chains) for key in keys}
+    save_results(stream_fp, cols, res_fp, order)
 
 
 def main():
@@ -119,289 +338,121 @@ def main():
     obj2 = args.image_dire.split("/")[-1].split("-")[0]
     assert obj1 == obj2, f"Data file {args.data_fp} and image directory {args.image_dire} do not match."
 
-    df = pd.read_excel(args.data_fp)
-    all_image_fps, mapper = load_image_fps_and_mapper(args.image_dire)
+    transcripts = TranscriptStore.load(args.data_fp)
+    if args.seed_images_dir is not None:
+        all_image_fps, mapper, playbook = load_virtual_grids(args)
+    else:
+        all_image_fps, mapper = load_image_fps_and_mapper(args.image_dire)
+        playbook = load_dict_from_json(os.path.join(args.image_dire, "playbook.json"))
     num_objects_per_image = mapper["metadata"]["number_of_objects_per_image"]
     mapper = mapper["data"]
 
-    playbook = load_dict_from_json(os.path.join(args.image_dire, "playbook.json"))
-
-    system_prompt, prompt_tmp = get_prompt_templates_from_setup_name(args.setup_name)
-    system_prompt = system_prompt.substitute(num_of_objects=num_objects_per_image, 
-                                             example_sequence=random_sequence_mapper[num_objects_per_image])
-
     rounds = [int(t) for t in args.rounds.split(",")]
-    pairs = df.columns.to_list()[3:][:args.num_pairs]
+    pairs = transcripts.pairs[:args.num_pairs]
     models = args.models.split(",")
 
     if args.image_dire.endswith("/"):
         args.image_dire = args.image_dire[:-1]
 
-    dire = args.image_dire.split("/")[-1]
+    res_fp = get_res_fp(args.image_dire, args.setup_name, args.output_fn)
+    os.makedirs(os.path.dirname(res_fp), exist_ok=True)
 
-    if args.output_fn is not None:
-        res_fp = f"results/{dire}/setup{args.setup_name}/{args.output_fn}.csv"
+    if args.resume:
+        assert args.output_fn is not None, "--resume requires the output_fn of the interrupted run."
+        load_run_state(get_state_fp(res_fp), args)
     else:
-        res_fp = f"results/{dire}/setup{args.setup_name}/{get_time_stamp()}.csv"
-    os.makedirs(os.path.dirname(res_fp), exist_ok=True)
+        save_run_state(get_state_fp(res_fp), args)
 
-    if args.setup_name == "one transcript at a time":
-        for i in range(len(rounds) - 1):
-            assert rounds[i] + 1 == rounds[i + 1], \
-                f"Under setup {args.setup_name}, rounds should be consecutive. Found {rounds[i]} and {rounds[i + 1]}."
-         
-        out = []
-        cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Response", "Prediction", "Answer", "Accu"]
-
-        for run_num in range(args.num_experiments_per_experiment):
-            
-            image_fps = sample(all_image_fps, len(rounds))
-            
-            for model in models:
-                for pair in pairs:
-                    chat = LVLMChat(model=model, system_prompt=system_prompt, 
-                                    max_img_dim=args.max_img_dim, 
-                                    temperature=args.temperature,)
-                    
-                    for i, round in enumerate(rounds):
-
-                        if not args.not_use_playbook:
-                            if args.repeat_same_img:
-                                image_path = playbook[str(run_num)][str(rounds[0])]
-                            else:
-                                image_path = playbook[str(run_num)][str(round)]
-                        else:
-                            image_path = image_fps[i]
-                        
-                        transcript, answer = get_conversations(df, round, pair, return_entire_transcript=True)
-                        answer = answer_transform(image_path, answer, mapper)
-
-                        prompt = prompt_tmp.substitute(transcript=transcript, image_path=image_path)
-                        response = chat.get_chat_completion(prompt)
-
-                        try:
-                            pred = extract_prediction(response, num_objects_per_image)
-                            accu = compute_accu(answer, pred)
-                            print(f"Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}, Accuracy {accu:.2f}")
-                            out.append([run_num, round, pair, image_path, model, response, pred, answer, accu])
-                        
-                        except Exception as e:
-                            print(f"Error processing Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}: {e}")
-                            out.append([run_num, round, pair, image_path, model, response, "ERROR", answer, 0])
-        
-                    out_df = pd.DataFrame(out, columns=cols)
-                    out_df.to_csv(res_fp, index=False)
-        
-        out_df = pd.DataFrame(out, columns=cols)
-        out_df.to_csv(res_fp, index=False)
-
-    elif args.setup_name == "object summaries":
-        for i in range(len(rounds) - 1):
-            assert rounds[i] + 1 == rounds[i + 1], \
-                f"Under setup {args.setup_name}, rounds should be consecutive. Found {rounds[i]} and {rounds[i + 1]}."
-         
-        out = []
-        cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Response", "Prediction", "Answer", "Accu"]
-
-        for run_num in range(args.num_experiments_per_experiment):
-            
-            image_fps = sample(all_image_fps, len(rounds))
-            
-            for model in models:
-                for pair in pairs:
-                    chat = LVLMChat(model=model, system_prompt=system_prompt, 
-                                    max_img_dim=args.max_img_dim, 
-                                    temperature=args.temperature,)
-                    
-                    for i, round in enumerate(rounds):
-
-                        if not args.not_use_playbook:
-                            image_path = playbook[str(run_num)][str(round)]
-                        else:
-                            image_path = image_fps[i]
-                        
-                        summaries, answer = get_conversations(df, round, pair, return_entire_transcript=False)
-                        summaries = ["### Summary for object " + str(i+1) + "\n" + s for i, s in enumerate(summaries)]
-                        summaries = "\n\n".join(summaries)
-                        answer = answer_transform(image_path, answer, mapper)
-                        prompt = prompt_tmp.substitute(summaries=summaries, image_path=image_path)
-                        response = chat.get_chat_completion(prompt)
-
-                        try:
-                            pred = extract_prediction(response, num_objects_per_image)
-                            accu = compute_accu(answer, pred)
-                            print(f"Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}, Accuracy {accu:.2f}")
-                            out.append([run_num, round, pair, image_path, model, response, pred, answer, accu])
-                        
-                        except Exception as e:
-                            print(f"Error processing Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}: {e}")
-                            out.append([run_num, round, pair, image_path, model, response, "ERROR", answer, 0])
-        
-                    out_df = pd.DataFrame(out, columns=cols)
-                    out_df.to_csv(res_fp, index=False)
-        
-        out_df = pd.DataFrame(out, columns=cols)
-        out_df.to_csv(res_fp, index=False)
-    
-    elif args.setup_name == "all transcripts":
-        for i in range(len(rounds) - 1):
-            assert rounds[i] + 1 == rounds[i + 1], \
-                f"Under setup {args.setup_name}, rounds should be consecutive. Found {rounds[i]} and {rounds[i + 1]}."
-            
-        out = []
-        cols = ["Run Number", "Rounds", "Pair", "Image FPs", "Model", "Response", "Prediction", "Answer", "Accu"]
-
-        for run_num in range(args.num_experiments_per_experiment):
-            image_fps = sample(all_image_fps, len(rounds))
-            
-            for model in models:
-                for pair in pairs:
-                    chat = LVLMChat(model=model, 
-                                    system_prompt=system_prompt, 
-                                    max_img_dim=args.max_img_dim, 
-                                    temperature=args.temperature,)
-                    prompts, answers = [], []
-
-                    for i, round in enumerate(rounds):
-
-                        if not args.not_use_playbook:
-                            image_path = playbook[str(run_num)][str(round)]
-                            image_fps[i] = image_path
-                        else:
-                            image_path = image_fps[i]
-                        
-                        transcript, answer = get_conversations(df, round, pair, return_entire_transcript=True)
-                        answer = answer_transform(image_path, answer, mapper)
-                        prompt = prompt_tmp.substitute(transcript=transcript, image_path=image_path, ix=i+1)
-                        prompts.append(prompt)
-                        answers.append(answer)
-                    
-                    prompt = f"\n\n{'*'*50}\n\n".join(prompts)
-                    response = chat.get_chat_completion(prompt)
-                    try:
-                        preds = extract_json_response(response, num_matches=len(rounds))
-                        accus = compute_accu_for_json_response(answers, preds)
-                        print(f"Run Number {run_num}, Image Paths {image_fps}, Rounds {rounds}, Pair {pair}, Model {model}, Accuracy {accus}")
-                        out.append([run_num, rounds, pair, image_fps, model, response, preds, answers, accus])
-                    
-                    except Exception as e:
-                        print(f"Error processing Run Number {run_num}, Image Paths {image_fps}, Rounds {rounds}, Pair {pair}, Model {model}: {e}")
-                        out.append([run_num, rounds, pair, image_fps, model, response, "ERROR", answers, 0])
-        
-                out_df = pd.DataFrame(out, columns=cols)
-                out_df.to_csv(res_fp, index=False)
-
-        out_df = pd.DataFrame(out, columns=cols)
-        out_df.to_csv(res_fp, index=False)
-        print(f"Results saved to {res_fp}")
-    
-    elif args.setup_name == "plus feedback":
-        for i in range(len(rounds) - 1):
-            assert rounds[i] + 1 == rounds[i + 1], \
-                f"Under setup {args.setup_name}, rounds should be consecutive. Found {rounds[i]} and {rounds[i + 1]}."
-         
-        out = []
-        cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Response", "Prediction", "Answer", "Accu"]
-
-        for run_num in range(args.num_experiments_per_experiment):
-            
-            image_fps = sample(all_image_fps, len(rounds))
-            
-            for model in models:
-                for pair in pairs:
-                    chat = LVLMChat(model=model, system_prompt=system_prompt, 
-                                    max_img_dim=args.max_img_dim, 
-                                    temperature=args.temperature,)
-                    
-                    for i, round in enumerate(rounds):
-
-                        if not args.not_use_playbook:
-                            if args.repeat_same_img:
-                                image_path = playbook[str(run_num)][str(rounds[0])]
-                            else:
-                                image_path = playbook[str(run_num)][str(round)]
-                        else:
-                            image_path = image_fps[i]
-                        
-                        transcript, answer = get_conversations(df, round, pair, return_entire_transcript=True)
-                        answer = answer_transform(image_path, answer, mapper)
-
-                        prompt = prompt_tmp.substitute(transcript=transcript, image_path=image_path)
-                        response = chat.get_chat_completion(prompt)
-
-                        try:
-                            pred = extract_prediction(response, num_objects_per_image)
-                            accu = compute_accu(answer, pred)
-                            print(f"Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}, Accuracy {accu:.2f}")
-                            out.append([run_num, round, pair, image_path, model, response, pred, answer, accu])
-                        
-                        except Exception as e:
-                            print(f"Error processing Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}: {e}")
-                            out.append([run_num, round, pair, image_path, model, response, "ERROR", answer, 0])
-                        
-                        answer_prompt = f"Here is correct sequence of picture indices as described by the Director: {answer}. Reflect on your previous answer if it was wrong. We will proceed after your reflection."
-                        response = chat.get_chat_completion(answer_prompt)
-                        out.append([run_num, round, pair, image_path, model, response, "ResponseToTheCorrectAnswer", answer, 0])
-        
-                    out_df = pd.DataFrame(out, columns=cols)
-                    out_df.to_csv(res_fp, index=False)
-        
-        out_df = pd.DataFrame(out, columns=cols)
-        out_df.to_csv(res_fp, index=False)
-
-
-    elif args.setup_name == "object descriptions":
-        assert args.num_experiments_per_experiment <= len(all_image_fps), \
-            f"Under setup {args.setup_name}, number of experiments per experiment {args.num_experiments_per_experiment} "\
-                f"cannot be greater than number of images {len(all_image_fps)}."
-        
-        out = []
-        cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Conversation", "Response", "Prediction", "Answer", "Accu"]
-
-        image_fps = sample(all_image_fps, args.num_experiments_per_experiment)
-
-        for run_num, image_path in enumerate(image_fps):
-            for model in models:
-                for round in rounds:
-
-                    if not args.not_use_playbook:
-                        image_path = playbook[str(run_num)][str(round)]
-                    
-                    for pair in pairs:
-                        conversations, answer = get_conversations(df, round, pair, return_entire_transcript=False)
-                        conversations = conversations + ["The conversation is over. Please give your final answer."]
-                        answer = answer_transform(image_path, answer, mapper)
-
-                        chat = LVLMChat(model=model,
-                                        system_prompt=system_prompt, 
-                                        max_img_dim=args.max_img_dim,
-                                        temperature=args.temperature)
-                        
-                        prompt = prompt_tmp.substitute(conversation=conversations[0], image_path=image_path)
-                        response = chat.get_chat_completion(prompt)
-                        out.append([run_num, round, pair, image_path, model, conversations[0], response, '-', '-', '-'])
-
-                        for ix, conversation in tqdm(enumerate(conversations[1:])):
-                            response = chat.get_chat_completion(conversation)
-                            out.append([run_num, round, pair, image_path, model, conversation, response, '-', '-', '-'])
-                        
-                        # final response
-                        try:
-                            pred = extract_prediction(response, num_objects_per_image)
-                            accu = compute_accu(answer, pred)
-                            print(f"Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}, Accuracy {accu:.2f}")
-                            out.append([run_num, round, pair, image_path, model, conversation, response, pred, answer, accu])
-                        
-                        except Exception as e:
-                            print(f"Error processing Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}: {e}")
-                            out.append([run_num, round, pair, image_path, model, conversation, response, "ERROR", answer, 0])
-                
-                    out_df = pd.DataFrame(out, columns=cols)
-                    out_df.to_csv(res_fp, index=False)
-        
-        out_df = pd.DataFrame(out, columns=cols)
-        out_df.to_csv(res_fp, index=False)
-        print(f"Results saved to {res_fp}")
+    image_profiles = load_image_profiles(args.image_profile, args.image_profiles_fp)
+    if args.prewarm_images:
+        profiles = {get_image_profile(image_profiles, model) for model in models}
+        prewarm_image_cache(all_image_fps, args.max_img_dim, profiles=list(profiles))
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResponseCache(args.cache_dir, max_size_mb=args.cache_max_mb, read_only=args.cache_replay)
+    else:
+        assert not args.cache_replay, "--cache_replay requires --cache_dir."
+
+    failure_log = FailureLog(os.path.splitext(res_fp)[0] + ".failures.jsonl", append=args.resume)
+    usage_ledger = UsageLedger(os.path.splitext(res_fp)[0] + ".usage.jsonl", append=args.resume)
+    telemetry = Telemetry(os.path.splitext(res_fp)[0] + ".events.jsonl", append=args.resume)
+    setup = get_setup(args.setup_name, transcripts, mapper, playbook, all_image_fps, num_objects_per_image, args,
+                      telemetry=telemetry)
+    chat_kwargs = dict(system_prompt=setup.system_prompt, 
+                       max_img_dim=args.max_img_dim, 
+                       temperature=args.temperature,
+                       cache=cache,
+                       retry_policy=RetryPolicy(max_tries=args.max_tries),
+                       failure_log=failure_log,
+                       usage_ledger=usage_ledger,
+                       prompt_caching=args.prompt_caching,
+                       max_images=args.max_images_in_history,
+                       max_turns=args.max_turns_in_history,
+                       summarize_dropped_turns=args.summarize_dropped_turns,
+                       stream=args.stream or args.early_stop,
+                       num_objects=num_objects_per_image if setup.single_answer else None,
+                       early_stop=args.early_stop and setup.single_answer,
+                       telemetry=telemetry,
+                       image_profiles=image_profiles)
+    completion_fns = dict()
+    if args.mock_backend is not None:
+        templates = load_dict_from_json(args.mock_templates_fp) if args.mock_templates_fp else None
+        mocks = {model: MockBackend(num_objects_per_image, templates=templates, model=model,
+                                    **parse_mock_spec(args.mock_backend)) for model in models}
+        completion_fns = {model: mock.acompletion if args.use_async and not args.batch else mock.completion
+                          for model, mock in mocks.items()}
+    else:
+        for model in filter(is_local_model, models):
+            backend = LocalBackend(model, max_batch_size=args.local_batch_size, max_wait=args.local_batch_wait,
+                                   max_new_tokens=args.local_max_new_tokens, num_threads=args.local_num_threads)
+            completion_fns[model] = backend.acompletion if args.use_async and not args.batch else backend.completion
+    assert not (args.fan_out and args.batch), "--fan_out does not apply to --batch, which sends all models' requests at once."
+    batch_backend = args.batch_backend if args.batch else None
+    rate_limits = (args.requests_per_minute, args.tokens_per_minute)
+    scheduler = ChainScheduler(max_concurrency=args.max_concurrency,
+                               provider_concurrency=parse_provider_concurrency(args.provider_concurrency))
+
+    setup.check_rounds(rounds)
+    chains = setup.get_chains(rounds, pairs, models)
+
+    plan = None
+    if args.plan:
+        plan = SweepPlan.compile(setup, chains, dedup=args.temperature == 0)
+        plan.save(os.path.splitext(res_fp)[0] + ".plan.jsonl")
+        for model, totals in plan.estimate(chat_kwargs, scheduler, args.plan_seconds_per_request,
+                                           args.plan_response_tokens, rate_limits).items():
+            cost = "unknown" if totals["cost"] is None else f"${totals['cost']:.2f}"
+            print(f"Plan for {model}: {totals['chains']} chains with {totals['requests']} requests, of which "
+                  f"{totals['unique chains']} chains with {totals['unique requests']} requests are unique. Estimated "
+                  f"{totals['prompt tokens']} prompt tokens, {totals['completion tokens']} completion tokens, cost {cost}, "
+                  f"{totals['provider hours']:.2f} hours for its provider. See {os.path.splitext(res_fp)[0]}.plan.jsonl")
+        if args.dry_run:
+            return
+
+    run_chains(scheduler, chains, setup.cols, res_fp, chat_kwargs, args.use_async, args.resume,
+               batch_backend, args.batch_poll_interval, rate_limits, completion_fns, args.fan_out, plan)
+    print(f"Results saved to {res_fp}")
+
+    if cache is not None:
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} entries")
+
+    for model, totals in usage_ledger.summary().items():
+        cost = "unknown" if totals["cost"] is None else f"${totals['cost']:.2f}"
+        print(f"Usage for {model}: {totals['requests']} requests, {totals['prompt_tokens']} prompt tokens "
+              f"({totals['cached_tokens']} cached), {totals['completion_tokens']} completion tokens, estimated cost {cost}")
+        if totals["latency"] is not None:
+            timings = ", ".join(f"mean {k} {totals[k]:.2f}s" for k in ["ttft", "time_to_answer", "latency"] if totals[k] is not None)
+            print(f"Streaming for {model}: {timings}, {totals['stopped_early']} responses stopped early")
+
+    for (model, error_type), (attempts, given_up) in failure_log.summary().items():
+        print(f"Failures for {model}: {attempts} failed attempts with {error_type}, {given_up} requests given up. See {failure_log.fp}")
+
+    for (model, stage), totals in telemetry.summary().items():
+        throughput = f", {totals['throughput']:.2f} requests/s" if totals.get("throughput") else ""
+        print(f"Timing for {model} {stage}: {totals['count']} events, p50 {totals['p50']:.3f}s, p95 {totals['p95']:.3f}s, "
+              f"p99 {totals['p99']:.3f}s, error rate {totals['error_rate']:.1%}{throughput}")
+    telemetry.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+import re
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from scripts.results import load_result_rows, load_arrow_results, get_int_list, SCORED_STATUSES
+
+
+STATUS_OK = 0
+STATUS_CANNOT_PARSE = 1
+STATUS_FAILED = 2
+
+META_COLS = ["File", "Run Number", "Round", "Pair", "Image FP", "Model"]
+
+# rows of multi-turn setups that are not answers to score
+UNSCORED_PREDICTIONS = ["-", "ResponseToTheCorrectAnswer"]
+
+LIST_PATTERN = re.compile(r"\[([^\[\]]*)\]")
+
+
+def parse_int_lists(value):
+    '''Lists of ints in a cell, which CSVs store as strings such as "[1, 2]" or "[[1, 2], [3, 4]]".'''
+    if not isinstance(value, str):
+        return value
+    return [[int(x) for x in match.split(",") if x.strip()] for match in LIST_PATTERN.findall(value)]
+
+
+def parse_str_list(value):
+    if not isinstance(value, str):
+        return value
+    return re.findall(r"'([^']*)'", value)
+
+
+def get_status(pred):
+    if isinstance(pred, str) and pred == "REQUEST_FAILED":
+        return STATUS_FAILED
+    elif isinstance(pred, (str, float)) or pred is None:
+        return STATUS_CANNOT_PARSE
+    elif isinstance(pred, list) and get_int_list(pred) is None:
+        # a number too large for the int32 arrays is no permutation of the answer anyway
+        return STATUS_CANNOT_PARSE
+    return STATUS_OK
+
+
+def expand_row(row, fp):
+    '''Split a result row into one (meta, pred, answer) trial per round. Rows that are not answers give nothing.'''
+    pred = row["Prediction"]
+    if isinstance(pred, str) and pred in UNSCORED_PREDICTIONS:
+        return []
+
+    if "Round" in row:
+        meta = [fp, row["Run Number"], row["Round"], row["Pair"], row["Image FP"], row["Model"]]
+        if isinstance(pred, str) and pred.startswith("["):
+            pred = parse_int_lists(pred)[0]
+        answer = row["Answer"]
+        answer = parse_int_lists(answer)[0] if isinstance(answer, str) else answer
+        return [(meta, pred, answer)]
+
+    # "all transcripts" rows hold the predictions of all rounds as {"Round i": [...]}
+    rounds = parse_int_lists(row["Rounds"])[0] if isinstance(row["Rounds"], str) else row["Rounds"]
+    image_fps = parse_str_list(row["Image FPs"])
+    answers = parse_int_lists(row["Answer"])
+    if isinstance(pred, str) and pred.startswith("{"):
+        pred = dict(zip(re.findall(r"'(Round \d+)'", pred), parse_int_lists(pred)))
+
+    out = []
+    for i, (round, answer) in enumerate(zip(rounds, answers)):
+        meta = [fp, row["Run Number"], round, row["Pair"], image_fps[i], row["Model"]]
+        out.append((meta, pred.get(f"Round {i+1}", "CANNOT_PARSE") if isinstance(pred, dict) else pred, answer))
+    return out
+
+
+def load_rows(fp):
+    if fp.endswith(".jsonl"):
+        return load_result_rows(fp)
+    return pd.read_csv(fp, keep_default_na=False).to_dict("records")
+
+
+def scatter_lists(column, lengths, width, fill):
+    '''(n, width) int32 array of an Arrow list<int> column, padded with `fill`. Null lists are all `fill`.'''
+    out = np.full((len(lengths), width), fill, dtype=np.int32)
+    values = pc.list_flatten(column).to_numpy(zero_copy_only=False)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    out[rows, np.arange(len(values)) - np.repeat(starts, lengths)] = values
+    return out
+
+
+def bootstrap_mean_ci(values, num_samples=1000, alpha=0.05, rng=None):
+    '''Percentile bootstrap CI of the mean of `values`, ignoring NaNs.
+
+    Resampling n values with replacement only changes how often each distinct value is drawn,
+    so the resamples are drawn as multinomial counts over the distinct values, which is exact
+    and independent of n.
+    '''
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan, np.nan
+
+    rng = np.random.default_rng(0) if rng is None else rng
+    uniques, counts = np.unique(values, return_counts=True)
+    draws = rng.multinomial(len(values), counts / len(values), size=num_samples)
+    means = draws @ uniques / len(values)
+    return np.quantile(means, alpha / 2), np.quantile(means, 1 - alpha / 2)
+
+
+class ScoreTable:
+    '''Scored trials of one or more result files, one row per (run, model, pair, round).
+
+    Predictions and answers are held as (n, width) int32 arrays padded with 0 and -1 respectively,
+    so positional accuracy, per-position and per-round curves are single NumPy expressions.
+    `status` marks unparsable predictions (scored 0) and failed requests (left out, as NaN).
+    '''
+
+    def __init__(self, meta, preds, answers, lengths, status):
+        self.meta = meta
+        self.preds = preds
+        self.answers = answers
+        self.lengths = lengths
+        self.status = status
+
+    def __len__(self):
+        return len(self.meta)
+
+    @classmethod
+    def from_rows(cls, rows, fp=None):
+        trials = [trial for row in rows for trial in expand_row(row, fp)]
+        width = max([len(answer) for _, _, answer in trials] +
+                    [len(pred) for _, pred, _ in trials if get_status(pred) == STATUS_OK] + [1])
+
+        preds = np.zeros((len(trials), width), dtype=np.int32)
+        answers = np.full((len(trials), width), -1, dtype=np.int32)
+        lengths = np.zeros(len(trials), dtype=np.int32)
+        status = np.zeros(len(trials), dtype=np.int8)
+
+        for i, (_, pred, answer) in enumerate(trials):
+            answers[i, :len(answer)] = answer
+            lengths[i] = len(answer)
+            status[i] = get_status(pred)
+            if status[i] == STATUS_OK:
+                preds[i, :len(pred)] = pred
+
+        meta = pd.DataFrame([meta for meta, _, _ in trials], columns=META_COLS)
+        return cls(meta, preds, answers, lengths, status)
+
+    @classmethod
+    def from_arrow(cls, table, fp=None):
+        '''Build from an Arrow result table without parsing: the list columns are scattered into the padded arrays.'''
+        status = table["status"].combine_chunks()
+        names = status.dictionary.to_pylist()
+        codes = status.indices.to_numpy(zero_copy_only=False)
+        table = table.filter(pa.array(np.isin(codes, [names.index(s) for s in SCORED_STATUSES])))
+        status = np.array([STATUS_FAILED if s == "failed" else STATUS_OK if s == "ok" else STATUS_CANNOT_PARSE
+                           for s in names], dtype=np.int8)[
+            table["status"].combine_chunks().indices.to_numpy(zero_copy_only=False)]
+
+        answer_lengths = pc.list_value_length(table["answer"]).to_numpy(zero_copy_only=False)
+        pred_lengths = pc.fill_null(pc.list_value_length(table["prediction"]), 0).to_numpy(zero_copy_only=False)
+        width = int(max(answer_lengths.max(initial=1), pred_lengths.max(initial=1)))
+
+        answers = scatter_lists(table["answer"], answer_lengths, width, -1)
+        preds = scatter_lists(table["prediction"], pred_lengths, width, 0)
+
+        meta = pd.DataFrame({"File": fp,
+                             "Run Number": table["run_number"].to_numpy(),
+                             "Round": table["round"].to_numpy(),
+                             "Pair": table["pair"].to_pandas().astype(str),
+                             "Image FP": table["image_fp"].to_pandas().astype(str),
+                             "Model": table["model"].to_pandas().astype(str)})
+        return cls(meta, preds, answers, answer_lengths.astype(np.int32), status)
+
+    @classmethod
+    def load(cls, fps):
+        '''Load result files (Arrow, CSV or the streamed JSONL) into one table.'''
+        tables = [cls.from_arrow(load_arrow_results(fp), fp) if fp.endswith(".arrow") else
+                  cls.from_rows(load_rows(fp), fp) for fp in fps]
+        return cls.concat(tables)
+
+    @classmethod
+    def concat(cls, tables):
+        width = max(t.preds.shape[1] for t in tables)
+        pad = lambda a, value: np.pad(a, ((0, 0), (0, width - a.shape[1])), constant_values=value)
+        return cls(pd.concat([t.meta for t in tables], ignore_index=True),
+                   np.concatenate([pad(t.preds, 0) for t in tables]),
+                   np.concatenate([pad(t.answers, -1) for t in tables]),
+                   np.concatenate([t.lengths for t in tables]),
+                   np.concatenate([t.status for t in tables]))
+
+    def correct(self):
+        '''(n, width) float matrix: 1 where the prediction is right, 0 where wrong, NaN past the answer or for failed requests.'''
+        out = (self.preds == self.answers).astype(np.float64)
+        out[np.arange(self.answers.shape[1])[None, :] >= self.lengths[:, None]] = np.nan
+        out[self.status == STATUS_FAILED] = np.nan
+        return out
+
+    def accuracy(self):
+        '''Positional accuracy of every trial, the same as `compute_accu`.'''
+        correct = (self.preds == self.answers).sum(axis=1) / self.lengths
+        return np.where(self.status == STATUS_FAILED, np.nan, correct)
+
+    def get_groups(self, by):
+        groups = self.meta.groupby(by, sort=True)
+        return groups.ngroup().to_numpy(), groups.size().index.to_frame(index=False)
+
+    def summarize(self, by=("Model", "Round"), num_samples=1000, alpha=0.05, seed=0):
+        '''Mean accuracy by group with percentile bootstrap confidence intervals, e.g. per-round curves by model.'''
+        by = list(by)
+        codes, out = self.get_groups(by)
+        accu = self.accuracy()
+        valid = ~np.isnan(accu)
+        num_groups = len(out)
+
+        out["Trials"] = np.bincount(codes, minlength=num_groups)
+        out["Failed"] = np.bincount(codes, weights=~valid, minlength=num_groups).astype(int)
+        counts = np.bincount(codes[valid], minlength=num_groups)
+        sums = np.bincount(codes[valid], weights=accu[valid], minlength=num_groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out["Accu"] = sums / counts
+
+        rng = np.random.default_rng(seed)
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(num_groups + 1))
+        cis = [bootstrap_mean_ci(accu[order[bounds[g]:bounds[g + 1]]], num_samples, alpha, rng)
+               for g in range(num_groups)]
+        out["CI Low"] = [low for low, _ in cis]
+        out["CI High"] = [high for _, high in cis]
+        return out
+
+    def per_position(self, by=("Model",)):
+        '''Accuracy at each position of the sequence by group. Columns are the positions, starting at 1.'''
+        by = list(by)
+        codes, out = self.get_groups(by)
+        correct = self.correct()
+        valid = ~np.isnan(correct)
+
+        num_groups = len(out)
+        positions = []
+        for j in range(correct.shape[1]):
+            counts = np.bincount(codes[valid[:, j]], minlength=num_groups)
+            sums = np.bincount(codes[valid[:, j]], weights=correct[valid[:, j], j], minlength=num_groups)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                positions.append(sums / counts)
+
+        return pd.concat([out, pd.DataFrame(np.stack(positions, axis=1),
+                                            columns=range(1, correct.shape[1] + 1))], axis=1)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Summarize result files of experiments.py.")
+    parser.add_argument("fps", nargs="+", help="Result files (CSV or JSONL).")
+    parser.add_argument("--by", type=str, default="Model,Round", help="Columns to group by. Default is Model,Round.")
+    parser.add_argument("--num_samples", type=int, default=1000, help="Bootstrap resamples. Default is 1000.")
+    parser.add_argument("--per_position", action="store_true", help="Also print the accuracy at each position.")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    table = ScoreTable.load(args.fps)
+    by = args.by.split(",")
+
+    print(f"{len(table)} trials from {len(args.fps)} file(s)")
+    print(table.summarize(by, num_samples=args.num_samples).to_string(index=False))
+    if args.per_position:
+        print(table.per_position(by).to_string(index=False, float_format="%.2f"))
+
+
+if __name__ == "__main__":
+    main()
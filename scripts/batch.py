@@ -0,0 +1,224 @@
+import os
+import json
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import litellm
+from litellm import completion
+
+from scripts.scheduler import get_provider
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# limits of the OpenAI batch API for a single input file
+MAX_REQUESTS_PER_BATCH = 50000
+MAX_BATCH_FILE_MB = 190
+
+FINAL_BATCH_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+def parse_batch_output(lines):
+    '''Map custom_id to the response content for every line of a batch output file. Failed requests map to None.'''
+    out = dict()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or dict()
+
+        if item.get("error") is None and response.get("status_code") == 200:
+            out[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            print(f"Batch request {item['custom_id']} failed: {item.get('error') or response}")
+            out[item["custom_id"]] = None
+
+    return out
+
+
+class BatchBackend:
+    '''Interface of a batch backend.
+
+    A backend takes a JSONL file of chat completion requests in the OpenAI batch format,
+    submits it, reports its status and returns the responses by custom_id.
+    '''
+
+    def get_request_model(self, model):
+        return model
+
+    def write_requests(self, fp, requests):
+        '''Write (custom_id, model, messages, temperature) requests to a batch input file.'''
+        with open(fp, "w") as f:
+            for custom_id, model, messages, temperature in requests:
+                f.write(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": {"model": self.get_request_model(model),
+                             "messages": messages,
+                             "temperature": temperature},
+                }, ensure_ascii=False) + "\n")
+
+    def submit(self, fp):
+        '''Submit the batch input file and return a batch id.'''
+        raise NotImplementedError
+
+    def get_status(self, batch_id):
+        raise NotImplementedError
+
+    def get_results(self, batch_id):
+        '''Return a dict mapping custom_id to the response content, or None for failed requests.'''
+        raise NotImplementedError
+
+
+class LiteLLMBatchBackend(BatchBackend):
+    '''Submits batches to the provider's batch API through litellm (openai or azure).'''
+
+    def __init__(self, custom_llm_provider="openai"):
+        self.custom_llm_provider = custom_llm_provider
+
+    def get_request_model(self, model):
+        # the batch API expects the provider's own model name
+        return model.split("/", 1)[1] if "/" in model else model
+
+    def submit(self, fp):
+        with open(fp, "rb") as f:
+            batch_file = litellm.create_file(file=f, purpose="batch",
+                                             custom_llm_provider=self.custom_llm_provider)
+        batch = litellm.create_batch(completion_window="24h",
+                                     endpoint=BATCH_ENDPOINT,
+                                     input_file_id=batch_file.id,
+                                     custom_llm_provider=self.custom_llm_provider)
+        return batch.id
+
+    def get_status(self, batch_id):
+        return litellm.retrieve_batch(batch_id=batch_id,
+                                      custom_llm_provider=self.custom_llm_provider).status
+
+    def get_results(self, batch_id):
+        batch = litellm.retrieve_batch(batch_id=batch_id,
+                                       custom_llm_provider=self.custom_llm_provider)
+        out = dict()
+
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is not None:
+                content = litellm.file_content(file_id=file_id,
+                                               custom_llm_provider=self.custom_llm_provider)
+                out.update(parse_batch_output(content.content.decode("utf-8").splitlines()))
+
+        return out
+
+
+class LocalBatchBackend(BatchBackend):
+    '''Stand-in backend that runs the requests of a batch file locally and writes an output file in the batch format.
+
+    `completion_fn(model, messages, temperature)` defaults to litellm's completion. Useful for testing
+    batch mode end to end without a batch API.
+    '''
+
+    def __init__(self, completion_fn=None, max_workers=4):
+        self.completion_fn = completion_fn or (
+            lambda model, messages, temperature: completion(model=model, messages=messages, temperature=temperature))
+        self.max_workers = max_workers
+
+    def __run_request(self, line):
+        request = json.loads(line)
+        body = request["body"]
+        try:
+            response = self.completion_fn(body["model"], body["messages"], body["temperature"])
+            content = response.choices[0].message.content
+            return {"custom_id": request["custom_id"], "error": None,
+                    "response": {"status_code": 200,
+                                 "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}}}
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": None,
+                    "error": {"message": str(e)}}
+
+    def submit(self, fp):
+        with open(fp, "r") as f:
+            lines = [line for line in f if line.strip()]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            outputs = list(executor.map(self.__run_request, lines))
+
+        output_fp = os.path.splitext(fp)[0] + ".output.jsonl"
+        with open(output_fp, "w") as f:
+            for output in outputs:
+                f.write(json.dumps(output, ensure_ascii=False) + "\n")
+
+        return output_fp
+
+    def get_status(self, batch_id):
+        return "completed"
+
+    def get_results(self, batch_id):
+        with open(batch_id, "r") as f:
+            return parse_batch_output(f)
+
+
+def get_batch_backend(name, provider, completion_fn=None):
+    '''The batch backend `name` for a provider. A model with its own `completion_fn(messages, temperature)`,
+    like the mock backend or a local model, is not known to any batch API, so its batches are run locally.'''
+    if completion_fn is not None:
+        return LocalBatchBackend(lambda model, messages, temperature: completion_fn(messages, temperature))
+    elif name == "litellm":
+        return LiteLLMBatchBackend(custom_llm_provider=provider)
+    elif name == "local":
+        return LocalBatchBackend()
+    else:
+        raise ValueError(f"Unknown batch backend {name}.")
+
+
+def split_requests(requests, max_requests=MAX_REQUESTS_PER_BATCH, max_mb=MAX_BATCH_FILE_MB):
+    '''Split requests into chunks that stay within the request count and file size limits of one batch.'''
+    chunks, chunk, chunk_size = [], [], 0
+
+    for request in requests:
+        size = len(json.dumps(request[2])) / 1024 / 1024
+        if chunk and (len(chunk) >= max_requests or chunk_size + size > max_mb):
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append(request)
+        chunk_size += size
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def run_batch(requests, backend_name, fp_prefix, poll_interval=60, completion_fns=None):
+    '''Submit (custom_id, model, messages, temperature) requests as batch jobs and wait for all of them.
+
+    Requests are grouped into one batch per model, split further if a batch would be too large.
+    `completion_fns` by model are passed on to get_batch_backend. Returns a dict mapping custom_id
+    to the response content, or None for failed requests.
+    '''
+    completion_fns = completion_fns or dict()
+    by_model = dict()
+    for request in requests:
+        by_model.setdefault(request[1], []).append(request)
+
+    submitted = []
+    for model, model_requests in by_model.items():
+        backend = get_batch_backend(backend_name, get_provider(model), completion_fns.get(model))
+
+        for i, chunk in enumerate(split_requests(model_requests)):
+            fp = f"{fp_prefix}.{model.replace('/', '_')}.{i}.jsonl"
+            backend.write_requests(fp, chunk)
+            batch_id = backend.submit(fp)
+            print(f"Submitted batch {batch_id} with {len(chunk)} requests for {model}.")
+            submitted.append((backend, batch_id))
+
+    out = dict()
+    for backend, batch_id in submitted:
+        status = backend.get_status(batch_id)
+        while status not in FINAL_BATCH_STATUSES:
+            sleep(poll_interval)
+            status = backend.get_status(batch_id)
+
+        if status != "completed":
+            print(f"Batch {batch_id} ended with status {status}.")
+        out.update(backend.get_results(batch_id))
+
+    return out
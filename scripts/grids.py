@@ -0,0 +1,321 @@
+import os
+import json
+import math
+import random
+import hashlib
+import argparse
+from io import BytesIO
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from tqdm import tqdm
+
+from scripts.utils import load_dict_from_json, save_dict_to_json
+
+
+# bump when the rendering changes, so that existing grids are re-rendered
+RENDER_VERSION = 1
+
+# records the inputs every grid of a directory was rendered from, see `get_grid_hash`
+HASHES_FN = "hashes.json"
+
+WHITE = (255, 255, 255)
+
+
+def get_seed_image_fps(seed_images_dir, first_n=None):
+    '''Pictures of the objects, named by their ids (1.png, 2.png, ...), in id order.'''
+    fns = sorted(os.listdir(seed_images_dir), key=lambda x: int(x.split(".")[0]))
+    return [os.path.join(seed_images_dir, f) for f in fns][:first_n]
+
+
+def hash_file(fp):
+    with open(fp, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_color(color):
+    return np.array(Image.new("RGB", (1, 1), color)).reshape(3)
+
+
+def load_tile(fp, img_size=(400, 400), pad_color=WHITE):
+    '''The picture shrunk to fit `img_size` and centered on a padded canvas, as a (height, width, 3) array.'''
+    with Image.open(fp) as img:
+        img = img.convert("RGB")
+        img.thumbnail(img_size, Image.LANCZOS)
+        tile = Image.new("RGB", img_size, pad_color)
+        tile.paste(img, ((img_size[0] - img.width) // 2, (img_size[1] - img.height) // 2))
+    return np.asarray(tile)
+
+
+def render_label(text, font_size=14):
+    '''Yellow position number on a half-transparent black box, as an RGBA array.'''
+    # font sizes are points at the 100 dpi that img_size was defined against in the notebooks
+    font = ImageFont.load_default(size=round(font_size * 100 / 72))
+    left, top, right, bottom = font.getbbox(text)
+    pad = max(2, font.size // 5)
+
+    label = Image.new("RGBA", (right - left + 2 * pad, bottom - top + 2 * pad), (0, 0, 0, 128))
+    ImageDraw.Draw(label).text((pad - left, pad - top), text, font=font, fill=(255, 255, 0, 255))
+    return np.asarray(label)
+
+
+class GridRenderer:
+    '''Composes grid images from the object pictures with NumPy.
+
+    The pictures are decoded and resized once. A grid is then a white canvas with the pictures
+    copied into their cells in the given order, the position numbers blended into the top left
+    corner of every cell, and lines between the cells.
+    '''
+
+    def __init__(self, seed_image_fps, grid_size=(3, 5), img_size=(400, 400),
+                 font_size=14, line_color="black", line_width=2):
+        assert len(seed_image_fps) <= grid_size[0] * grid_size[1], "Not enough space in grid for all images"
+        self.grid_size = tuple(grid_size)
+        self.img_size = tuple(img_size)
+        self.line_width = line_width
+        self.line_color = get_color(line_color)
+        self.tiles = np.stack([load_tile(fp, self.img_size) for fp in seed_image_fps])
+        self.labels = [render_label(str(i + 1), font_size) for i in range(len(seed_image_fps))]
+
+    def get_cell_origin(self, position):
+        row, col = divmod(position, self.grid_size[1])
+        step_y, step_x = self.img_size[1] + self.line_width, self.img_size[0] + self.line_width
+        return row * step_y, col * step_x
+
+    def render(self, order):
+        '''The grid with the object `order[p]` (1-indexed) at position p, as a (height, width, 3) array.'''
+        rows, cols = self.grid_size
+        width, height = self.img_size
+        canvas = np.empty((rows * height + (rows - 1) * self.line_width,
+                           cols * width + (cols - 1) * self.line_width, 3), dtype=np.uint8)
+        canvas[:] = self.line_color
+
+        for position in range(rows * cols):
+            y, x = self.get_cell_origin(position)
+            cell = canvas[y:y + height, x:x + width]
+            if position >= len(order):
+                cell[:] = WHITE
+                continue
+
+            cell[:] = self.tiles[order[position] - 1]
+            label = self.labels[position]
+            offset_y, offset_x = round(0.05 * height), round(0.05 * width)
+            region = cell[offset_y:offset_y + label.shape[0], offset_x:offset_x + label.shape[1]]
+            alpha = label[:region.shape[0], :region.shape[1], 3:] / 255
+            region[:] = (label[:region.shape[0], :region.shape[1], :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+
+        return canvas
+
+
+def encode_png(array, max_dim=None):
+    '''PNG bytes of an image array, shrunk so that the longest side is at most `max_dim`.'''
+    img = Image.fromarray(array)
+    if max_dim is not None:
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# image paths that are rendered in memory instead of read from disk, see VirtualGridSource
+virtual_images = dict()
+virtual_images_lock = Lock()
+
+
+def is_virtual_image(image_fp):
+    return image_fp in virtual_images
+
+
+def render_virtual_array(image_fp):
+    renderer, order = virtual_images[image_fp]
+    return renderer.render(order)
+
+
+def render_virtual_image(image_fp, max_dim=None):
+    '''PNG bytes of a virtual grid image.'''
+    return encode_png(render_virtual_array(image_fp), max_dim)
+
+
+class VirtualGridSource:
+    '''Grid images rendered in memory from the object pictures, without PNGs on disk.
+
+    Every order added gets an image path that LVLMChat accepts like any other (see
+    lvlm_chat.get_image_data_url): the grid is rendered from the cached tiles and encoded
+    when a request needs it, and is byte for byte the PNG `python -m scripts.grids` writes.
+    '''
+
+    def __init__(self, image_dire, renderer):
+        self.image_dire = image_dire
+        self.renderer = renderer
+        self.mapper = dict()
+
+    @classmethod
+    def from_mapper(cls, seed_images_dir, image_dire):
+        '''The grids of an image directory, rendered with the options saved in its mapper.json.'''
+        mapper = load_dict_from_json(os.path.join(image_dire, "mapper.json"))
+        metadata = mapper["metadata"]
+        seed_image_fps = get_seed_image_fps(seed_images_dir, metadata["number_of_objects_per_image"])
+        renderer = GridRenderer(seed_image_fps, metadata["grid_size"], metadata["img_size"],
+                                metadata.get("font_size", 14), metadata.get("line_color", "black"))
+
+        source = cls(image_dire, renderer)
+        for image_fp, order in mapper["data"].items():
+            source.add(image_fp, order)
+        return source
+
+    @property
+    def num_objects(self):
+        return len(self.renderer.tiles)
+
+    def add(self, image_fp, order):
+        assert sorted(order) == list(range(1, self.num_objects + 1)), f"{order} is not an order of the objects."
+        with virtual_images_lock:
+            virtual_images[image_fp] = (self.renderer, list(order))
+        self.mapper[image_fp] = list(order)
+        return image_fp
+
+    def get_image_fp(self, order):
+        '''Path of the grid with any order of the objects, rendered when first used.'''
+        return self.add(os.path.join(self.image_dire, f"order_{'-'.join(map(str, order))}.png"), order)
+
+    def add_random_orders(self, number_of_grids, seed=0):
+        '''Paths of new grids with distinct random orders, seeded by `seed`.'''
+        orders = get_random_orders(self.num_objects, number_of_grids, seed)[1:]
+        return [self.get_image_fp(order) for order in orders]
+
+
+def get_random_orders(num_objects, number_of_random_grids, seed=0):
+    '''The id order followed by distinct random orders of the object ids 1..num_objects.'''
+    assert number_of_random_grids < math.factorial(num_objects), "Not that many distinct orders."
+    rng = random.Random(seed)
+    id_order = list(range(1, num_objects + 1))
+    orders, seen = [id_order], {tuple(id_order)}
+
+    while len(orders) <= number_of_random_grids:
+        order = rng.sample(id_order, num_objects)
+        if tuple(order) not in seen:
+            seen.add(tuple(order))
+            orders.append(order)
+
+    return orders
+
+
+def get_grid_fns(number_of_random_grids):
+    return ["id_order.png"] + [f"random_order_{i}.png" for i in range(1, number_of_random_grids + 1)]
+
+
+def get_grid_hash(seed_hashes, order, params):
+    '''Hash of everything a grid is rendered from, so an unchanged grid is not rendered again.'''
+    payload = json.dumps({"version": RENDER_VERSION, "seeds": seed_hashes, "order": order, "params": params},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def create_playbook(image_fps, number_of_runs, number_of_rounds=4, seed=0):
+    '''Images for every (run, round): `number_of_rounds` distinct images per run, as in create_image_playbooks.ipynb.'''
+    rng = random.Random(seed)
+    image_fps = list(image_fps)
+    rng.shuffle(image_fps)
+
+    playbook = dict()
+    for run_num in range(number_of_runs):
+        images = rng.sample(image_fps, number_of_rounds)
+        playbook[str(run_num)] = {str(round): images[round - 1] for round in range(1, number_of_rounds + 1)}
+    return playbook
+
+
+renderer = None
+
+
+def init_worker(*args):
+    global renderer
+    renderer = GridRenderer(*args)
+
+
+def render_grid(save_fp, order):
+    with open(save_fp, "wb") as f:
+        f.write(encode_png(renderer.render(order)))
+    return save_fp
+
+
+def create_grids(seed_images_dir, save_dir, first_n=13, grid_size=(3, 5), img_size=(400, 400),
+                 font_size=14, line_color="black", number_of_random_grids=10,
+                 number_of_runs=100, number_of_rounds=4, seed=0, max_workers=None):
+    '''Render the grid images of `save_dir` in parallel processes and write its mapper.json and
+    playbook.json. Same layout as create_objects_map in create_data.ipynb, with seeded orders.
+
+    Grids whose file exists and whose inputs (pictures, order and rendering parameters) have the
+    same hash as when they were rendered are skipped.
+    '''
+    os.makedirs(save_dir, exist_ok=True)
+    seed_image_fps = get_seed_image_fps(seed_images_dir, first_n)
+    seed_hashes = [hash_file(fp) for fp in seed_image_fps]
+    params = {"grid_size": list(grid_size), "img_size": list(img_size), "font_size": font_size, "line_color": line_color}
+
+    hashes_fp = os.path.join(save_dir, HASHES_FN)
+    old_hashes = dict()
+    if os.path.exists(hashes_fp):
+        with open(hashes_fp, "r") as f:
+            old_hashes = json.load(f)
+
+    orders = get_random_orders(len(seed_image_fps), number_of_random_grids, seed)
+    mapper = {"data": dict(), "metadata": dict(params)}
+    hashes, todo = dict(), []
+
+    for fn, order in zip(get_grid_fns(number_of_random_grids), orders):
+        save_fp = os.path.join(save_dir, fn)
+        mapper["data"][save_fp] = order
+        hashes[fn] = get_grid_hash(seed_hashes, order, params)
+        if old_hashes.get(fn) != hashes[fn] or not os.path.exists(save_fp):
+            todo.append((save_fp, order))
+
+    if todo:
+        init_args = (seed_image_fps, grid_size, img_size, font_size, line_color)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=init_args) as executor:
+            save_fps, orders = zip(*todo)
+            list(tqdm(executor.map(render_grid, save_fps, orders, chunksize=8), total=len(todo), desc="grids"))
+
+    mapper["metadata"]["number_of_objects_per_image"] = len(seed_image_fps)
+    mapper["metadata"]["number_of_images"] = len(mapper["data"])
+    save_dict_to_json(mapper, os.path.join(save_dir, "mapper.json"))
+    save_dict_to_json(hashes, hashes_fp)
+
+    playbook = create_playbook(list(mapper["data"]), number_of_runs, number_of_rounds, seed)
+    save_dict_to_json(playbook, os.path.join(save_dir, "playbook.json"))
+
+    print(f"Rendered {len(todo)} and skipped {len(mapper['data']) - len(todo)} unchanged of {len(mapper['data'])} images in {save_dir}")
+    return mapper, playbook
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Render the grid images of an image directory with its mapper.json and playbook.json.")
+    parser.add_argument("seed_images_dir", type=str, help="Directory of the object pictures, e.g. data/scan-baskets-segmented")
+    parser.add_argument("save_dir", type=str, help="Directory of the grids, e.g. data/baskets-grid")
+    parser.add_argument("--first_n", type=int, default=13, help="Number of objects per grid. Default is 13.")
+    parser.add_argument("--grid_size", type=str, default="3,5", help="Rows,columns of the grid. Default is 3,5.")
+    parser.add_argument("--img_size", type=str, default="400,400", help="Width,height of a cell in pixels. Default is 400,400.")
+    parser.add_argument("--font_size", type=int, default=16, help="Font size of the position numbers. Default is 16.")
+    parser.add_argument("--line_color", type=str, default="black", help="Color of the grid lines. Default is black.")
+    parser.add_argument("--number_of_random_grids", type=int, default=30, help="Number of randomly ordered grids besides the id order. Default is 30.")
+    parser.add_argument("--number_of_runs", type=int, default=100, help="Number of runs in the playbook. Default is 100.")
+    parser.add_argument("--number_of_rounds", type=int, default=4, help="Number of rounds per run in the playbook. Default is 4.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random orders and the playbook. Default is 0.")
+    parser.add_argument("--max_workers", type=int, default=None, help="Number of processes. Default is the number of cores.")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    create_grids(args.seed_images_dir, args.save_dir, args.first_n,
+                 grid_size=[int(x) for x in args.grid_size.split(",")],
+                 img_size=[int(x) for x in args.img_size.split(",")],
+                 font_size=args.font_size, line_color=args.line_color,
+                 number_of_random_grids=args.number_of_random_grids,
+                 number_of_runs=args.number_of_runs, number_of_rounds=args.number_of_rounds,
+                 seed=args.seed, max_workers=args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
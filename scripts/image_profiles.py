@@ -0,0 +1,101 @@
+import math
+from io import BytesIO
+from collections import namedtuple
+
+from PIL import Image
+
+from scripts.utils import load_dict_from_json
+
+
+IMAGE_FORMATS = ["png", "jpeg", "webp"]
+
+# how an image is encoded for a model: format, quality (jpeg and webp), longest side in pixels, and
+# the side of the model's image tiles, so that the image is sized to a whole number of tiles
+ImageProfile = namedtuple("ImageProfile", ["format", "quality", "max_dim", "tile"], defaults=["png", None, None, None])
+
+
+def parse_image_profile(spec):
+    '''Parse a spec like "format=jpeg,quality=85,max_dim=1024,tile=512" into an ImageProfile.'''
+    out = dict()
+    for item in spec.split(","):
+        key, value = item.split("=")
+        key, value = key.strip(), value.strip()
+        out[key] = value.lower() if key == "format" else int(value)
+
+    profile = ImageProfile(**out)
+    assert profile.format in IMAGE_FORMATS, f"Image format must be one of {IMAGE_FORMATS}, got {profile.format}."
+    return profile
+
+
+def load_image_profiles(image_profile=None, image_profiles_fp=None):
+    '''Image profiles by model from a JSON file of {model: spec}, with `image_profile` (a spec) for all
+    other models under the key "*". Returns None if neither is given.'''
+    profiles = dict()
+    if image_profile is not None:
+        profiles["*"] = parse_image_profile(image_profile)
+    if image_profiles_fp is not None:
+        profiles.update({model: parse_image_profile(spec) for model, spec in load_dict_from_json(image_profiles_fp).items()})
+    return profiles or None
+
+
+def get_image_profile(image_profiles, model):
+    if not image_profiles:
+        return None
+    return image_profiles.get(model, image_profiles.get("*"))
+
+
+def get_target_size(size, profile):
+    '''Size of an image after shrinking it to `max_dim` and then to whole tiles, keeping its aspect ratio.
+
+    With tiles, the image is shrunk just enough that it does not spill over into a partial row or
+    column of tiles (at least one tile each way), e.g. a 2000x1200 grid becomes 1536x922 with 512
+    pixel tiles, 3x2 tiles instead of 4x3.
+    '''
+    width, height = size
+    scale = 1.0
+    if profile.max_dim is not None:
+        scale = min(scale, profile.max_dim / max(width, height))
+    if profile.tile is not None:
+        width_tiles = max(1, math.floor(width * scale / profile.tile))
+        height_tiles = max(1, math.floor(height * scale / profile.tile))
+        scale = min(scale, width_tiles * profile.tile / width, height_tiles * profile.tile / height)
+
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_with_profile(img, profile):
+    '''Bytes and MIME type of a PIL image encoded as the profile says.'''
+    target_size = get_target_size(img.size, profile)
+    if target_size != img.size:
+        img = img.resize(target_size, Image.LANCZOS)
+
+    kwargs = dict()
+    if profile.format == "jpeg":
+        # jpeg has no alpha channel, so transparent pixels become white like the grid background
+        if img.mode in ["RGBA", "LA", "P"]:
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+    if profile.quality is not None:
+        kwargs["quality"] = profile.quality
+
+    buffer = BytesIO()
+    img.save(buffer, format=profile.format.upper(), **kwargs)
+    return buffer.getvalue(), f"image/{profile.format}"
+
+
+def estimate_image_tokens(size, detail="high"):
+    '''Image tokens OpenAI bills for an image of this size: the image is scaled to fit in
+    2048x2048 and then to a shortest side of 768, and costs 85 tokens plus 170 per 512 pixel tile.'''
+    if detail == "low":
+        return 85
+
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
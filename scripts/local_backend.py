@@ -0,0 +1,159 @@
+import queue
+import base64
+import asyncio
+import threading
+from io import BytesIO
+from time import perf_counter
+from functools import lru_cache
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from PIL import Image
+
+from scripts.response_cache import make_completion_response
+
+
+def get_local_model_name(model):
+    '''The Hugging Face model id of a "local/<model id>" model, e.g. "local/HuggingFaceTB/SmolVLM-256M-Instruct".'''
+    return model[len("local/"):] if model.startswith("local/") else model
+
+
+def is_local_model(model):
+    return model.startswith("local/")
+
+
+@lru_cache(maxsize=64)
+def decode_data_url(url):
+    return Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1]))).convert("RGB")
+
+
+def to_hf_messages(messages):
+    '''Convert chat messages with data URL images into the chat-template format of Hugging Face
+    processors, and return them with the images in the order they appear.'''
+    out, images = [], []
+
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+
+        segments = []
+        for segment in content:
+            if segment["type"] == "image_url":
+                images.append(decode_data_url(segment["image_url"]["url"]))
+                segments.append({"type": "image"})
+            else:
+                segments.append({"type": "text", "text": segment["text"]})
+        out.append({"role": message["role"], "content": segments})
+
+    return out, images
+
+
+class LocalBackend:
+    '''An open-weights vision-language model run on CPU with transformers, as a `completion_fn`.
+
+    `completion` and `acompletion` queue the request and wait for it. A worker thread takes up
+    to `max_batch_size` queued requests at a time, waiting at most `max_wait` seconds for a
+    batch to fill up, and answers them with one batched `generate` call, so concurrent chats
+    (see --max_concurrency) share forward passes.
+
+    transformers and torch are only imported when a backend is created.
+    '''
+
+    def __init__(self, model, max_batch_size=8, max_wait=0.05, max_new_tokens=512, num_threads=None):
+        try:
+            import torch
+            from transformers import AutoProcessor, AutoModelForImageTextToText
+        except ImportError as e:
+            raise ImportError("Local models need transformers and torch: pip install transformers torch") from e
+
+        self.torch = torch
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        model_name = get_local_model_name(model)
+        self.processor = AutoProcessor.from_pretrained(model_name)
+        self.processor.tokenizer.padding_side = "left"
+        self.model = AutoModelForImageTextToText.from_pretrained(model_name, torch_dtype=torch.float32).eval()
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self.num_batches = 0
+        self.num_requests = 0
+
+        self.requests = queue.Queue()
+        threading.Thread(target=self.serve, daemon=True, name="local-backend").start()
+
+    def submit(self, messages, temperature):
+        future = Future()
+        self.requests.put((messages, temperature, future))
+        return future
+
+    def completion(self, messages, temperature):
+        return self.submit(messages, temperature).result()
+
+    async def acompletion(self, messages, temperature):
+        return await asyncio.wrap_future(self.submit(messages, temperature))
+
+    def get_batch(self):
+        '''Block for the next request, then take the ones queued within `max_wait`.'''
+        batch = [self.requests.get()]
+        deadline = perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def serve(self):
+        while True:
+            by_temperature = dict()
+            for messages, temperature, future in self.get_batch():
+                by_temperature.setdefault(temperature, []).append((messages, future))
+
+            for temperature, requests in by_temperature.items():
+                try:
+                    responses = self.generate([messages for messages, _ in requests], temperature)
+                except Exception as e:
+                    for _, future in requests:
+                        future.set_exception(e)
+                    continue
+
+                self.num_batches += 1
+                self.num_requests += len(requests)
+                for (_, future), response in zip(requests, responses):
+                    future.set_result(response)
+
+    def generate(self, batch, temperature):
+        conversations, images = zip(*[to_hf_messages(messages) for messages in batch])
+        texts = [self.processor.apply_chat_template(conversation, add_generation_prompt=True)
+                 for conversation in conversations]
+        inputs = self.processor(text=texts, images=list(images) if any(images) else None,
+                                return_tensors="pt", padding=True)
+
+        kwargs = dict(max_new_tokens=self.max_new_tokens, do_sample=temperature > 0)
+        if temperature > 0:
+            kwargs["temperature"] = temperature
+
+        with self.torch.inference_mode():
+            output_ids = self.model.generate(**inputs, **kwargs)
+
+        responses = []
+        num_prompt = inputs["input_ids"].shape[1]
+        for i in range(len(batch)):
+            new_ids = output_ids[i, num_prompt:]
+            if self.processor.tokenizer.pad_token_id is not None:
+                new_ids = new_ids[new_ids != self.processor.tokenizer.pad_token_id]
+            response = make_completion_response(self.processor.tokenizer.decode(new_ids, skip_special_tokens=True).strip())
+
+            prompt_tokens, completion_tokens = int(inputs["attention_mask"][i].sum()), len(new_ids)
+            response.usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                             total_tokens=prompt_tokens + completion_tokens)
+            responses.append(response)
+        return responses
@@ -1,13 +1,34 @@
 import re, os
 import base64
+import asyncio
 from io import BytesIO
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 import filetype
-from groq import Groq
-from time import sleep
-from litellm import completion
+from groq import Groq, AsyncGroq
+from time import sleep, perf_counter
+from litellm import completion, acompletion
 from litellm import supports_vision
+from scripts.response_cache import CacheMissError
+from scripts.grids import is_virtual_image, render_virtual_image, render_virtual_array
+from scripts.image_profiles import encode_with_profile, get_image_profile
+from scripts.rate_limit import RetryPolicy, is_retryable_error, is_rate_limit_error
+from scripts.streaming import stream_completion, stream_completion_async
+
+
+# returned instead of a response when a request failed for good
+FAILED_RESPONSE = "SOMETHING WRONG"
+
+# stands in for images dropped from the history by `max_images`
+IMAGE_PLACEHOLDER = "[An image shown earlier in the conversation was omitted here.]"
+
+# starts the message that stands in for the turns dropped from the history by `max_turns`
+HISTORY_SUMMARY_HEADER = "[Earlier turns of the conversation were shortened to what was said in them:]"
+
+# anthropic-style prompt caching marker, see LVLMChat.get_request_messages
+CACHE_CONTROL = {"type": "ephemeral"}
 
 
 def encode_image(image_path):
@@ -29,16 +50,106 @@ def encode_resized_image(image_path, max_dim=1024):
         return base64.b64encode(buffer.read()).decode("utf-8")
 
 
+# the playbooks reuse ~30 grid images per image directory
+IMAGE_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def load_image_data_url(image_path, mtime, max_img_dim=None):
+    '''Read, optionally resize, and base64 encode the image into a data URL.
+
+    Cached per process. `mtime` is only part of the cache key, so that a changed file is re-encoded.
+    '''
+    if not filetype.is_image(image_path):
+        raise ValueError(f"Invalid image path: {image_path}")
+
+    if max_img_dim is None:
+        base64_image = encode_image(image_path)
+    else:
+        base64_image = encode_resized_image(image_path, max_img_dim)
+
+    extension = filetype.guess_extension(image_path).lower()
+    if extension not in ["jpg", "jpeg", "png"]:
+        raise ValueError(f"Unsupported image format: {extension}")
+
+    if extension == "jpg":
+        extension = "jpeg"
+
+    return f"data:image/{extension};base64,{base64_image}"
+
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def load_virtual_image_data_url(image_path, max_img_dim=None):
+    '''Render and base64 encode a grid image that only exists in memory, see scripts.grids.VirtualGridSource.'''
+    base64_image = base64.b64encode(render_virtual_image(image_path, max_img_dim)).decode("utf-8")
+    return f"data:image/png;base64,{base64_image}"
+
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def load_profiled_image_data_url(image_path, mtime, profile):
+    '''Encode the image (from disk or rendered in memory) as its ImageProfile says, see scripts.image_profiles.'''
+    if is_virtual_image(image_path):
+        img = Image.fromarray(render_virtual_array(image_path))
+    else:
+        img = Image.open(image_path)
+
+    with img:
+        data, mime_type = encode_with_profile(img, profile)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def get_image_data_url(image_path, max_img_dim=None, profile=None):
+    '''With an image `profile`, it replaces `max_img_dim`.'''
+    if profile is not None:
+        mtime = None if is_virtual_image(image_path) else os.path.getmtime(image_path)
+        return load_profiled_image_data_url(image_path, mtime, profile)
+    if is_virtual_image(image_path):
+        return load_virtual_image_data_url(image_path, max_img_dim)
+    return load_image_data_url(image_path, os.path.getmtime(image_path), max_img_dim)
+
+
+def prewarm_image_cache(image_fps, max_img_dim=None, max_workers=8, profiles=(None,)):
+    '''Encode the images up front (once per image profile) so that no request has to wait on disk I/O or resizing.'''
+    if len(image_fps) * len(profiles) > IMAGE_CACHE_SIZE:
+        print(f"Only the last {IMAGE_CACHE_SIZE} of {len(image_fps) * len(profiles)} encoded images will stay in the image cache.")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda job: get_image_data_url(job[0], max_img_dim, job[1]),
+                          [(fp, profile) for profile in profiles for fp in image_fps]))
+
+
+@lru_cache(maxsize=None)
+def get_groq_client():
+    return Groq(api_key=os.environ.get("GROQ_API_KEY"))
+
 
-def get_groq_complemtion(model, messages, temperature):
-    client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
-    return client.chat.completions.create(
+@lru_cache(maxsize=None)
+def get_async_groq_client():
+    return AsyncGroq(api_key=os.environ.get("GROQ_API_KEY"))
+
+
+def get_groq_complemtion(model, messages, temperature, **kwargs):
+    return get_groq_client().chat.completions.create(
         model=model,
         messages=messages,
         temperature=temperature,
+        **kwargs,
     )
 
 
+async def get_async_groq_completion(model, messages, temperature, **kwargs):
+    return await get_async_groq_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        **kwargs,
+    )
+
+
+# ask for the usage in the last chunk of a stream; dropped for providers that do not support it
+LITELLM_STREAM_KWARGS = dict(stream=True, stream_options={"include_usage": True}, drop_params=True)
+
+
 class LVLMChat:
 
     def __init__(self, 
@@ -48,25 +159,37 @@ class LVLMChat:
                 #  messages=None, 
                  max_img_dim=None, 
                  temperature=0, 
-                 max_tries=5):
+                 max_tries=5,
+                 cache=None,
+                 retry_policy=None,
+                 rate_limiter=None,
+                 failure_log=None,
+                 usage_ledger=None,
+                 prompt_caching=False,
+                 max_images=None,
+                 stream=False,
+                 num_objects=None,
+                 early_stop=False,
+                 telemetry=None,
+                 max_turns=None,
+                 summarize_dropped_turns=False,
+                 message_cache=None,
+                 image_profiles=None):
+
+        if completion_fn is None:
+            completion_fn = self.get_default_completion_fn(model, stream, num_objects, early_stop)
+
+        if rate_limiter is not None:
+            completion_fn = self.get_rate_limited_completion_fn(rate_limiter, completion_fn)
 
+        if cache is not None:
+            completion_fn = self.get_cached_completion_fn(cache, completion_fn, model)
+
+        self.full_model_name = model
         if model.startswith("groq/"):
             model = model.replace("groq/", "")
-            completion_fn = lambda messages, temperature: get_groq_complemtion(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
 
-        if completion_fn is None:
-            assert supports_vision(model), f"Model {model} does not support vision."
-            self.completion_fn = lambda messages, temperature: completion(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-        else:
-            self.completion_fn = completion_fn
+        self.completion_fn = completion_fn
 
         # if messages is not None:
         #     self.messages = messages
@@ -79,32 +202,82 @@ class LVLMChat:
         self.max_img_dim = max_img_dim
         self.temperature = temperature
         self.max_tries = max_tries
+        self.retry_policy = retry_policy or RetryPolicy(max_tries=max_tries)
+        self.rate_limiter = rate_limiter
+        self.failure_log = failure_log
+        self.usage_ledger = usage_ledger
+        self.prompt_caching = prompt_caching
+        self.max_images = max_images
+        self.telemetry = telemetry
+        self.max_turns = max_turns
+        self.summarize_dropped_turns = summarize_dropped_turns
+        self.summary = None
+        self.message_cache = message_cache
+        self.image_profile = get_image_profile(image_profiles, self.full_model_name)
 
         if system_prompt is not None:
             self.messages.append(self.__construct_message("system", system_prompt))
 
+    @staticmethod
+    def get_default_completion_fn(model, stream=False, num_objects=None, early_stop=False):
+        '''With `stream`, the completion is streamed and timed, and with `early_stop` it is cancelled
+        once a valid permutation of 1..num_objects has been given as the final answer (see StreamCollector).'''
+        if model.startswith("groq/"):
+            model = model.replace("groq/", "")
+            if stream:
+                return partial(stream_completion, lambda messages, temperature: get_groq_complemtion(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                ), num_objects=num_objects, early_stop=early_stop)
+            return lambda messages, temperature: get_groq_complemtion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            )
+
+        assert supports_vision(model), f"Model {model} does not support vision."
+        if stream:
+            return partial(stream_completion, lambda messages, temperature: completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **LITELLM_STREAM_KWARGS,
+            ), num_objects=num_objects, early_stop=early_stop)
+        return lambda messages, temperature: completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+        )
+
+    @staticmethod
+    def get_cached_completion_fn(cache, completion_fn, model):
+        return cache.wrap(completion_fn, model)
+
+    @staticmethod
+    def get_rate_limited_completion_fn(rate_limiter, completion_fn):
+        return rate_limiter.wrap(completion_fn)
+
     def __construct_message_segment(self, text=None, image_path=None):
         assert text is not None or image_path is not None, "Either text or image_path should be provided"
 
         if text is not None:
             return {"type": "text", "text": text}
 
+        # the history only refers to the image, see `materialize_segment`
         if image_path is not None:
-            if self.max_img_dim is None:
-                base64_image = encode_image(image_path)
-            else:
-                base64_image = encode_resized_image(image_path, 
-                                                    self.max_img_dim)
-
-            extension = filetype.guess_extension(image_path).lower()
-            if extension not in ["jpg", "jpeg", "png"]:
-                raise ValueError(f"Unsupported image format: {extension}")
+            return {"type": "image_ref", "image_path": image_path}
 
-            if extension == "jpg":
-                extension = "jpeg"
+    def materialize_segment(self, segment):
+        '''The segment to send for a segment of the history, with images referred to by path encoded as data URLs.'''
+        if segment["type"] != "image_ref":
+            return segment
 
-            return {"type": "image_url",
-                    "image_url": {"url": f"data:image/{extension};base64,{base64_image}"}}
+        start = perf_counter()
+        url = get_image_data_url(segment["image_path"], self.max_img_dim, self.image_profile)
+        self.record_event("encode", start)
+        return {"type": "image_url", "image_url": {"url": url}}
 
     def __construct_message(self, role, prompt):
         '''Construct a message for the chat given the role and prompt.'''
@@ -125,11 +298,7 @@ class LVLMChat:
                 continue
             elif "<" in segment and ">" in segment:
                 image_path = segment[1:-1]
-
-                if filetype.is_image(image_path):
-                    content.append(self.__construct_message_segment(image_path=image_path))
-                else:
-                    raise ValueError(f"Invalid image path: {image_path}")                                
+                content.append(self.__construct_message_segment(image_path=image_path))
             else:
                 content.append(self.__construct_message_segment(text=segment))
 
@@ -138,32 +307,279 @@ class LVLMChat:
 
         return {"role": role, "content": content}
 
-    def __get_completion(self):
+    def get_user_message(self, prompt):
+        '''The user message of a prompt, built once per prompt for all chats sharing a `message_cache`
+        (e.g. the chats of one request fanned out to several models). Messages are never changed
+        after they are built, so the chats can share them.'''
+        if self.message_cache is None:
+            return self.__construct_message("user", prompt)
+
+        message = self.message_cache.get(prompt)
+        if message is None:
+            message = self.message_cache.setdefault(prompt, self.__construct_message("user", prompt))
+        return message
+
+    def append_message(self, role, prompt):
+        if role == "user":
+            self.messages.append(self.get_user_message(prompt))
+        else:
+            self.messages.append(self.__construct_message(role, prompt))
+        if role == "assistant":
+            self.trim_history()
+
+    def trim_history(self):
+        '''Drop the oldest turns beyond `max_turns` from the history, keeping the system prompt and the
+        first turn, which sets up the task. With `summarize_dropped_turns`, the text of the dropped
+        user turns is kept in one message in their place, without the images and the responses.'''
+        if self.max_turns is None:
+            return
+
+        num_pinned = sum(1 for message in self.messages[:1] if message["role"] == "system") + 2
+        if self.summary is not None:
+            num_pinned += 1
+
+        num_dropped = len(self.messages) - num_pinned - 2 * self.max_turns
+        if num_dropped <= 0:
+            return
+
+        dropped = self.messages[num_pinned:num_pinned + num_dropped]
+        kept = self.messages[num_pinned + num_dropped:]
+        head = self.messages[:num_pinned - (self.summary is not None)]
+
+        if self.summarize_dropped_turns:
+            texts = [self.summary["content"]] if self.summary is not None else [HISTORY_SUMMARY_HEADER]
+            for message in dropped:
+                if message["role"] != "user":
+                    continue
+                content = message["content"]
+                if isinstance(content, list):
+                    content = " ".join(segment["text"] for segment in content if segment["type"] == "text")
+                texts.append(content.strip())
+            self.summary = {"role": "user", "content": "\n\n".join(texts)}
+            head.append(self.summary)
+
+        self.messages = head + kept
+
+    def get_request_messages(self):
+        '''The messages to send for the next request, laid out from the conversation history.
+
+        The history itself is never changed, so every request starts with the exact same prefix
+        (system prompt, then earlier turns) as the previous one, which is what provider-side
+        prompt caching matches on; openai and gemini cache such prefixes automatically.
+
+        With `max_images`, only the last `max_images` images are sent and older ones are
+        replaced by a short text placeholder. This cuts the prompt size of long chats, but
+        changes the prefix whenever an image is dropped.
+
+        With `prompt_caching`, anthropic-style cache_control breakpoints are added to the system
+        prompt and to the last two user turns, so that each request reads the prefix cached by
+        the previous one.
+
+        The history refers to images by path, and they are only encoded into the messages of
+        the request (from the process-wide image cache), so a chat holds no image data itself.
+        With `max_turns`, the history is also capped at the last `max_turns` turns after the
+        first one (see `trim_history`), which changes the prefix once turns start being dropped.
+        '''
+        messages = [dict(message) for message in self.messages]
+
+        if self.max_images is not None:
+            num_images = 0
+            for message in messages[::-1]:
+                if not isinstance(message["content"], list):
+                    continue
+                content = []
+                for segment in message["content"][::-1]:
+                    if segment["type"] in ["image_ref", "image_url"]:
+                        num_images += 1
+                        if num_images > self.max_images:
+                            segment = {"type": "text", "text": IMAGE_PLACEHOLDER}
+                    content.append(segment)
+                message["content"] = content[::-1]
+
+        for message in messages:
+            if isinstance(message["content"], list):
+                message["content"] = [self.materialize_segment(segment) for segment in message["content"]]
+
+        if self.prompt_caching:
+            user_ixs = [i for i, message in enumerate(messages) if message["role"] == "user"][-2:]
+            system_ixs = [i for i, message in enumerate(messages) if message["role"] == "system"]
+
+            for i in system_ixs + user_ixs:
+                content = messages[i]["content"]
+                if isinstance(content, str):
+                    content = [{"type": "text", "text": content}]
+                content = list(content)
+                content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+                messages[i]["content"] = content
+
+        return messages
+
+    def record_event(self, stage, start, ok=True, **fields):
+        '''Record the time since `start` (a perf_counter value) spent on a stage, see scripts.telemetry.'''
+        if self.telemetry is not None:
+            self.telemetry.record(self.full_model_name, stage, perf_counter() - start, ok=ok, **fields)
+
+    def record_usage(self, response, messages):
+        if self.usage_ledger is None:
+            return
+
+        num_images = sum(1 for message in messages if isinstance(message["content"], list)
+                         for segment in message["content"] if segment["type"] == "image_url")
+        self.usage_ledger.record(self.full_model_name, response,
+                                 num_messages=len(messages), num_images=num_images)
+
+    def get_retry_delay(self, attempt, error):
+        '''Record the failed attempt and return the seconds to wait before retrying, or None to give up.'''
+        delay = self.retry_policy.get_delay(attempt, error)
+
+        if self.failure_log is not None:
+            self.failure_log.record(self.model, attempt, error, 
+                                    retryable=is_retryable_error(error), gave_up=delay is None)
+
+        if delay is not None and self.rate_limiter is not None and is_rate_limit_error(error):
+            self.rate_limiter.on_rate_limited(delay)
+
+        print(f"Running into problem ({type(error).__name__}, attempt {attempt + 1}):", error)
+        print(f"Retrying in {delay:.1f}s..." if delay is not None else "Giving up.")
+        return delay
+
+    def __get_completion(self, start=None):
         assistant_response = None
 
-        for _ in range(self.max_tries):
+        start = start or perf_counter()
+        messages = self.get_request_messages()
+        self.record_event("build", start)
+
+        attempt = 0
+        for attempt in range(self.retry_policy.max_tries):
 
+            attempt_start = perf_counter()
             try:
                 assistant_response = self.completion_fn(
-                    self.messages, self.temperature)
+                    messages, self.temperature)
+                self.record_event("network", attempt_start, attempt=attempt + 1)
                 break
+            except CacheMissError:
+                raise
             except Exception as e:
-                print("Running into problem:", e)
-                print("Retrying...")
-                sleep(10)
+                self.record_event("network", attempt_start, ok=False, attempt=attempt + 1, error_type=type(e).__name__)
+                delay = self.get_retry_delay(attempt, e)
+                if delay is None:
+                    break
+                wait_start = perf_counter()
+                sleep(delay)
+                self.record_event("retry_wait", wait_start, attempt=attempt + 1)
+
+        self.record_event("request", start, ok=assistant_response is not None, attempts=attempt + 1)
 
         if assistant_response is None:
-            assistant_response = f"SOMETHING WRONG"
+            assistant_response = FAILED_RESPONSE
         else:
+            self.record_usage(assistant_response, messages)
             assistant_response = assistant_response.choices[0].message.content
-            self.messages.append(self.__construct_message("assistant", assistant_response))
+            self.append_message("assistant", assistant_response)
 
         return assistant_response
 
     def get_chat_completion(self, prompt):
-        self.messages.append(self.__construct_message("user", prompt))
-        return self.__get_completion()
+        start = perf_counter()
+        self.append_message("user", prompt)
+        return self.__get_completion(start)
 
     def get_chat_completion_from_messages(self, messages):
         self.messages = messages
-        return self.__get_completion()
\ No newline at end of file
+        return self.__get_completion()
+
+
+class AsyncLVLMChat(LVLMChat):
+    '''LVLMChat whose completions are coroutines, so that many chat sessions can share one event loop.
+
+    Uses litellm's `acompletion` and a process-wide AsyncGroq client. A custom `completion_fn`
+    must be an async function with the same (messages, temperature) signature.
+    '''
+
+    @staticmethod
+    def get_default_completion_fn(model, stream=False, num_objects=None, early_stop=False):
+        if model.startswith("groq/"):
+            model = model.replace("groq/", "")
+            if stream:
+                return partial(stream_completion_async, lambda messages, temperature: get_async_groq_completion(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                ), num_objects=num_objects, early_stop=early_stop)
+            return lambda messages, temperature: get_async_groq_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            )
+
+        assert supports_vision(model), f"Model {model} does not support vision."
+        if stream:
+            return partial(stream_completion_async, lambda messages, temperature: acompletion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **LITELLM_STREAM_KWARGS,
+            ), num_objects=num_objects, early_stop=early_stop)
+        return lambda messages, temperature: acompletion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+        )
+
+    @staticmethod
+    def get_cached_completion_fn(cache, completion_fn, model):
+        return cache.wrap_async(completion_fn, model)
+
+    @staticmethod
+    def get_rate_limited_completion_fn(rate_limiter, completion_fn):
+        return rate_limiter.wrap_async(completion_fn)
+
+    async def __get_completion(self, start=None):
+        assistant_response = None
+
+        start = start or perf_counter()
+        messages = self.get_request_messages()
+        self.record_event("build", start)
+
+        attempt = 0
+        for attempt in range(self.retry_policy.max_tries):
+
+            attempt_start = perf_counter()
+            try:
+                assistant_response = await self.completion_fn(
+                    messages, self.temperature)
+                self.record_event("network", attempt_start, attempt=attempt + 1)
+                break
+            except CacheMissError:
+                raise
+            except Exception as e:
+                self.record_event("network", attempt_start, ok=False, attempt=attempt + 1, error_type=type(e).__name__)
+                delay = self.get_retry_delay(attempt, e)
+                if delay is None:
+                    break
+                wait_start = perf_counter()
+                await asyncio.sleep(delay)
+                self.record_event("retry_wait", wait_start, attempt=attempt + 1)
+
+        self.record_event("request", start, ok=assistant_response is not None, attempts=attempt + 1)
+
+        if assistant_response is None:
+            assistant_response = FAILED_RESPONSE
+        else:
+            self.record_usage(assistant_response, messages)
+            assistant_response = assistant_response.choices[0].message.content
+            self.append_message("assistant", assistant_response)
+
+        return assistant_response
+
+    async def get_chat_completion(self, prompt):
+        start = perf_counter()
+        self.append_message("user", prompt)
+        return await self.__get_completion(start)
+
+    async def get_chat_completion_from_messages(self, messages):
+        self.messages = messages
+        return await self.__get_completion()
\ No newline at end of file
@@ -0,0 +1,132 @@
+import json
+import time
+import random
+import asyncio
+from threading import Lock
+from types import SimpleNamespace
+
+import httpx
+import litellm
+
+from scripts.rate_limit import estimate_prompt_tokens
+from scripts.response_cache import get_cache_key, make_completion_response
+
+
+DEFAULT_TEMPLATE = "I compared the pictures with the descriptions in the conversation.\n\nFinal Answer: {answer}"
+
+MOCK_REQUEST = httpx.Request("POST", "http://mock/v1/chat/completions")
+
+
+def parse_mock_spec(spec):
+    '''Parse a spec like "latency=0.5,error_rate=0.01,rate_limit_rate=0.05" into MockBackend arguments.'''
+    if not spec:
+        return dict()
+
+    out = dict()
+    for item in spec.split(","):
+        key, value = item.split("=")
+        key = key.strip()
+        out[key] = int(value) if key == "seed" else float(value)
+    return out
+
+
+def count_images(message):
+    if isinstance(message["content"], str):
+        return 0
+    return sum(1 for segment in message["content"] if segment.get("type") == "image_url")
+
+
+class MockBackend:
+    '''Local stand-in for an LVLM API, to run and benchmark experiments offline.
+
+    `completion` and `acompletion` have the (messages, temperature) signature of a `completion_fn`,
+    see LVLMChat. Every request is answered after `latency` seconds (+/- `jitter` as a fraction)
+    with a random permutation of 1..num_objects per image in the last user message, filled into
+    one of the `templates` ("{answer}"). Attempts fail with a 429 (with a Retry-After header of
+    `retry_after` seconds) at `rate_limit_rate` and with a 500 at `error_rate`.
+
+    Everything is drawn from a random generator seeded by `seed`, `model`, the request and the attempt
+    number, so the same run gets the same responses and errors however its requests are scheduled.
+    Attempts are counted until the request succeeds.
+    Use one backend per model, see `completion_fns` in experiments.run_chains.
+    '''
+
+    def __init__(self, num_objects=13, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1.0, templates=None, seed=0, model="mock"):
+        self.num_objects = num_objects
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.templates = templates or [DEFAULT_TEMPLATE]
+        self.seed = seed
+        self.model = model
+        self.attempts = dict()
+        self.num_attempts = 0
+        self.lock = Lock()
+
+    def get_rngs(self, messages, temperature):
+        '''Key of the request, and random generators of this attempt at it (latency, errors) and of the request (response).'''
+        key = get_cache_key(self.model, temperature, messages)
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+            self.num_attempts += 1
+        return key, random.Random(f"{self.seed}:{key}:{attempt}"), random.Random(f"{self.seed}:{key}")
+
+    def succeed(self, key, messages, rng):
+        # only requests still being retried keep their attempt count, so a long run does not pile them up
+        with self.lock:
+            self.attempts.pop(key, None)
+        return self.get_response(messages, rng)
+
+    def get_delay(self, rng):
+        return max(0.0, self.latency * (1 + rng.uniform(-self.jitter, self.jitter)))
+
+    def get_error(self, rng):
+        draw = rng.random()
+        if draw < self.rate_limit_rate:
+            response = httpx.Response(429, headers={"retry-after": str(self.retry_after)}, request=MOCK_REQUEST)
+            return litellm.RateLimitError("Mock rate limit reached.", llm_provider="mock",
+                                          model=self.model, response=response)
+        if draw < self.rate_limit_rate + self.error_rate:
+            response = httpx.Response(500, request=MOCK_REQUEST)
+            return litellm.InternalServerError("Mock server error.", llm_provider="mock",
+                                               model=self.model, response=response)
+        return None
+
+    def get_response(self, messages, rng):
+        user_messages = [message for message in messages if message["role"] == "user"]
+        num_images = max(1, count_images(user_messages[-1])) if user_messages else 1
+        answers = [rng.sample(range(1, self.num_objects + 1), self.num_objects) for _ in range(num_images)]
+
+        if num_images == 1:
+            answer = ", ".join(map(str, answers[0]))
+        else:
+            answer = json.dumps({f"Round {i+1}": seq for i, seq in enumerate(answers)})
+
+        content = rng.choice(self.templates).format(answer=answer, num_objects=self.num_objects)
+        response = make_completion_response(content)
+        prompt_tokens, completion_tokens = estimate_prompt_tokens(messages), len(content) // 4
+        response.usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                         total_tokens=prompt_tokens + completion_tokens)
+        return response
+
+    def completion(self, messages, temperature):
+        key, attempt_rng, request_rng = self.get_rngs(messages, temperature)
+        time.sleep(self.get_delay(attempt_rng))
+
+        error = self.get_error(attempt_rng)
+        if error is not None:
+            raise error
+        return self.succeed(key, messages, request_rng)
+
+    async def acompletion(self, messages, temperature):
+        key, attempt_rng, request_rng = self.get_rngs(messages, temperature)
+        await asyncio.sleep(self.get_delay(attempt_rng))
+
+        error = self.get_error(attempt_rng)
+        if error is not None:
+            raise error
+        return self.succeed(key, messages, request_rng)
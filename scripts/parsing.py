@@ -0,0 +1,144 @@
+import re
+from collections import namedtuple
+
+
+SEQUENCE_PATTERN = re.compile(r"\d+(?:\s*,\s*\d+)+")
+
+# text after a sequence that more streamed output could still extend it from, e.g. "1, 2, "
+CONTINUATION_PATTERN = re.compile(r"\s*(?:,\s*)?")
+
+# the end of a text that more streamed output could still turn into a sequence, e.g. "12, "
+TAIL_PATTERN = re.compile(r"\d+\s*(?:,\s*)?\Z")
+
+OK = "ok"
+NO_SEQUENCE = "no sequence"
+WRONG_LENGTH = "wrong length"
+OUT_OF_RANGE = "out of range"
+DUPLICATE_INDICES = "duplicate indices"
+MISSING_ROUNDS = "missing rounds"
+
+CODES = [OK, NO_SEQUENCE, WRONG_LENGTH, OUT_OF_RANGE, DUPLICATE_INDICES, MISSING_ROUNDS]
+
+
+# `pred` is the chosen sequence (None if there is none), `code` is OK or why it is not a valid
+# permutation, and `confidence` is the fraction of the expected indices the sequence covers
+ParseResult = namedtuple("ParseResult", ["pred", "code", "confidence"])
+
+
+def to_ints(match):
+    return [int(x) for x in match.split(",")]
+
+
+def is_permutation(seq, num_objects):
+    return len(seq) == num_objects and min(seq) >= 1 and max(seq) <= num_objects and len(set(seq)) == num_objects
+
+
+def check_sequence(seq, num_objects):
+    '''OK if `seq` is a permutation of 1..num_objects, otherwise the reason it is not, and the confidence.'''
+    valid = {x for x in seq if 1 <= x <= num_objects}
+    confidence = len(valid) / num_objects
+
+    if len(valid) == num_objects and len(seq) == num_objects:
+        return OK, 1.0
+    elif len(seq) != num_objects:
+        return WRONG_LENGTH, confidence
+    elif len(valid) < len(set(seq)):
+        return OUT_OF_RANGE, confidence
+    return DUPLICATE_INDICES, confidence
+
+
+class StreamingParser:
+    '''Incremental parser of the predicted sequence of picture indices in a response.
+
+    `feed` takes the response chunk by chunk and scans every character once, except for the end
+    of the text that could still become part of a sequence, which is read again with the next
+    chunk. A sequence that ends at the end of the text received so far may still grow, so it only
+    becomes final once text that cannot extend it arrives, or on `finish`. The last valid permutation wins, and
+    without one the last sequence is returned with the reason it is not valid.
+    '''
+
+    def __init__(self, num_objects):
+        self.num_objects = num_objects
+        self.text = ""
+        self.pos = 0
+        self.best = None
+        self.best_pos = None
+        self.last = None
+        self.pending = None
+        self.pending_pos = None
+
+    def add(self, seq, pos=None):
+        result = ParseResult(seq, *check_sequence(seq, self.num_objects))
+        if result.code == OK:
+            self.best = result
+            self.best_pos = pos
+        self.last = result
+
+    def feed(self, chunk):
+        self.text += chunk
+        self.pending = None
+
+        for match in SEQUENCE_PATTERN.finditer(self.text, self.pos):
+            if CONTINUATION_PATTERN.fullmatch(self.text, match.end()):
+                self.pending = to_ints(match.group())
+                self.pending_pos = self.pos = match.start()
+                break
+            self.add(to_ints(match.group()), match.start())
+            self.pos = match.end()
+
+        if self.pending is None:
+            # no sequence can start before a number at the very end, like the "12" of "... 12, "
+            tail = TAIL_PATTERN.search(self.text, self.pos)
+            self.pos = tail.start() if tail is not None else len(self.text)
+
+        return self.result()
+
+    def result(self):
+        '''Best result so far, counting a sequence that may still grow as it is now.'''
+        if self.pending is None:
+            return self.get_result(self.best, self.last)
+
+        code, confidence = check_sequence(self.pending, self.num_objects)
+        pending = ParseResult(self.pending, code, confidence)
+        return self.get_result(pending if code == OK else self.best, pending)
+
+    def is_complete(self):
+        '''True once a valid permutation is final, e.g. to stop a streamed response early.'''
+        return self.best is not None
+
+    def finish(self):
+        if self.pending is not None:
+            self.add(self.pending, self.pending_pos)
+            self.pending = None
+        return self.result()
+
+    def get_result(self, best, last):
+        if best is not None:
+            return best
+        if last is not None:
+            return last
+        return ParseResult(None, NO_SEQUENCE, 0.0)
+
+
+def parse_prediction(response, num_objects):
+    '''Parse a complete response in one pass. Same results as feeding it all to a StreamingParser.'''
+    best, last = None, None
+
+    for match in SEQUENCE_PATTERN.finditer(response):
+        last = to_ints(match.group())
+        if is_permutation(last, num_objects):
+            best = last
+
+    if best is not None:
+        return ParseResult(best, OK, 1.0)
+    elif last is None:
+        return ParseResult(None, NO_SEQUENCE, 0.0)
+    return ParseResult(last, *check_sequence(last, num_objects))
+
+
+def parse_predictions(response, num_matches):
+    '''The last `num_matches` sequences in a response, one per round, or None if there are fewer, with a code.'''
+    seqs = [to_ints(match.group()) for match in SEQUENCE_PATTERN.finditer(response)]
+    if num_matches is None or len(seqs) < num_matches:
+        return None, NO_SEQUENCE if not seqs else MISSING_ROUNDS
+    return seqs[len(seqs) - num_matches:], OK
@@ -0,0 +1,185 @@
+import io
+import re
+import json
+import base64
+from io import BytesIO
+from functools import lru_cache
+from contextlib import redirect_stdout
+
+from PIL import Image
+
+from scripts.image_profiles import estimate_image_tokens, get_image_profile
+from scripts.lvlm_chat import get_image_data_url
+from scripts.response_cache import hash_bytes
+from scripts.scheduler import get_provider
+from scripts.usage import get_cost
+
+
+# images are written into prompts as <image path>, see LVLMChat
+IMAGE_PATTERN = re.compile(r"<([^<>]+)>")
+
+# the columns of a chain's rows that are known before any request is sent
+MANIFEST_COLS = ["Run Number", "Round", "Rounds", "Pair", "Image FP", "Image FPs", "Answer"]
+
+
+def dry_run_turns(turns_fn):
+    '''The prompts a chain asks for when every response is empty, and the rows it returns then.'''
+    prompts = []
+    turns = turns_fn()
+    try:
+        prompt = next(turns)
+        while True:
+            prompts.append(prompt)
+            prompt = turns.send("")
+    except StopIteration as e:
+        return prompts, e.value
+
+
+def record_turns(turns_fn, record):
+    '''The turns of a chain, with every (prompt, response) appended to `record`.'''
+    turns = turns_fn()
+    try:
+        prompt = next(turns)
+        while True:
+            response = yield prompt
+            record.append((prompt, response))
+            prompt = turns.send(response)
+    except StopIteration as e:
+        return e.value
+
+
+def replay_turns(turns_fn, record):
+    '''The rows of a chain fed the recorded turns of an identical chain, or None if it asks for other prompts.'''
+    if record is None:
+        return None
+
+    turns = turns_fn()
+    try:
+        prompt = next(turns)
+        for recorded_prompt, response in record:
+            if prompt != recorded_prompt:
+                return None
+            prompt = turns.send(response)
+        return None
+    except StopIteration as e:
+        return e.value
+
+
+def to_json_value(value):
+    return value.tolist() if hasattr(value, "tolist") else list(value)
+
+
+@lru_cache(maxsize=None)
+def get_encoded_image_size(image_path, max_img_dim=None, profile=None):
+    data_url = get_image_data_url(image_path, max_img_dim, profile)
+    with Image.open(BytesIO(base64.b64decode(data_url.split(",", 1)[1]))) as img:
+        return img.size
+
+
+class SweepPlan:
+    '''Manifest of every chain of a sweep, compiled by running the chains against empty responses.
+
+    Each entry has the chain's keys, the hash of its model and prompts, its image paths and the
+    answers it is scored against (after `answer_transform`). At temperature 0, a chain whose model
+    and prompts are the same as an earlier chain's (e.g. two runs that drew the same images for a
+    pair) is a duplicate of it: only the first is sent, and the duplicates are scored on its
+    responses, see `run_chains`.
+    '''
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.duplicate_of = [entry["duplicate_of"] for entry in entries]
+        self.originals = {ix for ix in self.duplicate_of if ix is not None}
+
+    @classmethod
+    def compile(cls, setup, chains, dedup=True):
+        entries, first = [], dict()
+
+        # scoring the empty responses should neither print nor count as parses
+        telemetry, setup.telemetry = setup.telemetry, None
+        try:
+            with redirect_stdout(io.StringIO()):
+                for ix, (model, keys, turns_fn) in enumerate(chains):
+                    prompts, rows = dry_run_turns(turns_fn)
+                    signature = hash_bytes(json.dumps([model, prompts], ensure_ascii=False).encode("utf-8"))
+                    duplicate_of = first.get(signature) if dedup else None
+                    first.setdefault(signature, ix)
+
+                    rows = [dict(zip(setup.cols, row)) for row in rows]
+                    entries.append({"chain": ix, "model": model, "keys": keys, "signature": signature,
+                                    "duplicate_of": duplicate_of, "prompts": prompts,
+                                    "images": [IMAGE_PATTERN.findall(prompt) for prompt in prompts],
+                                    "rows": [{col: row[col] for col in MANIFEST_COLS if col in row}
+                                             for row in rows if row.get("Answer") != "-"]})
+        finally:
+            setup.telemetry = telemetry
+
+        return cls(entries)
+
+    def has_duplicates(self, ix):
+        return ix in self.originals
+
+    def save(self, fp):
+        '''Write the manifest as JSONL, one chain per line, with the prompts replaced by their lengths.'''
+        with open(fp, "w") as f:
+            for entry in self.entries:
+                entry = dict(entry, prompts=[len(prompt) for prompt in entry["prompts"]])
+                f.write(json.dumps(entry, default=to_json_value) + "\n")
+
+    def estimate_requests(self, entry, system_prompt, response_tokens, max_img_dim=None, profile=None, max_images=None):
+        '''Estimated (prompt, completion) tokens of every request of a chain, with each earlier response
+        taken to be `response_tokens` long and images counted as OpenAI bills them.'''
+        out = []
+        num_chars, images = len(system_prompt or ""), []
+
+        for turn, (prompt, prompt_images) in enumerate(zip(entry["prompts"], entry["images"])):
+            num_chars += len(IMAGE_PATTERN.sub("", prompt))
+            images.extend(prompt_images)
+            sent_images = images if max_images is None else images[len(images) - min(max_images, len(images)):]
+
+            image_tokens = sum(estimate_image_tokens(get_encoded_image_size(image_path, max_img_dim, profile))
+                               for image_path in sent_images)
+            out.append((num_chars // 4 + turn * response_tokens + image_tokens, response_tokens))
+        return out
+
+    def estimate(self, chat_kwargs, scheduler, seconds_per_request=5.0, response_tokens=300, rate_limits=(None, None)):
+        '''Requests, tokens, cost and wall-clock time of the sweep by model, with and without deduplication.
+
+        Chains of a provider are assumed to run `scheduler.get_limit` at a time with `seconds_per_request`
+        per turn, and no faster than the requests per minute of `rate_limits`. Providers run in parallel.
+        '''
+        out, longest = dict(), dict()
+        for entry in self.entries:
+            model = entry["model"]
+            totals = out.setdefault(model, {"chains": 0, "unique chains": 0, "requests": 0, "unique requests": 0,
+                                            "prompt tokens": 0, "completion tokens": 0})
+            totals["chains"] += 1
+            totals["requests"] += len(entry["prompts"])
+            if entry["duplicate_of"] is not None:
+                continue
+
+            requests = self.estimate_requests(entry, chat_kwargs.get("system_prompt"), response_tokens,
+                                              chat_kwargs.get("max_img_dim"),
+                                              get_image_profile(chat_kwargs.get("image_profiles"), model),
+                                              chat_kwargs.get("max_images"))
+            totals["unique chains"] += 1
+            totals["unique requests"] += len(requests)
+            totals["prompt tokens"] += sum(prompt_tokens for prompt_tokens, _ in requests)
+            totals["completion tokens"] += sum(completion_tokens for _, completion_tokens in requests)
+            longest[model] = max(longest.get(model, 0.0), len(requests) * seconds_per_request)
+
+        by_provider = dict()
+        for model, totals in out.items():
+            totals["cost"] = get_cost(model, totals["prompt tokens"], totals["completion tokens"])
+            provider = get_provider(model)
+            busy = by_provider.setdefault(provider, {"seconds": 0.0, "longest": 0.0})
+            busy["seconds"] += totals["unique requests"] * seconds_per_request
+            busy["longest"] = max(busy["longest"], longest.get(model, 0.0))
+            if rate_limits[0] is not None:
+                busy["rate limited"] = max(busy.get("rate limited", 0.0), totals["unique requests"] / rate_limits[0] * 60)
+
+        for model, totals in out.items():
+            busy = by_provider[get_provider(model)]
+            totals["provider hours"] = max(busy["seconds"] / scheduler.get_limit(get_provider(model)),
+                                           busy["longest"], busy.get("rate limited", 0.0)) / 3600
+        return out
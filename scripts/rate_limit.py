@@ -0,0 +1,266 @@
+import json
+import time
+import random
+import asyncio
+from threading import Lock
+from email.utils import parsedate_to_datetime
+
+
+# client errors that are worth retrying; every other 4xx is fatal
+RETRYABLE_STATUS_CODES = [408, 409, 425, 429]
+
+# rough prompt size of one image, used to charge images against a tokens/min budget
+TOKENS_PER_IMAGE = 765
+
+
+def get_status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_rate_limit_error(error):
+    return get_status_code(error) == 429
+
+
+def is_retryable_error(error):
+    '''Rate limits, timeouts, connection problems and server errors are retryable; bad requests and bugs are not.'''
+    status = get_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+
+    return not isinstance(error, (ValueError, TypeError, KeyError, AttributeError,
+                                  IndexError, AssertionError, NotImplementedError))
+
+
+def get_retry_after(error):
+    '''Seconds to wait according to the Retry-After header of the error's response, if any.'''
+    headers = getattr(error, "litellm_response_headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def get_total_tokens(response):
+    return getattr(getattr(response, "usage", None), "total_tokens", None)
+
+
+def estimate_prompt_tokens(messages):
+    '''Cheap estimate of the prompt tokens of a request: ~4 characters per token plus a flat cost per image.'''
+    num_chars, num_images = 0, 0
+
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            num_chars += len(content)
+            continue
+        for segment in content:
+            if segment.get("type") == "image_url":
+                num_images += 1
+            else:
+                num_chars += len(segment.get("text", ""))
+
+    return num_chars // 4 + num_images * TOKENS_PER_IMAGE
+
+
+class RetryPolicy:
+    '''Exponential backoff with jitter that honors Retry-After and gives up early on fatal errors.'''
+
+    def __init__(self, max_tries=5, base_delay=2.0, max_delay=120.0):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt, error):
+        '''Seconds to wait before the next attempt, or None if the request should not be retried.'''
+        if attempt + 1 >= self.max_tries or not is_retryable_error(error):
+            return None
+
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) + random.uniform(0, 1)
+
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    '''Thread-safe token bucket refilled at `rate_per_min`, holding up to `burst_seconds` worth of tokens.
+
+    `reserve` takes the tokens right away and returns how long the caller has to wait for them,
+    so the same bucket serves both threads (sleep) and coroutines (asyncio.sleep).
+    '''
+
+    def __init__(self, rate_per_min, burst_seconds=6.0, min_rate_fraction=0.1):
+        self.max_rate = rate_per_min / 60.0
+        self.min_rate = self.max_rate * min_rate_fraction
+        self.rate = self.max_rate
+        self.capacity = max(1.0, self.max_rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def __refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount=1.0):
+        with self.lock:
+            now = time.monotonic()
+            self.__refill(now)
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount):
+        '''Give back (positive) or take (negative) tokens, e.g. once the actual usage of a request is known.'''
+        with self.lock:
+            self.__refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def slow_down(self, factor=0.5):
+        with self.lock:
+            self.__refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * factor)
+
+    def speed_up(self, factor=1.05):
+        with self.lock:
+            self.__refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate * factor)
+
+
+class RateLimiter:
+    '''Requests/min and tokens/min limits shared by every chat of one model.
+
+    Adaptive: a 429 pauses all callers for the Retry-After period and halves the allowed rate,
+    which then recovers by 5% with every successful request.
+    '''
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = None if requests_per_minute is None else TokenBucket(requests_per_minute)
+        self.tokens = None if tokens_per_minute is None else TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def reserve(self, num_tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(num_tokens))
+
+        with self.lock:
+            return max(wait, self.paused_until - time.monotonic())
+
+    def acquire(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self, estimated_tokens=0, actual_tokens=None):
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+        for bucket in [self.requests, self.tokens]:
+            if bucket is not None:
+                bucket.speed_up()
+
+    def wrap(self, completion_fn):
+        '''Put the limiter in front of a completion_fn(messages, temperature).'''
+        def limited_completion_fn(messages, temperature):
+            num_tokens = estimate_prompt_tokens(messages)
+            self.acquire(num_tokens)
+            response = completion_fn(messages, temperature)
+            self.on_success(num_tokens, get_total_tokens(response))
+            return response
+
+        return limited_completion_fn
+
+    def wrap_async(self, completion_fn):
+        '''Same as `wrap` for an async completion_fn.'''
+        async def limited_completion_fn(messages, temperature):
+            num_tokens = estimate_prompt_tokens(messages)
+            await self.acquire_async(num_tokens)
+            response = await completion_fn(messages, temperature)
+            self.on_success(num_tokens, get_total_tokens(response))
+            return response
+
+        return limited_completion_fn
+
+    def on_rate_limited(self, pause):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+        for bucket in [self.requests, self.tokens]:
+            if bucket is not None:
+                bucket.slow_down()
+
+
+rate_limiters = dict()
+rate_limiters_lock = Lock()
+
+
+def get_rate_limiter(model, requests_per_minute=None, tokens_per_minute=None):
+    '''Process-wide rate limiter of the model, created on first use. Returns None if no limit is set.'''
+    if requests_per_minute is None and tokens_per_minute is None:
+        return None
+
+    with rate_limiters_lock:
+        if model not in rate_limiters:
+            rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return rate_limiters[model]
+
+
+class FailureLog:
+    '''Structured record of failed completion attempts, optionally appended to a JSONL file.'''
+
+    def __init__(self, fp=None, append=True):
+        self.fp = fp
+        self.counts = dict()
+        self.lock = Lock()
+
+        if fp is not None and not append:
+            open(fp, "w").close()
+
+    def record(self, model, attempt, error, retryable, gave_up):
+        record = {"time": time.time(),
+                  "model": model,
+                  "attempt": attempt + 1,
+                  "error_type": type(error).__name__,
+                  "status_code": get_status_code(error),
+                  "message": str(error)[:500],
+                  "retryable": retryable,
+                  "gave_up": gave_up}
+
+        with self.lock:
+            key = (model, record["error_type"])
+            attempts, given_up = self.counts.get(key, (0, 0))
+            self.counts[key] = (attempts + 1, given_up + int(gave_up))
+            if self.fp is not None:
+                with open(self.fp, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        '''Count of failed attempts and of requests given up on, by model and error type.'''
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,212 @@
+import os
+import re
+import json
+import time
+import hashlib
+from threading import Lock
+from types import SimpleNamespace
+
+
+DATA_URL_PATTERN = re.compile(r"^data:(image/[a-z]+);base64,(.*)$", re.S)
+
+
+class CacheMissError(Exception):
+    '''Raised in replay mode when a request is not in the cache.'''
+
+
+def make_completion_response(content):
+    '''Minimal stand-in for a litellm response, exposing `choices[0].message.content`.'''
+    message = SimpleNamespace(role="assistant", content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_messages(messages):
+    '''Copy of the messages with every base64 image payload replaced by the hash of the payload.'''
+    out = []
+
+    for message in messages:
+        content = message["content"]
+
+        if isinstance(content, list):
+            segments = []
+            for segment in content:
+                if segment.get("type") == "image_url":
+                    url = segment["image_url"]["url"]
+                    match = DATA_URL_PATTERN.match(url)
+                    if match is not None:
+                        url = f"{match.group(1)};sha256,{hash_bytes(match.group(2).encode())}"
+                    segment = {"type": "image_url", "image_url": {"url": url}}
+                segments.append(segment)
+            content = segments
+
+        out.append({"role": message["role"], "content": content})
+
+    return out
+
+
+def get_cache_key(model, temperature, messages):
+    payload = json.dumps({"model": model,
+                          "temperature": temperature,
+                          "messages": normalize_messages(messages)},
+                         sort_keys=True, ensure_ascii=False)
+    return hash_bytes(payload.encode())
+
+
+def is_stopped_early(response):
+    '''Whether a streamed response was cut off after its answer (see --early_stop), see StreamCollector.'''
+    timing = getattr(response, "timing", None)
+    return bool(timing and timing.get("stopped_early"))
+
+
+class ResponseCache:
+    '''On-disk, content-addressed cache of LVLM completions.
+
+    Each response is stored as a small JSON file named by the hash of (model, temperature, messages),
+    with image payloads hashed rather than included. When `max_size_mb` is set, the least recently
+    used entries are evicted once the cache grows beyond that size. Responses stopped early are not
+    stored, since the same request without --early_stop gets the full response. In `read_only` mode
+    the cache never calls the wrapped completion function and raises CacheMissError on a miss.
+    '''
+
+    def __init__(self, cache_dir, max_size_mb=None, read_only=False):
+        self.cache_dir = cache_dir
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+        self.read_only = read_only
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> [last used time, size in bytes], used for eviction
+        self.entries = dict()
+        for root, _, files in os.walk(cache_dir):
+            for f in files:
+                if f.endswith(".json"):
+                    stat = os.stat(os.path.join(root, f))
+                    self.entries[f[:-5]] = [stat.st_mtime, stat.st_size]
+        self.size = sum(size for _, size in self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def __read(self, fp):
+        try:
+            with open(fp, "r") as f:
+                return json.load(f)["content"]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get(self, key):
+        '''Return the cached response content for the key, or None.'''
+        fp = self.get_path(key)
+        content = self.__read(fp)
+
+        if content is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries[key][0] = time.time()
+
+        if self.max_size is not None and not self.read_only:
+            os.utime(fp)
+
+        return content
+
+    def put(self, key, model, temperature, content):
+        '''Store the content under the key and return the stored content.
+
+        The first response stored under a key wins, so that concurrent duplicate requests
+        all continue with the same history that a later replay will see.
+        '''
+        if self.read_only:
+            return content
+
+        fp = self.get_path(key)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+
+        with self.lock:
+            cached_content = self.__read(fp)
+            if cached_content is not None:
+                return cached_content
+
+            tmp_fp = f"{fp}.{os.getpid()}.tmp"
+            with open(tmp_fp, "w") as f:
+                json.dump({"model": model, "temperature": temperature, "content": content}, f)
+            os.replace(tmp_fp, fp)
+
+            if key in self.entries:
+                self.size -= self.entries[key][1]
+            self.entries[key] = [time.time(), os.path.getsize(fp)]
+            self.size += self.entries[key][1]
+            self.__evict()
+
+        return content
+
+    def __evict(self):
+        if self.max_size is None or self.size <= self.max_size:
+            return
+
+        for key, (_, size) in sorted(self.entries.items(), key=lambda x: x[1][0]):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+            del self.entries[key]
+            self.size -= size
+
+    def __lookup(self, model, temperature, messages):
+        key = get_cache_key(model, temperature, messages)
+        content = self.get(key)
+
+        if content is None and self.read_only:
+            raise CacheMissError(f"No cached response for model {model} (key {key}).")
+
+        return key, content
+
+    def wrap(self, completion_fn, model):
+        '''Put the cache in front of a completion_fn(messages, temperature).'''
+        def cached_completion_fn(messages, temperature):
+            key, content = self.__lookup(model, temperature, messages)
+
+            if content is None:
+                response = completion_fn(messages, temperature)
+                if is_stopped_early(response):
+                    return response
+                content = response.choices[0].message.content
+                stored_content = self.put(key, model, temperature, content)
+                return response if stored_content == content else make_completion_response(stored_content)
+
+            return make_completion_response(content)
+
+        return cached_completion_fn
+
+    def wrap_async(self, completion_fn, model):
+        '''Same as `wrap` for an async completion_fn.'''
+        async def cached_completion_fn(messages, temperature):
+            key, content = self.__lookup(model, temperature, messages)
+
+            if content is None:
+                response = await completion_fn(messages, temperature)
+                if is_stopped_early(response):
+                    return response
+                content = response.choices[0].message.content
+                stored_content = self.put(key, model, temperature, content)
+                return response if stored_content == content else make_completion_response(stored_content)
+
+            return make_completion_response(content)
+
+        return cached_completion_fn
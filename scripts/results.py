@@ -0,0 +1,426 @@
+import os
+import json
+import random
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from scripts.parsing import CODES, check_sequence, parse_prediction, parse_predictions
+
+
+def get_stream_fp(res_fp):
+    '''Path of the append-only JSONL file that rows are streamed to while `res_fp` is being produced.'''
+    return os.path.splitext(res_fp)[0] + ".jsonl"
+
+
+def get_state_fp(res_fp):
+    return os.path.splitext(res_fp)[0] + ".state.json"
+
+
+def get_arrow_fp(res_fp):
+    return os.path.splitext(res_fp)[0] + ".arrow"
+
+
+def get_row_key(row):
+    '''(run, model, pair, round) key of a result row. Rows covering several rounds use the tuple of rounds.'''
+    round = row["Round"] if "Round" in row else tuple(row["Rounds"])
+    return (row["Run Number"], row["Model"], row["Pair"], round)
+
+
+def truncate_to_last_line(fp, block_size=1 << 16):
+    '''Cut a line left unfinished by an interrupted write off the end of a file, so that appending
+    to it starts on a new line.'''
+    if not os.path.exists(fp):
+        return
+
+    with open(fp, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            ix = f.read(pos - start).rfind(b"\n")
+            if ix >= 0:
+                pos = start + ix + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+
+
+class ResultWriter:
+    '''Appends result rows to a JSONL file as they are produced.
+
+    Every write is flushed, so an interrupted run loses at most the rows that were in flight.
+    '''
+
+    def __init__(self, fp, cols, append=False):
+        self.fp = fp
+        self.cols = cols
+        self.lock = Lock()
+        if append:
+            truncate_to_last_line(fp)
+        self.file = open(fp, "a" if append else "w")
+
+    def write(self, rows):
+        # the rows of a chain go out in one write, so that an interruption rarely splits them
+        data = "".join(json.dumps(dict(zip(self.cols, row)), ensure_ascii=False) + "\n" for row in rows)
+
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_result_rows(fp):
+    '''Load the rows of a JSONL result file as dicts. A truncated last line from an interrupted run is skipped.'''
+    if not os.path.exists(fp):
+        return []
+
+    rows = []
+    with open(fp, "r") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line in {fp}: {line[:80]}")
+    return rows
+
+
+def load_done_keys(fp, chain_keys):
+    '''The keys of the chains whose rows are all in a JSONL result file, given the keys of every chain.
+
+    A chain cut off after some of its rows is run again in full, so its rows are cut off the end of
+    the file first, together with any rows written after them.
+    '''
+    rows = list(scan_result_rows(fp))
+    found = {key for _, _, key in rows}
+    partial = {key for keys in chain_keys if not set(keys) <= found for key in keys if key in found}
+
+    offsets = [offset for offset, _, key in rows if key in partial]
+    if offsets:
+        end = min(offsets)
+        print(f"Dropping {sum(offset >= end for offset, _, _ in rows)} rows of partly written chains from {fp}.")
+        with open(fp, "rb+") as f:
+            f.truncate(end)
+        found = {key for offset, _, key in rows if offset < end}
+    return found
+
+
+def scan_result_rows(fp, cols=None):
+    '''Yield the byte offset, the value kinds of `cols` and the key of every row of a JSONL result file.'''
+    if not os.path.exists(fp):
+        return
+
+    with open(fp, "rb") as f:
+        offset = 0
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line in {fp}: {line[:80]}")
+            else:
+                kinds = [get_value_kind(row.get(col)) for col in cols or []]
+                yield offset, kinds, get_row_key(row)
+            offset += len(line)
+
+
+def get_value_kind(value):
+    if value is None:
+        return "none"
+    if isinstance(value, bool):
+        return "other"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return "other"
+
+
+def is_float_column(kinds):
+    '''Whether pandas reads a column with these value kinds as floats: numbers with a float or a missing value.'''
+    return kinds <= {"int", "float", "none"} and bool(kinds & {"int", "float"}) and bool(kinds & {"float", "none"})
+
+
+def save_rows_to_csv(rows, cols, fp):
+    pd.DataFrame([[row.get(col) for col in cols] for row in rows], columns=cols).to_csv(fp, index=False)
+
+
+def save_results(stream_fp, cols, res_fp, order, chunk_size=1000):
+    '''Write the CSV at `res_fp` and the Arrow file next to it from the rows of a JSONL result file,
+    sorted by the `order` of their keys.
+
+    Only the offsets of the rows are held while sorting, and the rows are then read and written a
+    chunk at a time, so memory use does not grow with the size of the run. The CSV is the same as
+    writing all rows at once, since the columns pandas would read as floats are found up front.
+    '''
+    offsets, kinds = [], [set() for _ in cols]
+    for ix, (offset, row_kinds, key) in enumerate(scan_result_rows(stream_fp, cols)):
+        offsets.append((order.get(key, len(order)), ix, offset))
+        for col_kinds, kind in zip(kinds, row_kinds):
+            col_kinds.add(kind)
+    offsets.sort()
+    float_cols = [col for col, col_kinds in zip(cols, kinds) if is_float_column(col_kinds)]
+
+    with open(stream_fp, "rb") as f, open(res_fp, "w", newline="") as csv_file:
+        for start, rows in iter_row_chunks(f, offsets, chunk_size):
+            df = pd.DataFrame([[row.get(col) for col in cols] for row in rows], columns=cols)
+            for col in float_cols:
+                df[col] = df[col].astype(float)
+            df.to_csv(csv_file, index=False, header=start == 0)
+
+    # the Arrow file is written after the CSV is complete, so that it can never cut the CSV short
+    arrow_fp = get_arrow_fp(res_fp)
+    try:
+        with open(stream_fp, "rb") as f, ArrowResultWriter(arrow_fp) as arrow_writer:
+            for _, rows in iter_row_chunks(f, offsets, chunk_size):
+                arrow_writer.write(rows)
+    except Exception as e:
+        print(f"Could not write the Arrow results {arrow_fp}, the CSV {res_fp} is complete: {e}")
+        if os.path.exists(arrow_fp):
+            os.remove(arrow_fp)
+
+
+def iter_row_chunks(f, offsets, chunk_size):
+    '''(index of the first row, rows) of every chunk of the rows at the sorted `offsets` of a JSONL file.'''
+    for start in range(0, max(len(offsets), 1), chunk_size):
+        rows = []
+        for _, _, offset in offsets[start:start + chunk_size]:
+            f.seek(offset)
+            rows.append(json.loads(f.readline()))
+        yield start, rows
+
+
+def save_run_state(fp, args):
+    '''Save the arguments and the initial random state, so that a resumed run samples the same images.'''
+    state = {"args": vars(args), "random_state": random.getstate()}
+    with open(fp, "w") as f:
+        json.dump(state, f)
+
+
+def load_run_state(fp, args):
+    '''Restore the random state saved by `save_run_state` and warn about arguments that changed since.'''
+    with open(fp, "r") as f:
+        state = json.load(f)
+
+    for k, v in state["args"].items():
+        if k != "resume" and getattr(args, k, None) != v:
+            print(f"Warning: {k} was {v} in the interrupted run, but is {getattr(args, k, None)} now.")
+
+    version, internal_state, gauss_next = state["random_state"]
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+
+# status of a row in the Arrow results: a scored prediction, one that could not be parsed or scored,
+# a failed request, an intermediate turn of a multi-turn setup, or the response to feedback
+STATUSES = ["ok", "cannot_parse", "error", "failed", "turn", "feedback"]
+SCORED_STATUSES = ["ok", "cannot_parse", "error", "failed"]
+
+STATUS_OF_PREDICTION = {"CANNOT_PARSE": "cannot_parse", "ERROR": "error", "REQUEST_FAILED": "failed",
+                        "-": "turn", "ResponseToTheCorrectAnswer": "feedback"}
+
+RESPONSE_CODEC = "zstd"
+
+ARROW_SCHEMA = pa.schema([
+    ("run_number", pa.int32()),
+    ("model", pa.dictionary(pa.int16(), pa.string())),
+    ("pair", pa.dictionary(pa.int16(), pa.string())),
+    ("round", pa.int32()),
+    ("rounds", pa.list_(pa.int32())),
+    ("image_fp", pa.dictionary(pa.int32(), pa.string())),
+    ("status", pa.dictionary(pa.int8(), pa.string())),
+    ("prediction", pa.list_(pa.int32())),
+    ("answer", pa.list_(pa.int32())),
+    ("accu", pa.float64()),
+    ("parse_code", pa.dictionary(pa.int8(), pa.string())),
+    ("conversation", pa.string()),
+    ("response", pa.binary()),
+    ("response_size", pa.int32()),
+])
+
+
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+
+def get_int_list(values):
+    '''The list if every value fits the int32 lists of ARROW_SCHEMA, otherwise None.'''
+    if isinstance(values, list) and all(isinstance(x, int) and INT32_MIN <= x <= INT32_MAX for x in values):
+        return values
+    return None
+
+
+def get_status_of_prediction(pred):
+    if isinstance(pred, list):
+        # a prediction with a number too large for ARROW_SCHEMA is no permutation of the answer anyway
+        return "ok" if get_int_list(pred) is not None else "cannot_parse"
+    if isinstance(pred, dict):
+        return "ok"
+    return STATUS_OF_PREDICTION.get(pred, "cannot_parse")
+
+
+def get_accu_value(accu):
+    return float(accu) if isinstance(accu, (int, float)) and not isinstance(accu, bool) else None
+
+
+def get_parse_code(status, pred, response, answer):
+    '''Why the prediction is not a valid permutation (see scripts.parsing), for rows with a prediction.'''
+    if status in ["failed", "turn", "feedback"] or not isinstance(answer, list):
+        return None
+    if isinstance(pred, list):
+        return check_sequence(pred, len(answer))[0]
+    return parse_prediction(response, len(answer)).code
+
+
+def expand_result_row(row):
+    '''Typed records of a result row: one per round, with "all transcripts" rows split by round.'''
+    if "Round" in row:
+        pred = row["Prediction"]
+        status = get_status_of_prediction(pred)
+        return [{"run_number": row["Run Number"], "model": row["Model"], "pair": row["Pair"],
+                 "round": row["Round"], "rounds": [row["Round"]], "image_fp": row["Image FP"],
+                 "status": status, "prediction": pred if status == "ok" else None,
+                 "answer": get_int_list(row["Answer"]),
+                 "accu": get_accu_value(row["Accu"]) if status in SCORED_STATUSES else None,
+                 "parse_code": get_parse_code(status, pred, row["Response"], row["Answer"]),
+                 "conversation": row.get("Conversation"), "response": row["Response"]}]
+
+    preds, accus = row["Prediction"], row["Accu"]
+    out = []
+    for i, round in enumerate(row["Rounds"]):
+        pred = preds.get(f"Round {i+1}", "CANNOT_PARSE") if isinstance(preds, dict) else preds
+        status = get_status_of_prediction(pred)
+        accu = accus[i] if isinstance(accus, list) else accus
+
+        if isinstance(pred, list):
+            parse_code = check_sequence(pred, len(row["Answer"][i]))[0]
+        elif status != "failed":
+            parse_code = parse_predictions(row["Response"], len(row["Rounds"]))[1]
+        else:
+            parse_code = None
+
+        out.append({"run_number": row["Run Number"], "model": row["Model"], "pair": row["Pair"],
+                    "round": round, "rounds": row["Rounds"], "image_fp": row["Image FPs"][i],
+                    "status": status, "prediction": pred if status == "ok" else None,
+                    "answer": get_int_list(row["Answer"][i]), "accu": get_accu_value(accu),
+                    "parse_code": parse_code,
+                    "conversation": None, "response": row["Response"]})
+    return out
+
+
+# columns whose values are stored once in a dictionary per file
+DICTIONARY_COLUMNS = ["model", "pair", "image_fp", "parse_code"]
+
+
+def get_initial_dictionaries():
+    # parse codes are known up front, and a dictionary that starts out empty cannot get deltas
+    return {name: {code: i for i, code in enumerate(CODES)} if name == "parse_code" else dict()
+            for name in DICTIONARY_COLUMNS}
+
+
+def encode_dictionary_column(values, dictionary, type):
+    '''Dictionary-encode `values` against `dictionary` (value -> index), adding the values it does not have yet.'''
+    indices = [None if value is None else dictionary.setdefault(value, len(dictionary)) for value in values]
+    return pa.DictionaryArray.from_arrays(pa.array(indices, type=type.index_type),
+                                          pa.array(list(dictionary), type=type.value_type))
+
+
+def rows_to_batch(rows, dictionaries=None):
+    '''Convert result rows to a record batch with ARROW_SCHEMA. Responses are compressed one by one, so the
+    batch itself stays uncompressed and can be memory-mapped, and responses are only inflated on demand.
+
+    `dictionaries` maps every dictionary column to the dictionary of the batches written before, if any.
+    '''
+    records = [record for row in rows for record in expand_result_row(row)]
+    dictionaries = dictionaries if dictionaries is not None else get_initial_dictionaries()
+    codec = pa.Codec(RESPONSE_CODEC)
+
+    columns = dict()
+    for name in ["run_number", "round", "rounds", "prediction", "answer", "accu", "conversation"]:
+        columns[name] = pa.array([r[name] for r in records], type=ARROW_SCHEMA.field(name).type)
+
+    for name in DICTIONARY_COLUMNS:
+        columns[name] = encode_dictionary_column([r[name] for r in records], dictionaries[name],
+                                                 ARROW_SCHEMA.field(name).type)
+
+    # a fixed dictionary, so that status codes mean the same in every file
+    status_codes = np.array([STATUSES.index(r["status"]) for r in records], dtype=np.int8)
+    columns["status"] = pa.DictionaryArray.from_arrays(status_codes, pa.array(STATUSES))
+
+    responses = [(r["response"] or "").encode("utf-8") for r in records]
+    columns["response"] = pa.array([codec.compress(b, asbytes=True) for b in responses], type=pa.binary())
+    columns["response_size"] = pa.array([len(b) for b in responses], type=pa.int32())
+
+    return pa.record_batch([columns[field.name] for field in ARROW_SCHEMA], schema=ARROW_SCHEMA)
+
+
+def rows_to_arrow(rows):
+    return pa.Table.from_batches([rows_to_batch(rows)], schema=ARROW_SCHEMA)
+
+
+def save_rows_to_arrow(rows, fp):
+    save_arrow_table(rows_to_arrow(rows), fp)
+
+
+class ArrowResultWriter:
+    '''Writes result rows to an Arrow file one batch at a time.
+
+    The dictionaries only ever grow, and the values new to a batch are written as dictionary
+    deltas, so the file has one dictionary per column as the Arrow file format requires.
+    '''
+
+    def __init__(self, fp):
+        self.sink = pa.OSFile(fp, "wb")
+        self.writer = pa.ipc.new_file(self.sink, ARROW_SCHEMA,
+                                      options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        self.dictionaries = get_initial_dictionaries()
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_batch(rows_to_batch(rows, self.dictionaries))
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_arrow_table(table, fp):
+    # the Arrow file format allows one dictionary per column, so merged tables are unified first
+    table = table.unify_dictionaries()
+    with pa.OSFile(fp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_arrow_results(fp, columns=None, filter=None):
+    '''Memory-map an Arrow result file. Columns are read without copying or parsing;
+    `filter` is an optional pyarrow.compute expression, e.g. pc.field("status") == "ok".'''
+    table = pa.ipc.open_file(pa.memory_map(fp, "r")).read_all()
+
+    if filter is not None:
+        table = table.filter(filter)
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+def decompress_responses(table):
+    '''Raw responses of an Arrow result table as strings.'''
+    codec = pa.Codec(RESPONSE_CODEC)
+    return [codec.decompress(data, decompressed_size=size, asbytes=True).decode("utf-8")
+            for data, size in zip(table["response"].to_pylist(), table["response_size"].to_pylist())]
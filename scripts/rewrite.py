@@ -0,0 +1,209 @@
+import os
+import json
+import argparse
+from time import sleep
+from string import Template
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+from litellm import completion
+
+from scripts.rate_limit import RetryPolicy
+from scripts.response_cache import hash_bytes
+from scripts.results import truncate_to_last_line
+from scripts.transcripts import read_data_file, get_index_fp, TranscriptStore
+
+
+# the prompts of notebooks/rewrite_transcripts.ipynb, by the suffix of the files they produce
+REWRITE_PROMPTS = {
+    "revised": Template('''
+You are given an excerpt from a transcribed, spontaneous conversation between two individuals. \
+Your task is to revise the excerpt to produce a clear, polished version of the dialogue that reads like formal written text. \
+Transform any standalone words or phrases into complete, grammatically correct sentences where appropriate. Do not add any \
+additional information or context or change the meaning of the text. Do not output anything other than the revised excerpt.
+
+Here is the excerpt:
+${excerpt}
+
+Revised Excerpt:
+'''.strip()),
+    "summarized": Template('''
+You are given an excerpt from a transcribed, spontaneous conversation between two individuals. \
+Your task is to extract and concisely summarize all descriptions used to characterize a specific object mentioned in the excerpt. \
+You must follow the instructions below:
+
+1. Preserve all relevant descriptive details.
+2. Do not alter the meaning, add context, or introduce new information.
+3. Your response must only include the final summary—do not include the original excerpt or any explanatory text.
+
+Excerpt:
+
+${excerpt}
+
+Summary of Object Descriptions:
+'''.strip()),
+}
+
+
+def get_rewrite_key(model, temperature, prompt):
+    return hash_bytes(json.dumps([model, temperature, prompt], ensure_ascii=False).encode("utf-8"))
+
+
+class RewriteCache:
+    '''Append-only JSONL file of finished rewrites by the hash of (model, temperature, prompt).
+
+    It is the checkpoint of a rewrite too: every rewrite is flushed as soon as it is done, so an
+    interrupted run only redoes the requests that were in flight, and an excerpt that occurs in
+    several cells or corpora is rewritten once.
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = dict()
+        self.lock = Lock()
+
+        if os.path.exists(fp):
+            with open(fp, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["key"]] = entry["rewrite"]
+            truncate_to_last_line(fp)
+        self.file = open(fp, "a")
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, rewrite):
+        with self.lock:
+            self.entries[key] = rewrite
+            self.file.write(json.dumps({"key": key, "rewrite": rewrite}, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def get_default_completion_fn(model):
+    return lambda messages, temperature: completion(model=model, messages=messages, temperature=temperature)
+
+
+def get_rewrite(prompt, completion_fn, temperature=0, retry_policy=None):
+    '''The rewrite of one prompt, retried with backoff on retryable errors, or None if it failed for good.'''
+    retry_policy = retry_policy or RetryPolicy()
+
+    for attempt in range(retry_policy.max_tries):
+        try:
+            response = completion_fn([{"role": "user", "content": prompt}], temperature)
+            return response.choices[0].message.content
+        except Exception as e:
+            delay = retry_policy.get_delay(attempt, e)
+            print(f"Running into problem ({type(e).__name__}, attempt {attempt + 1}):", e)
+            if delay is None:
+                return None
+            sleep(delay)
+
+
+def iter_cells(df):
+    '''(row index, pair column, excerpt) of every non-empty transcript cell of a matching-data sheet.'''
+    pairs = df.columns.tolist()[3:]
+    for col_ix, pair in enumerate(pairs, start=3):
+        for row_ix, excerpt in enumerate(df.iloc[:, col_ix]):
+            if isinstance(excerpt, str) and excerpt.strip():
+                yield row_ix, pair, excerpt
+
+
+def rewrite_dfs(dfs, prompt_tmp, cache, model="openai/gpt-4.1-2025-04-14", temperature=0,
+                max_concurrency=16, retry_policy=None, completion_fn=None):
+    '''Rewrite every non-empty transcript cell of the sheets with `prompt_tmp`, concurrently.
+
+    Rewrites in the cache are reused and new ones are added to it as they finish. Returns the
+    revised sheets and the number of cells whose rewrite failed, which are left unchanged.
+    '''
+    completion_fn = completion_fn or get_default_completion_fn(model)
+    revised = [df.copy() for df in dfs]
+
+    cells, todo = [], dict()
+    for df_ix, df in enumerate(dfs):
+        for row_ix, pair, excerpt in iter_cells(df):
+            prompt = prompt_tmp.substitute(excerpt=excerpt)
+            key = get_rewrite_key(model, temperature, prompt)
+            cells.append((df_ix, row_ix, pair, key))
+            if cache.get(key) is None:
+                todo[key] = prompt
+
+    print(f"{len(cells)} cells, {len(cells) - len(todo)} already rewritten, {len(todo)} unique excerpts to rewrite.")
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {executor.submit(get_rewrite, prompt, completion_fn, temperature, retry_policy): key
+                   for key, prompt in todo.items()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            if future.result() is not None:
+                cache.put(futures[future], future.result())
+
+    num_failed = 0
+    for df_ix, row_ix, pair, key in cells:
+        rewrite = cache.get(key)
+        if rewrite is None:
+            num_failed += 1
+        else:
+            revised[df_ix].iat[row_ix, revised[df_ix].columns.get_loc(pair)] = rewrite
+
+    return revised, num_failed
+
+
+def get_output_fp(data_fp, suffix, format):
+    return f"{os.path.splitext(data_fp)[0]}-{suffix}.{format}"
+
+
+def save_data_file(df, fp):
+    '''Save a revised sheet as xlsx or parquet, with the transcript index that TranscriptStore.load reads first.'''
+    if fp.endswith(".parquet"):
+        df.to_parquet(fp, index=False)
+    else:
+        df.to_excel(fp, index=False)
+
+    stat = os.stat(fp)
+    TranscriptStore.from_dataframe(df).save(get_index_fp(fp), (stat.st_mtime_ns, stat.st_size))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Rewrite the transcripts of matching-data files with an LLM.")
+    parser.add_argument("data_fps", nargs="+", help="Matching-data files, e.g. data/baskets-matching-data.xlsx")
+    parser.add_argument("--style", type=str, default="revised", choices=list(REWRITE_PROMPTS), help="'revised' makes the transcripts read like formal text, 'summarized' keeps only the object descriptions. Default is revised.")
+    parser.add_argument("--model", type=str, default="openai/gpt-4.1-2025-04-14", help="Model for the rewrites.")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Temperature for the model.")
+    parser.add_argument("--max_concurrency", type=int, default=16, help="Max number of requests in flight. Default is 16.")
+    parser.add_argument("--max_tries", type=int, default=5, help="Max attempts per request. Default is 5.")
+    parser.add_argument("--format", type=str, default="xlsx", choices=["xlsx", "parquet"], help="Format of the output files, <name>-<style>.<format>. Default is xlsx.")
+    parser.add_argument("--cache_fp", type=str, default="data/rewrites.jsonl", help="Cache and checkpoint of the rewrites. Default is data/rewrites.jsonl.")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    dfs = [read_data_file(fp) for fp in args.data_fps]
+
+    cache = RewriteCache(args.cache_fp)
+    try:
+        revised, num_failed = rewrite_dfs(dfs, REWRITE_PROMPTS[args.style], cache, args.model, args.temperature,
+                                          args.max_concurrency, RetryPolicy(max_tries=args.max_tries))
+    finally:
+        cache.close()
+
+    if num_failed:
+        print(f"{num_failed} cells could not be rewritten, so no files were saved. Re-run to retry them; "
+              f"the finished rewrites are kept in {args.cache_fp}.")
+        return
+
+    for data_fp, df in zip(args.data_fps, revised):
+        output_fp = get_output_fp(data_fp, args.style, args.format)
+        save_data_file(df, output_fp)
+        print(f"Rewritten data saved to {output_fp}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def get_provider(model):
+    '''Return the provider prefix of a litellm-style model name, e.g. "openai" for "openai/gpt-4o-mini".'''
+    return model.split("/")[0] if "/" in model else model
+
+
+def parse_provider_concurrency(spec):
+    '''Parse a spec like "openai=8,groq=2" into {"openai": 8, "groq": 2}.'''
+    if not spec:
+        return dict()
+
+    out = dict()
+    for item in spec.split(","):
+        provider, limit = item.split("=")
+        out[provider.strip()] = int(limit)
+    return out
+
+
+class ChainScheduler:
+    '''Runs independent chat chains concurrently.
+
+    A chain is a callable that runs all rounds of one (run, model, pair) against
+    its own LVLMChat, so the round order within a chain is preserved while up to
+    `max_concurrency` chains per provider are in flight at the same time.
+    '''
+
+    def __init__(self, max_concurrency=4, provider_concurrency=None):
+        assert max_concurrency >= 1, "max_concurrency must be at least 1."
+        self.max_concurrency = max_concurrency
+        self.provider_concurrency = provider_concurrency or dict()
+
+    def get_pool(self, models):
+        '''The pool of a chain: the provider of its model, or for a chain fanned out to several
+        models (a tuple of models), all their providers, capped by the lowest of their limits.'''
+        if isinstance(models, str):
+            return get_provider(models)
+        return "+".join(sorted({get_provider(model) for model in models}))
+
+    def get_limit(self, pool):
+        return min(self.provider_concurrency.get(provider, self.max_concurrency) for provider in pool.split("+"))
+
+    def run(self, chains):
+        '''Run (model, chain_fn) pairs and yield (index, result) as chains complete.
+
+        Each provider gets its own thread pool so a slow or rate limited provider
+        does not starve the others.
+        A chain fanned out to several models runs in a pool of its own, see `get_pool`.
+        '''
+        executors = dict()
+        futures = dict()
+
+        try:
+            for ix, (model, chain_fn) in enumerate(chains):
+                provider = self.get_pool(model)
+                if provider not in executors:
+                    executors[provider] = ThreadPoolExecutor(
+                        max_workers=self.get_limit(provider),
+                        thread_name_prefix=f"chain-{provider}")
+                futures[executors[provider].submit(chain_fn)] = ix
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    async def run_async(self, chains):
+        '''Same as `run`, but chain_fn returns a coroutine and all chains share the running event loop.
+
+        Concurrency per provider is bounded with a semaphore instead of a thread pool,
+        so thousands of chains can be in flight without a thread each.
+        '''
+        semaphores = dict()
+
+        async def run_one(ix, semaphore, chain_fn):
+            async with semaphore:
+                return ix, await chain_fn()
+
+        tasks = []
+        for ix, (model, chain_fn) in enumerate(chains):
+            provider = self.get_pool(model)
+            if provider not in semaphores:
+                semaphores[provider] = asyncio.Semaphore(self.get_limit(provider))
+            tasks.append(asyncio.ensure_future(run_one(ix, semaphores[provider], chain_fn)))
+
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,60 @@
+from scripts.lvlm_chat import FAILED_RESPONSE
+from scripts.parsing import parse_prediction, parse_predictions
+
+
+def extract_prediction(response, num_objects_per_image):
+    if response == FAILED_RESPONSE:
+        return "REQUEST_FAILED"
+
+    # the last valid permutation, otherwise the last sequence
+    pred = parse_prediction(response, num_objects_per_image).pred
+    return "CANNOT_PARSE" if pred is None else pred
+
+    
+def compute_accu(answer, pred):
+    # failed requests are left out of the averages instead of being scored as wrong answers
+    if pred == "REQUEST_FAILED":
+        return float("nan")
+    elif pred == "CANNOT_PARSE":
+        return 0
+    else:
+        return sum([a==p for a, p in zip(answer, pred)]) / len(answer)
+    
+
+def answer_transform(img_fp, answer, mapper):
+    if img_fp in mapper:
+        return [mapper[img_fp].index(x) + 1 for x in answer]
+    else:
+        raise ValueError(f"Image path {img_fp} not found in mapper.") 
+    
+
+def extract_json_response(response, num_matches=None):    
+    if response == FAILED_RESPONSE:
+        return "REQUEST_FAILED"
+
+    preds, _ = parse_predictions(response, num_matches)
+
+    if preds is not None:
+        return {f"Round {i+1}": pred for i, pred in enumerate(preds)}
+
+    return "CANNOT_PARSE"
+
+
+def compute_accu_for_json_response(answers, preds):
+    out = [0] * len(answers)
+
+    if preds == "REQUEST_FAILED":
+        return [float("nan")] * len(answers)
+    elif preds == "CANNOT_PARSE":
+        return out
+    else:
+        for i in range(len(preds)):
+            try:
+                pred = preds[f"Round {i+1}"]
+                answer = answers[i]
+                out[i] = sum([a==p for a, p in zip(answer, pred)]) / len(answer)
+            except Exception as e:
+                print(f"Error processing Round {i+1}: {e}")
+                out[i] = "CANNOT_PARSE"
+        
+        return out
@@ -0,0 +1,262 @@
+from time import perf_counter
+from random import sample
+from functools import partial
+
+from scripts.prompt_templates import get_prompt_templates_from_setup_name
+from scripts.scoring import extract_prediction, compute_accu, answer_transform, \
+    extract_json_response, compute_accu_for_json_response
+
+
+random_sequence_mapper = {
+    10: "3, 7, 1, 5, 2, 8, 10, 4, 6, 9",
+    13: "3, 7, 1, 12, 5, 2, 13, 8, 10, 4, 6, 9, 11",
+}
+
+
+SETUPS = dict()
+
+
+def register_setup(cls):
+    SETUPS[cls.name] = cls
+    return cls
+
+
+def get_setup(setup_name, *args, **kwargs):
+    if setup_name not in SETUPS:
+        raise ValueError(f"Not Implemented for setup_name {setup_name}.")
+    return SETUPS[setup_name](*args, **kwargs)
+
+
+class Setup:
+    '''An experiment setup.
+
+    A setup builds the chains of a sweep (`get_chains`), each a (model, keys, turns_fn) tuple,
+    where calling turns_fn gives the turn plan of one chat: a generator that yields the prompts
+    in order, receives the responses and returns the result rows (`get_turns`). Every setup is
+    run by the same engine, see `run_chains` in experiments.py.
+    '''
+
+    name = None
+    cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Response", "Prediction", "Answer", "Accu"]
+    consecutive_rounds = True
+    supports_repeat_same_img = False
+    # whether every response ends with a single final answer, so that a stream can stop there
+    single_answer = True
+
+    def __init__(self, transcripts, mapper, playbook, all_image_fps, num_objects_per_image, args, telemetry=None):
+        self.transcripts = transcripts
+        self.telemetry = telemetry
+        self.mapper = mapper
+        self.playbook = playbook
+        self.all_image_fps = all_image_fps
+        self.num_objects_per_image = num_objects_per_image
+        self.args = args
+
+        system_prompt, self.prompt_tmp = get_prompt_templates_from_setup_name(self.name)
+        self.system_prompt = system_prompt.substitute(num_of_objects=num_objects_per_image,
+                                                      example_sequence=random_sequence_mapper[num_objects_per_image])
+
+    def check_rounds(self, rounds):
+        if self.consecutive_rounds:
+            for i in range(len(rounds) - 1):
+                assert rounds[i] + 1 == rounds[i + 1], \
+                    f"Under setup {self.name}, rounds should be consecutive. Found {rounds[i]} and {rounds[i + 1]}."
+
+    def get_image_path(self, run_num, rounds, i, image_fps):
+        if not self.args.not_use_playbook:
+            if self.supports_repeat_same_img and self.args.repeat_same_img:
+                return self.playbook[str(run_num)][str(rounds[0])]
+            return self.playbook[str(run_num)][str(rounds[i])]
+        return image_fps[i]
+
+    def get_chain_keys(self, run_num, model, pair, rounds):
+        '''The (run, model, pair, round) keys of the rows a chain produces, used to resume runs.'''
+        return [(run_num, model, pair, round) for round in rounds]
+
+    def get_chains(self, rounds, pairs, models):
+        chains = []
+
+        for run_num in range(self.args.num_experiments_per_experiment):
+
+            image_fps = sample(self.all_image_fps, len(rounds))
+
+            for model in models:
+                for pair in pairs:
+                    keys = self.get_chain_keys(run_num, model, pair, rounds)
+                    chains.append((model, keys, partial(self.get_turns, run_num, model, pair, rounds, image_fps)))
+
+        return chains
+
+    def get_turns(self, run_num, model, pair, rounds, image_fps):
+        raise NotImplementedError
+
+    def record_parse(self, model, start, pred):
+        if self.telemetry is not None:
+            self.telemetry.record(model, "parse", perf_counter() - start,
+                                  ok=pred not in ["CANNOT_PARSE", "REQUEST_FAILED"])
+
+    def score(self, run_num, round, pair, image_path, model, response, answer):
+        '''Score the final response of a round and return its result row.'''
+        try:
+            start = perf_counter()
+            pred = extract_prediction(response, self.num_objects_per_image)
+            self.record_parse(model, start, pred)
+            accu = compute_accu(answer, pred)
+            print(f"Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}, Accuracy {accu:.2f}")
+            return [run_num, round, pair, image_path, model, response, pred, answer, accu]
+
+        except Exception as e:
+            print(f"Error processing Run Number {run_num}, Image Path {image_path}, Round {round}, Pair {pair}, Model {model}: {e}")
+            return [run_num, round, pair, image_path, model, response, "ERROR", answer, 0]
+
+
+class PerRoundSetup(Setup):
+    '''Setups with one prompt per round, all in the same chat.'''
+
+    def get_prompt(self, round, pair, image_path):
+        '''Return the prompt and the raw answer of the round.'''
+        raise NotImplementedError
+
+    def get_turns(self, run_num, model, pair, rounds, image_fps):
+        out = []
+
+        for i, round in enumerate(rounds):
+            image_path = self.get_image_path(run_num, rounds, i, image_fps)
+            prompt, answer = self.get_prompt(round, pair, image_path)
+            answer = answer_transform(image_path, answer, self.mapper)
+
+            response = yield prompt
+            out.append(self.score(run_num, round, pair, image_path, model, response, answer))
+
+            for row in (yield from self.get_follow_up_turns(run_num, round, pair, image_path, model, answer)):
+                out.append(row)
+
+        return out
+
+    def get_follow_up_turns(self, run_num, round, pair, image_path, model, answer):
+        '''Turns after the answer of a round, e.g. feedback. Yields prompts and returns rows like `get_turns`.'''
+        return []
+        yield
+
+
+@register_setup
+class OneTranscriptAtATime(PerRoundSetup):
+    name = "one transcript at a time"
+    supports_repeat_same_img = True
+
+    def get_prompt(self, round, pair, image_path):
+        transcript, answer = self.transcripts.get_conversations(round, pair, return_entire_transcript=True)
+        return self.prompt_tmp.substitute(transcript=transcript, image_path=image_path), answer
+
+
+@register_setup
+class ObjectSummaries(PerRoundSetup):
+    name = "object summaries"
+
+    def get_prompt(self, round, pair, image_path):
+        summaries, answer = self.transcripts.get_conversations(round, pair, return_entire_transcript=False)
+        summaries = ["### Summary for object " + str(i+1) + "\n" + s for i, s in enumerate(summaries)]
+        summaries = "\n\n".join(summaries)
+        return self.prompt_tmp.substitute(summaries=summaries, image_path=image_path), answer
+
+
+@register_setup
+class AllTranscripts(Setup):
+    name = "all transcripts"
+    single_answer = False
+    cols = ["Run Number", "Rounds", "Pair", "Image FPs", "Model", "Response", "Prediction", "Answer", "Accu"]
+
+    def get_chain_keys(self, run_num, model, pair, rounds):
+        return [(run_num, model, pair, tuple(rounds))]
+
+    def get_turns(self, run_num, model, pair, rounds, image_fps):
+        # chains of the same run share the sampled list, so fill in a copy
+        image_fps = list(image_fps)
+        prompts, answers = [], []
+
+        for i, round in enumerate(rounds):
+            image_fps[i] = image_path = self.get_image_path(run_num, rounds, i, image_fps)
+            transcript, answer = self.transcripts.get_conversations(round, pair, return_entire_transcript=True)
+            answer = answer_transform(image_path, answer, self.mapper)
+            prompt = self.prompt_tmp.substitute(transcript=transcript, image_path=image_path, ix=i+1)
+            prompts.append(prompt)
+            answers.append(answer)
+
+        prompt = f"\n\n{'*'*50}\n\n".join(prompts)
+        response = yield prompt
+        try:
+            start = perf_counter()
+            preds = extract_json_response(response, num_matches=len(rounds))
+            self.record_parse(model, start, preds)
+            accus = compute_accu_for_json_response(answers, preds)
+            print(f"Run Number {run_num}, Image Paths {image_fps}, Rounds {rounds}, Pair {pair}, Model {model}, Accuracy {accus}")
+            return [[run_num, rounds, pair, image_fps, model, response, preds, answers, accus]]
+
+        except Exception as e:
+            print(f"Error processing Run Number {run_num}, Image Paths {image_fps}, Rounds {rounds}, Pair {pair}, Model {model}: {e}")
+            return [[run_num, rounds, pair, image_fps, model, response, "ERROR", answers, 0]]
+
+
+@register_setup
+class ObjectDescriptions(Setup):
+    '''One chat per (run, model, round, pair), with one turn per target picture.'''
+
+    name = "object descriptions"
+    cols = ["Run Number", "Round", "Pair", "Image FP", "Model", "Conversation", "Response", "Prediction", "Answer", "Accu"]
+    consecutive_rounds = False
+
+    def check_rounds(self, rounds):
+        assert self.args.num_experiments_per_experiment <= len(self.all_image_fps), \
+            f"Under setup {self.name}, number of experiments per experiment {self.args.num_experiments_per_experiment} "\
+                f"cannot be greater than number of images {len(self.all_image_fps)}."
+
+    def get_chains(self, rounds, pairs, models):
+        chains = []
+        image_fps = sample(self.all_image_fps, self.args.num_experiments_per_experiment)
+
+        for run_num, image_path in enumerate(image_fps):
+            for model in models:
+                for round in rounds:
+
+                    if not self.args.not_use_playbook:
+                        image_path = self.playbook[str(run_num)][str(round)]
+
+                    for pair in pairs:
+                        keys = [(run_num, model, pair, round)]
+                        chains.append((model, keys, partial(self.get_turns, run_num, model, round, pair, image_path)))
+
+        return chains
+
+    def get_turns(self, run_num, model, round, pair, image_path):
+        out = []
+        conversations, answer = self.transcripts.get_conversations(round, pair, return_entire_transcript=False)
+        conversations = conversations + ["The conversation is over. Please give your final answer."]
+        answer = answer_transform(image_path, answer, self.mapper)
+
+        prompt = self.prompt_tmp.substitute(conversation=conversations[0], image_path=image_path)
+        response = yield prompt
+        out.append([run_num, round, pair, image_path, model, conversations[0], response, '-', '-', '-'])
+
+        for conversation in conversations[1:]:
+            response = yield conversation
+            out.append([run_num, round, pair, image_path, model, conversation, response, '-', '-', '-'])
+
+        # final response
+        row = self.score(run_num, round, pair, image_path, model, response, answer)
+        out.append(row[:5] + [conversation] + row[5:])
+        return out
+
+
+@register_setup
+class PlusFeedback(OneTranscriptAtATime):
+    name = "plus feedback"
+    # the reflection on the correct answer may restate it and should not be cut short
+    single_answer = False
+
+    def get_follow_up_turns(self, run_num, round, pair, image_path, model, answer):
+        answer_prompt = f"Here is correct sequence of picture indices as described by the Director: {answer}. Reflect on your previous answer if it was wrong. We will proceed after your reflection."
+        response = yield answer_prompt
+        return [[run_num, round, pair, image_path, model, response, "ResponseToTheCorrectAnswer", answer, 0]]
+
+
+SETUP_NAMES = list(SETUPS)
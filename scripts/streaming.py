@@ -0,0 +1,113 @@
+import time
+import inspect
+
+from scripts.parsing import StreamingParser
+from scripts.response_cache import make_completion_response
+
+
+# the answer format all single-answer prompt templates ask for
+FINAL_ANSWER_MARKER = "final answer"
+
+
+def get_delta_text(chunk):
+    choices = getattr(chunk, "choices", None)
+    if not choices:
+        return ""
+    return getattr(choices[0].delta, "content", None) or ""
+
+
+class StreamCollector:
+    '''Accumulates the chunks of a streamed completion and times them.
+
+    With `num_objects`, the text is parsed as it arrives (see StreamingParser) to record the time
+    to answer: when a valid permutation after the "Final Answer" marker is complete. With
+    `early_stop`, `add` then returns True to tell the caller to cancel the rest of the generation.
+    '''
+
+    def __init__(self, num_objects=None, early_stop=False):
+        self.start = time.monotonic()
+        self.parts = []
+        self.usage = None
+        self.first_token_at = None
+        self.answer_at = None
+        self.stopped_early = False
+        self.early_stop = early_stop
+        self.parser = None if num_objects is None else StreamingParser(num_objects)
+
+    def has_answer(self):
+        if not self.parser.is_complete():
+            return False
+        return self.parser.text.lower().rfind(FINAL_ANSWER_MARKER, 0, self.parser.best_pos) != -1
+
+    def add(self, chunk):
+        '''Add a chunk and return True if the generation can be stopped.'''
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+
+        text = get_delta_text(chunk)
+        if not text:
+            return False
+
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.parts.append(text)
+
+        if self.parser is not None and self.answer_at is None:
+            self.parser.feed(text)
+            if self.has_answer():
+                self.answer_at = now
+                self.stopped_early = self.early_stop
+
+        return self.stopped_early
+
+    def get_response(self):
+        '''A completion response with the streamed text, the usage if reported, and a `timing` dict in seconds.'''
+        end = time.monotonic()
+        response = make_completion_response("".join(self.parts))
+        response.usage = self.usage
+        response.timing = {
+            "ttft": None if self.first_token_at is None else self.first_token_at - self.start,
+            "time_to_answer": None if self.answer_at is None else self.answer_at - self.start,
+            "latency": end - self.start,
+            "stopped_early": self.stopped_early,
+        }
+        return response
+
+
+def close_stream(stream):
+    '''Close a stream of chunks, which drops the connection and ends the generation on the provider's side.
+
+    litellm wraps the provider's stream in `completion_stream`. Returns an awaitable for async streams.
+    '''
+    stream = getattr(stream, "completion_stream", None) or stream
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    return close() if close is not None else None
+
+
+def stream_completion(create_fn, messages, temperature, num_objects=None, early_stop=False):
+    '''Stream a completion from `create_fn(messages, temperature)`, which must return an iterator of chunks.'''
+    collector = StreamCollector(num_objects, early_stop)
+    stream = create_fn(messages, temperature)
+
+    for chunk in stream:
+        if collector.add(chunk):
+            close_stream(stream)
+            break
+
+    return collector.get_response()
+
+
+async def stream_completion_async(create_fn, messages, temperature, num_objects=None, early_stop=False):
+    '''Same as `stream_completion` for an async `create_fn` returning an async iterator of chunks.'''
+    collector = StreamCollector(num_objects, early_stop)
+    stream = await create_fn(messages, temperature)
+
+    async for chunk in stream:
+        if collector.add(chunk):
+            closed = close_stream(stream)
+            if inspect.isawaitable(closed):
+                await closed
+            break
+
+    return collector.get_response()
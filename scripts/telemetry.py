@@ -0,0 +1,115 @@
+import json
+import time
+import random
+from array import array
+from threading import Lock
+
+import numpy as np
+
+
+# stages timed by LVLMChat and the setups, in the order they happen for a request
+STAGES = ["build", "encode", "network", "retry_wait", "parse", "request"]
+
+
+class DurationReservoir:
+    '''Count and sum of the durations of one (model, stage), with a uniform random sample of at
+    most `max_samples` of them for the percentiles (reservoir sampling), so memory does not grow
+    with the length of a run. Percentiles are exact until `max_samples` durations are recorded.'''
+
+    def __init__(self, max_samples=10000, seed=0):
+        self.max_samples = max_samples
+        self.rng = random.Random(seed)
+        self.samples = array("d")
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if len(self.samples) < self.max_samples:
+            self.samples.append(duration)
+        else:
+            ix = self.rng.randrange(self.count)
+            if ix < self.max_samples:
+                self.samples[ix] = duration
+
+
+class Telemetry:
+    '''Timing events of every stage of every request, optionally appended to a JSONL file.
+
+    Stages: "build" lays out the request messages (including "encode", the images in them),
+    "network" is one attempt at the completion call, "retry_wait" the backoff after a failed
+    attempt, "parse" extracts the prediction from a response, and "request" is a whole
+    request from build to response, retries included.
+    '''
+
+    def __init__(self, fp=None, append=True, max_samples=10000):
+        self.fp = fp
+        self.lock = Lock()
+        self.file = None
+        self.max_samples = max_samples
+
+        # only a bounded sample of the durations is kept in memory, so a long run does not pile up events
+        self.durations = dict()
+        self.errors = dict()
+        self.spans = dict()
+
+        if fp is not None:
+            self.file = open(fp, "a" if append else "w")
+
+    def record(self, model, stage, duration, ok=True, **fields):
+        event = dict(time=time.time(), model=model, stage=stage, duration=duration, ok=ok, **fields)
+        key = (model, stage)
+
+        with self.lock:
+            if key not in self.durations:
+                self.durations[key] = DurationReservoir(self.max_samples)
+            self.durations[key].add(duration)
+            self.errors[key] = self.errors.get(key, 0) + (not ok)
+            start, end = self.spans.get(key, (event["time"] - duration, event["time"]))
+            self.spans[key] = (min(start, event["time"] - duration), max(end, event["time"]))
+
+            if self.file is not None:
+                self.file.write(json.dumps(event) + "\n")
+                self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def summary(self):
+        '''Per (model, stage): count, error rate and mean/p50/p95/p99 durations in seconds.
+        "request" stages also get the throughput in requests per second.'''
+        with self.lock:
+            durations = {key: (np.array(reservoir.samples), reservoir.count, reservoir.total)
+                         for key, reservoir in self.durations.items()}
+            errors, spans = dict(self.errors), dict(self.spans)
+
+        out = dict()
+        for model, stage in sorted(durations, key=lambda key: (key[0], STAGES.index(key[1]))):
+            key = (model, stage)
+            samples, count, total = durations[key]
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            totals = {"count": count, "error_rate": errors[key] / count,
+                      "mean": total / count, "p50": p50, "p95": p95, "p99": p99}
+
+            if stage == "request":
+                span = spans[key][1] - spans[key][0]
+                totals["throughput"] = count / span if span > 0 else None
+
+            out[key] = totals
+
+        return out
+
+    def get_postfix(self, stage="network"):
+        '''Short live summary for a progress bar, e.g. "network p50 1.20s p95 3.10s err 2%".'''
+        with self.lock:
+            keys = [key for key in self.durations if key[1] == stage]
+            if not keys:
+                return ""
+            durations = np.concatenate([np.array(self.durations[key].samples) for key in keys])
+            count = sum(self.durations[key].count for key in keys)
+            num_errors = sum(self.errors[key] for key in keys)
+
+        p50, p95 = np.percentile(durations, [50, 95])
+        return f"{stage} p50 {p50:.2f}s p95 {p95:.2f}s err {num_errors / count:.0%}"
@@ -0,0 +1,90 @@
+import os
+import pickle
+
+import pandas as pd
+
+
+# bump when the layout of the index changes, so that stale index files are rebuilt
+INDEX_VERSION = 1
+
+
+def get_index_fp(data_fp):
+    '''Path of the binary transcript index kept next to the data file.'''
+    return os.path.splitext(data_fp)[0] + ".index.pkl"
+
+
+def read_data_file(data_fp):
+    '''The matching-data sheet of an xlsx file, or of a parquet file such as the ones scripts.rewrite writes.'''
+    if data_fp.endswith(".parquet"):
+        return pd.read_parquet(data_fp)
+    return pd.read_excel(data_fp)
+
+
+class TranscriptStore:
+    '''Transcripts of a data file, indexed by (round, pair) once instead of filtering the sheet on every call.
+
+    `load` reads the index from a pickle next to the data file and only re-parses the data file
+    when the index is missing or older than the data file.
+    '''
+
+    def __init__(self, pairs, chunks, answers):
+        self.pairs = pairs
+        self.chunks = chunks
+        self.answers = answers
+        self.transcripts = dict()
+
+    @classmethod
+    def from_dataframe(cls, df):
+        pairs = df.columns.to_list()[3:]
+        chunks, answers = dict(), dict()
+
+        for round_ix, sub in df.groupby("Round", sort=False):
+            round_ix = int(round_ix)
+            answers[round_ix] = sub["Answer"].to_list()
+            for pair_ix in pairs:
+                chunks[(round_ix, pair_ix)] = sub[pair_ix].to_list()
+
+        return cls(pairs, chunks, answers)
+
+    @classmethod
+    def load(cls, data_fp):
+        index_fp = get_index_fp(data_fp)
+        stat = os.stat(data_fp)
+
+        if os.path.exists(index_fp):
+            try:
+                with open(index_fp, "rb") as f:
+                    index = pickle.load(f)
+                if index["version"] == INDEX_VERSION and index["source"] == (stat.st_mtime_ns, stat.st_size):
+                    return cls(index["pairs"], index["chunks"], index["answers"])
+            except Exception as e:
+                print(f"Rebuilding transcript index {index_fp}: {e}")
+
+        store = cls.from_dataframe(read_data_file(data_fp))
+        store.save(index_fp, (stat.st_mtime_ns, stat.st_size))
+        return store
+
+    def save(self, index_fp, source):
+        index = {"version": INDEX_VERSION, "source": source,
+                 "pairs": self.pairs, "chunks": self.chunks, "answers": self.answers}
+        tmp_fp = f"{index_fp}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fp, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fp, index_fp)
+        except OSError as e:
+            print(f"Could not save transcript index {index_fp}: {e}")
+
+    def get_conversations(self, round_ix, pair_ix,
+                          return_entire_transcript=False,
+                          chunk_separator="\n\n"):
+        '''Same as `scripts.utils.get_conversations`, as a dict lookup.'''
+        answer = list(self.answers[round_ix])
+
+        if return_entire_transcript:
+            key = (round_ix, pair_ix, chunk_separator)
+            if key not in self.transcripts:
+                self.transcripts[key] = chunk_separator.join(self.chunks[(round_ix, pair_ix)])
+            return self.transcripts[key], answer
+        else:
+            return list(self.chunks[(round_ix, pair_ix)]), answer
@@ -0,0 +1,100 @@
+import json
+import time
+from threading import Lock
+
+from litellm import cost_per_token
+
+
+def get_usage(response):
+    '''(prompt, completion, cached prompt) tokens reported in a response, or None if it reports no usage.'''
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+    # openai-style usage reports prompt_tokens_details.cached_tokens, anthropic cache_read_input_tokens
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or getattr(usage, "cache_read_input_tokens", 0) or 0
+
+    return prompt_tokens, completion_tokens, cached_tokens
+
+
+def get_cost(model, prompt_tokens, completion_tokens):
+    '''Estimated cost in USD from litellm's price list, or None for models it does not know.'''
+    try:
+        prompt_cost, completion_cost = cost_per_token(model=model,
+                                                      prompt_tokens=prompt_tokens,
+                                                      completion_tokens=completion_tokens)
+        return prompt_cost + completion_cost
+    except Exception:
+        return None
+
+
+class UsageLedger:
+    '''Per-run record of the tokens used by every request, optionally appended to a JSONL file.'''
+
+    def __init__(self, fp=None, append=True):
+        self.fp = fp
+        self.totals = dict()
+        self.lock = Lock()
+
+        if fp is not None and not append:
+            open(fp, "w").close()
+
+    def record(self, model, response, num_messages=None, num_images=None):
+        '''Record the usage of a response, and the `timing` of streamed responses (see scripts.streaming).'''
+        usage = get_usage(response)
+        timing = getattr(response, "timing", None)
+        if usage is None and timing is None:
+            return
+
+        # a stream cancelled early does not get to report its usage
+        prompt_tokens, completion_tokens, cached_tokens = usage or (0, 0, 0)
+        record = {"time": time.time(),
+                  "model": model,
+                  "prompt_tokens": prompt_tokens,
+                  "completion_tokens": completion_tokens,
+                  "cached_tokens": cached_tokens,
+                  "num_messages": num_messages,
+                  "num_images": num_images}
+        if timing is not None:
+            record.update(timing)
+
+        with self.lock:
+            self.add_to_totals(record)
+            if self.fp is not None:
+                with open(self.fp, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def add_to_totals(self, record):
+        # running totals only, so memory does not grow with the number of requests
+        totals = self.totals.setdefault(record["model"], {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                          "cached_tokens": 0, "stopped_early": 0, "timings": dict()})
+        totals["requests"] += 1
+        for k in ["prompt_tokens", "completion_tokens", "cached_tokens"]:
+            totals[k] += record[k]
+        totals["stopped_early"] += int(bool(record.get("stopped_early")))
+
+        for k in ["ttft", "time_to_answer", "latency"]:
+            if record.get(k) is not None:
+                total, count = totals["timings"].get(k, (0.0, 0))
+                totals["timings"][k] = (total + record[k], count + 1)
+
+    def summary(self):
+        '''Totals by model: requests, prompt, completion and cached tokens, the estimated cost, and the mean timings of streamed requests.'''
+        out = dict()
+
+        with self.lock:
+            for model, totals in self.totals.items():
+                out[model] = {k: totals[k] for k in ["requests", "prompt_tokens", "completion_tokens", "cached_tokens"]}
+                out[model]["cost"] = get_cost(model, totals["prompt_tokens"], totals["completion_tokens"])
+
+                # means over streamed requests only
+                for k in ["ttft", "time_to_answer", "latency"]:
+                    total, count = totals["timings"].get(k, (0.0, 0))
+                    out[model][k] = total / count if count else None
+                out[model]["stopped_early"] = totals["stopped_early"]
+
+        return out
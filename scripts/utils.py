@@ -47,7 +47,7 @@ def get_filepathes_from_dir(file_dir, include_sub_dir=False,
 def get_conversations(df, round_ix, pair_ix, 
                       return_entire_transcript=False, 
                       chunk_separator="\n\n"):
-    sub = df.copy()[df["Round"] == round_ix]
+    sub = df[df["Round"] == round_ix]
     convs = sub[pair_ix].to_list()
     answer = sub["Answer"].to_list()
 
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import itertools
+import subprocess
+from threading import Lock, BoundedSemaphore
+from contextlib import ExitStack
+
+import pyarrow as pa
+from tqdm import tqdm
+
+from experiments import get_parser, get_res_fp
+from scripts.results import get_arrow_fp, get_state_fp, get_stream_fp, load_arrow_results, save_arrow_table
+from scripts.scheduler import ChainScheduler, get_provider, parse_provider_concurrency
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Run a grid of experiments.py jobs in parallel.")
+    parser.add_argument("sweep_fp", type=str, help="JSON file with the grid, see sweeps/examples.json")
+    parser.add_argument("--sweep_dire", type=str, default=None, help="Directory for the job logs, manifest and merged results. Default is results/sweeps/<sweep name>.")
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count(), help="Max number of jobs running at once. Default is the number of cores.")
+    parser.add_argument("--max_concurrency", type=int, default=2, help="Max number of jobs running at once per provider. Default is 2.")
+    parser.add_argument("--provider_concurrency", type=str, default=None, help="Per-provider overrides of max_concurrency, e.g. openai=4,groq=1")
+    parser.add_argument("--rerun", action="store_true", help="Rerun jobs whose results already exist.")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the jobs.")
+    return parser.parse_args()
+
+
+def expand_grid(spec):
+    '''Expand a sweep spec into a list of jobs, each a dict of experiments.py arguments.
+
+    The spec has optional "defaults" and a list of "grids". Every grid maps argument names to a
+    value or a list of values, and yields one job per combination. A value can also be a dict of
+    arguments that go together, e.g. {"data_fp": ..., "image_dire": ...}.
+    '''
+    jobs = []
+
+    for grid in spec["grids"]:
+        keys = list(grid)
+        values = [grid[k] if isinstance(grid[k], list) else [grid[k]] for k in keys]
+
+        for combination in itertools.product(*values):
+            job = dict(spec.get("defaults", dict()))
+            for k, v in zip(keys, combination):
+                if isinstance(v, dict):
+                    job.update(v)
+                else:
+                    job[k] = v
+            jobs.append(job)
+
+    return jobs
+
+
+def get_job_id(job):
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+
+
+def get_command(job):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments.py")]
+    for k, v in job.items():
+        if v is True:
+            command.append(f"--{k}")
+        elif v is not False and v is not None:
+            command.append(f"--{k}={v}")
+    return command
+
+
+class Sweep:
+    '''Jobs of a sweep, run as experiments.py processes.
+
+    At most `max_workers` jobs run at once, and at most as many per provider as the
+    scheduler allows, so that every provider quota is used without one provider taking
+    all the workers. A job with the models of several providers counts against each of them.
+    Jobs with results are skipped, and interrupted jobs are resumed.
+    '''
+
+    def __init__(self, jobs, sweep_dire, max_workers, scheduler):
+        defaults = vars(get_parser().parse_args([]))
+        self.jobs = []
+
+        for job in jobs:
+            job_id = get_job_id(job)
+            job = dict(job, output_fn=job.get("output_fn") or job_id)
+            args = dict(defaults, **job)
+            res_fp = get_res_fp(args["image_dire"], args["setup_name"], job["output_fn"])
+            self.jobs.append({"id": job_id, "args": job, "res_fp": res_fp,
+                              "data_fp": args["data_fp"], "setup_name": args["setup_name"],
+                              "providers": sorted({get_provider(model) for model in args["models"].split(",")})})
+
+        self.sweep_dire = sweep_dire
+        self.workers = BoundedSemaphore(max_workers)
+        self.scheduler = scheduler
+        # the scheduler runs jobs of several providers in a pool of their own, so these hold each provider to its limit
+        self.provider_slots = {provider: BoundedSemaphore(scheduler.get_limit(provider))
+                               for job in self.jobs for provider in job["providers"]}
+        self.running = dict()
+        self.lock = Lock()
+        self.pbar = None
+
+    def update_status(self):
+        running = ", ".join(f"{provider}={n}" for provider, n in sorted(self.running.items()) if n)
+        self.pbar.set_postfix_str(f"running: {running or 'none'}")
+
+    def run_job(self, job, rerun=False):
+        args = dict(job["args"])
+        if rerun:
+            for fp in [job["res_fp"], get_stream_fp(job["res_fp"]), get_state_fp(job["res_fp"]), get_arrow_fp(job["res_fp"])]:
+                if os.path.exists(fp):
+                    os.remove(fp)
+        elif os.path.exists(get_state_fp(job["res_fp"])):
+            args["resume"] = True
+
+        # providers are taken in sorted order, so two jobs never wait on each other
+        with ExitStack() as stack:
+            for provider in job["providers"]:
+                stack.enter_context(self.provider_slots[provider])
+            stack.enter_context(self.workers)
+
+            with self.lock:
+                for provider in job["providers"]:
+                    self.running[provider] = self.running.get(provider, 0) + 1
+                self.update_status()
+
+            start = time.time()
+            with open(os.path.join(self.sweep_dire, "logs", f"{job['id']}.log"), "w") as log:
+                returncode = subprocess.call(get_command(args), stdout=log, stderr=subprocess.STDOUT)
+
+            with self.lock:
+                for provider in job["providers"]:
+                    self.running[provider] -= 1
+                self.update_status()
+
+        return {"returncode": returncode, "elapsed": time.time() - start}
+
+    def run(self, rerun=False):
+        os.makedirs(os.path.join(self.sweep_dire, "logs"), exist_ok=True)
+        todo = [job for job in self.jobs if rerun or not os.path.exists(job["res_fp"])]
+        print(f"{len(self.jobs) - len(todo)} of {len(self.jobs)} jobs already done.")
+
+        manifest_fp = os.path.join(self.sweep_dire, "jobs.jsonl")
+        with open(manifest_fp, "a") as manifest, tqdm(total=len(todo), desc="jobs") as self.pbar:
+            chains = [(tuple(job["providers"]), lambda job=job: self.run_job(job, rerun)) for job in todo]
+
+            for ix, status in self.scheduler.run(chains):
+                job = todo[ix]
+                manifest.write(json.dumps(dict(job, time=time.time(), **status)) + "\n")
+                manifest.flush()
+                if status["returncode"] != 0:
+                    tqdm.write(f"Job {job['id']} failed with code {status['returncode']}, "
+                               f"see {os.path.join(self.sweep_dire, 'logs', job['id'] + '.log')}")
+                self.pbar.update(1)
+
+    def merge(self):
+        '''Concatenate the Arrow results of all finished jobs into one file, tagged by job.'''
+        tables = []
+        for job in self.jobs:
+            arrow_fp = get_arrow_fp(job["res_fp"])
+            if not os.path.exists(arrow_fp):
+                continue
+
+            table = load_arrow_results(arrow_fp)
+            for name in ["job_id", "data_fp", "setup_name"]:
+                value = job["id"] if name == "job_id" else job[name]
+                table = table.append_column(name, pa.array([value] * table.num_rows, type=pa.string()).dictionary_encode())
+            tables.append(table)
+
+        if not tables:
+            return None
+
+        merged_fp = os.path.join(self.sweep_dire, "results.arrow")
+        save_arrow_table(pa.concat_tables(tables, promote_options="permissive"), merged_fp)
+        return merged_fp
+
+
+def main():
+    args = get_args()
+
+    with open(args.sweep_fp, "r") as f:
+        spec = json.load(f)
+    jobs = expand_grid(spec)
+
+    sweep_dire = args.sweep_dire or os.path.join("results", "sweeps", os.path.splitext(os.path.basename(args.sweep_fp))[0])
+    scheduler = ChainScheduler(max_concurrency=args.max_concurrency,
+                               provider_concurrency=parse_provider_concurrency(args.provider_concurrency))
+    sweep = Sweep(jobs, sweep_dire, args.max_workers, scheduler)
+
+    if args.dry_run:
+        for job in sweep.jobs:
+            status = "done" if os.path.exists(job["res_fp"]) else "todo"
+            print(job["id"], status, shlex.join(get_command(job["args"])[2:]))
+        return
+
+    sweep.run(rerun=args.rerun)
+    merged_fp = sweep.merge()
+    if merged_fp is not None:
+        print(f"Merged results saved to {merged_fp}")
+
+
+if __name__ == "__main__":
+    main()
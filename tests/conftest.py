@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import random
+import subprocess
+
+import pytest
+import pandas as pd
+from PIL import Image
+
+
+REPO_DIRE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def baskets_dire(tmp_path):
+    '''A small baskets dataset in the layout of data/: grids with a mapper and playbook, and a matching-data sheet.'''
+    rng = random.Random(0)
+    ids = list(range(1, 14))
+    grid_dire = tmp_path / "data" / "baskets-grid"
+    grid_dire.mkdir(parents=True)
+
+    mapper = {"data": dict(), "metadata": {"number_of_objects_per_image": 13}}
+    for k in range(6):
+        fp = f"data/baskets-grid/random_order_{k}.png"
+        Image.new("RGB", (60, 40), (k * 40, 50, 50)).save(tmp_path / fp)
+        mapper["data"][fp] = rng.sample(ids, 13)
+    mapper["metadata"]["number_of_images"] = len(mapper["data"])
+    (grid_dire / "mapper.json").write_text(json.dumps(mapper))
+
+    playbook = {str(r): {str(t): rng.choice(list(mapper["data"])) for t in range(1, 5)} for r in range(10)}
+    (grid_dire / "playbook.json").write_text(json.dumps(playbook))
+
+    rows = []
+    for round in range(1, 5):
+        for j, answer in enumerate(rng.sample(ids, 13)):
+            row = {"Trial": round, "Round": round, "Answer": answer}
+            row.update({f"Pair{p}": f"D: round {round} object {j} has stripes\nM: got it" for p in range(1, 4)})
+            rows.append(row)
+    pd.DataFrame(rows).to_excel(tmp_path / "data" / "baskets-matching-data.xlsx", index=False)
+    return tmp_path
+
+
+def run_experiments(dire, *args):
+    '''Run experiments.py in `dire` and return the path of its results for the --output_fn in `args`.'''
+    env = dict(os.environ, PYTHONPATH=REPO_DIRE)
+    subprocess.run([sys.executable, os.path.join(REPO_DIRE, "experiments.py"),
+                    "--data_fp=data/baskets-matching-data.xlsx", "--image_dire=data/baskets-grid", *args],
+                   cwd=dire, env=env, check=True, capture_output=True)
+    output_fn = [arg.split("=", 1)[1] for arg in args if arg.startswith("--output_fn=")][0]
+    setup_name = [arg.split("=", 1)[1] for arg in args if arg.startswith("--setup_name=")][0]
+    return dire / "results" / "baskets-grid" / f"setup{setup_name}" / f"{output_fn}.csv"
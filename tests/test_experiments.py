@@ -0,0 +1,29 @@
+import pytest
+
+from conftest import run_experiments
+
+
+MOCK_ARGS = ["--mock_backend=seed=1", "--models=mock/a,mock/b", "--rounds=1,2", "--num_pairs=2",
+             "--num_experiments_per_experiment=2"]
+
+
+@pytest.mark.parametrize("setup_name", ["one transcript at a time", "plus feedback"])
+def test_batch_matches_chats(baskets_dire, setup_name):
+    args = MOCK_ARGS + [f"--setup_name={setup_name}"]
+    chats = run_experiments(baskets_dire, *args, "--output_fn=chats")
+    batch = run_experiments(baskets_dire, *args, "--output_fn=batch", "--batch", "--batch_poll_interval=0")
+    assert chats.read_bytes() == batch.read_bytes()
+
+
+def test_resume_after_partly_written_chain(baskets_dire):
+    args = MOCK_ARGS + ["--setup_name=one transcript at a time"]
+    full = run_experiments(baskets_dire, *args, "--output_fn=full")
+
+    # the interrupted run saved the first chain and one row of the second
+    dire = full.parent
+    lines = (dire / "full.jsonl").read_text().splitlines(True)
+    (dire / "resumed.jsonl").write_text("".join(lines[:3]))
+    (dire / "resumed.state.json").write_text((dire / "full.state.json").read_text())
+
+    resumed = run_experiments(baskets_dire, *args, "--output_fn=resumed", "--resume")
+    assert full.read_bytes() == resumed.read_bytes()
@@ -0,0 +1,23 @@
+from scripts.mock_backend import MockBackend
+
+
+def complete(mock, messages, max_tries=20):
+    for _ in range(max_tries):
+        try:
+            return mock.completion(messages, 0).choices[0].message.content
+        except Exception:
+            pass
+    raise AssertionError("The mock kept failing.")
+
+
+def test_attempts_are_dropped_on_success():
+    mock = MockBackend(error_rate=0.3, rate_limit_rate=0.2, seed=1)
+    requests = [[{"role": "user", "content": f"request {i}"}] for i in range(200)]
+
+    responses = [complete(mock, messages) for messages in requests]
+    assert mock.attempts == dict()
+    assert mock.num_attempts > len(requests)
+
+    # the same requests get the same responses from a fresh backend, in any order
+    other = MockBackend(error_rate=0.3, rate_limit_rate=0.2, seed=1)
+    assert [complete(other, messages) for messages in requests[::-1]] == responses[::-1]
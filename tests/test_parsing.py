@@ -0,0 +1,47 @@
+import random
+from time import perf_counter
+
+from scripts.parsing import StreamingParser, parse_prediction
+
+
+RESPONSES = [
+    "The first picture matches 3, the second 1.\nFinal Answer: 3, 1, 2, 4",
+    "Final Answer: 1, 2, 3, 40000",
+    "I think 2, 3 go together. 12, 4 no. Final Answer: 4, 3, 2, 1 ,",
+    "no sequence here 12",
+    "1, 2\n3, 4, 1, 2\n\n",
+]
+
+
+def feed_chunks(text, num_objects, rng):
+    parser = StreamingParser(num_objects)
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, 5)
+        parser.feed(text[start:end])
+        start = end
+    return parser.finish()
+
+
+def test_streaming_matches_one_pass():
+    rng = random.Random(0)
+    for response in RESPONSES:
+        for _ in range(20):
+            assert feed_chunks(response, 4, rng) == parse_prediction(response, 4)
+
+
+def time_feed(num_chunks):
+    parser = StreamingParser(13)
+    chunk = "the basket on the left, 7 of them; "
+    start = perf_counter()
+    for _ in range(num_chunks):
+        parser.feed(chunk)
+    return perf_counter() - start
+
+
+def test_feed_scales_linearly():
+    # a quadratic parser takes 16 times as long for 4 times the chunks
+    time_feed(500)
+    small = min(time_feed(2000) for _ in range(3))
+    large = min(time_feed(8000) for _ in range(3))
+    assert large < 8 * small
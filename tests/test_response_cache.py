@@ -0,0 +1,33 @@
+import asyncio
+
+from scripts.response_cache import ResponseCache, make_completion_response
+
+
+MESSAGES = [{"role": "user", "content": "Which picture?"}]
+
+
+def make_streamed_response(content, stopped_early):
+    response = make_completion_response(content)
+    response.timing = {"stopped_early": stopped_early}
+    return response
+
+
+def test_responses_stopped_early_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cut = cache.wrap(lambda messages, temperature: make_streamed_response("Final Answer: 1, 2", True), "m")
+    full = cache.wrap(lambda messages, temperature: make_streamed_response("Final Answer: 1, 2\nBecause", False), "m")
+
+    assert cut(MESSAGES, 0).choices[0].message.content == "Final Answer: 1, 2"
+    assert len(cache) == 0
+    assert full(MESSAGES, 0).choices[0].message.content == "Final Answer: 1, 2\nBecause"
+    assert cut(MESSAGES, 0).choices[0].message.content == "Final Answer: 1, 2\nBecause"
+
+
+def test_async_responses_stopped_early_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+
+    async def completion(messages, temperature):
+        return make_streamed_response("Final Answer: 1, 2", True)
+
+    asyncio.run(cache.wrap_async(completion, "m")(MESSAGES, 0))
+    assert len(cache) == 0
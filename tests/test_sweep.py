@@ -0,0 +1,65 @@
+import time
+from threading import Lock
+
+import sweep
+from scripts.scheduler import ChainScheduler
+from scripts.results import get_state_fp, get_stream_fp
+
+
+class FakeCalls:
+    '''Stands in for subprocess.call: records the commands and the most jobs running at once per provider.'''
+
+    def __init__(self):
+        self.commands = []
+        self.running = dict()
+        self.max_running = dict()
+        self.lock = Lock()
+
+    def __call__(self, command, **kwargs):
+        providers = {model.split("/")[0] for model in get_models(command)}
+        with self.lock:
+            self.commands.append(command)
+            for provider in providers:
+                self.running[provider] = self.running.get(provider, 0) + 1
+                self.max_running[provider] = max(self.max_running.get(provider, 0), self.running[provider])
+        time.sleep(0.05)
+        with self.lock:
+            for provider in providers:
+                self.running[provider] -= 1
+        return 0
+
+
+def get_models(command):
+    return [arg.split("=", 1)[1] for arg in command if arg.startswith("--models=")][0].split(",")
+
+
+def make_sweep(tmp_path, monkeypatch, models):
+    monkeypatch.chdir(tmp_path)
+    calls = FakeCalls()
+    monkeypatch.setattr(sweep.subprocess, "call", calls)
+    jobs = sweep.expand_grid({"grids": [{"models": models, "pair_ix": list(range(3))}]})
+    jobs = [dict(job, num_pairs=job.pop("pair_ix") + 1) for job in jobs]
+    return sweep.Sweep(jobs, str(tmp_path / "sweep"), 8, ChainScheduler(max_concurrency=1)), calls
+
+
+def test_job_counts_against_every_provider(tmp_path, monkeypatch):
+    s, calls = make_sweep(tmp_path, monkeypatch, ["openai/a,anthropic/b", "anthropic/c", "openai/d"])
+    assert s.jobs[0]["providers"] == ["anthropic", "openai"]
+
+    s.run()
+    assert len(calls.commands) == 9
+    assert calls.max_running == {"openai": 1, "anthropic": 1}
+
+
+def test_rerun_starts_over(tmp_path, monkeypatch):
+    s, calls = make_sweep(tmp_path, monkeypatch, ["openai/a"])
+    for job in s.jobs:
+        (tmp_path / job["res_fp"]).parent.mkdir(parents=True, exist_ok=True)
+        for fp in [job["res_fp"], get_stream_fp(job["res_fp"]), get_state_fp(job["res_fp"])]:
+            (tmp_path / fp).write_text("old")
+
+    s.run(rerun=True)
+    assert len(calls.commands) == 3
+    assert not any("--resume" in command for command in calls.commands)
+    for job in s.jobs:
+        assert not (tmp_path / get_stream_fp(job["res_fp"])).exists()